@@ -1,4 +1,4 @@
-import os, multiprocessing, six
+import os, six
 
 import cget.util as util
 from cget import display
@@ -9,6 +9,9 @@ class Builder:
         self.top_dir = top_dir
         self.build_dir = self.get_path('build')
         self.exists = exists
+        self.jobs = None
+        self.jobserver = None
+        self.archive = None
         self.cmake_original_file = '__cget_original_cmake_file__.cmake'
 
     def get_path(self, *args):
@@ -17,15 +20,21 @@ class Builder:
     def get_build_path(self, *args):
         return self.get_path('build', *args)
 
-    def get_generator(self):
+    def get_jobs(self):
+        return self.jobs or util.default_jobs()
+
+    def get_cache_var(self, name):
         cache_file = self.get_build_path('CMakeCache.txt')
         if os.path.exists(cache_file):
             with open(cache_file) as f:
                 for line in f:
-                    if line.startswith('CMAKE_GENERATOR:'):
+                    if line.startswith(name + ':'):
                         return line.split('=', 1)[1].strip()
         return None
 
+    def get_generator(self):
+        return self.get_cache_var('CMAKE_GENERATOR')
+
     def is_make_generator(self):
         # NMake also writes a Makefile, but nmake has no -j option
         generator = self.get_generator()
@@ -33,6 +42,34 @@ class Builder:
             return 'Makefiles' in generator and 'NMake' not in generator
         return os.path.exists(self.get_build_path('Makefile'))
 
+    def is_ninja_generator(self):
+        generator = self.get_generator()
+        return generator is not None and 'Ninja' in generator
+
+    def get_ninja_version(self):
+        ninja = self.get_cache_var('CMAKE_MAKE_PROGRAM') or util.which('ninja', throws=False)
+        try:
+            out, err = util.cmd([ninja, '--version'], capture='out')
+            return tuple(int(x) for x in out.decode().strip().split('.')[:2])
+        except:
+            return (0, 0)
+
+    # Read by the cmake helper scripts, which launch their own build tools
+    def get_jobs_env(self):
+        return {
+            'CGET_BUILD_JOBS': str(self.get_jobs()),
+            'CGET_JOBSERVER': 'On' if self.jobserver is not None else 'Off'
+        }
+
+    def get_jobserver_env(self):
+        # Ninja only joins a jobserver since 1.12, and only through a fifo
+        if self.jobserver is None: return None
+        if self.is_make_generator():
+            return {'MAKEFLAGS': self.jobserver.makeflags()}
+        if self.is_ninja_generator() and self.jobserver.fifo and self.get_ninja_version() >= (1, 12):
+            return {'MAKEFLAGS': self.jobserver.makeflags(fifo=True)}
+        return None
+
     def cmake(self, options=None, use_toolchain=False, **kwargs):
         if use_toolchain: return self.prefix.cmd.cmake(options=util.merge({'-DCMAKE_TOOLCHAIN_FILE': self.prefix.toolchain}, options), **kwargs)
         else: return self.prefix.cmd.cmake(options=options, **kwargs)
@@ -58,10 +95,26 @@ class Builder:
     def fetch(self, url, hash=None, copy=False, insecure=False):
         self.prefix.log("fetch:", url)
         if insecure: url = url.replace('https', 'http')
-        f = util.retrieve_url(url, self.top_dir, copy=copy, insecure=insecure, hash=hash)
-        if os.path.isfile(f):
-            with display.status("Extracting archive..."):
-                util.extract_ar(archive=f, dst=self.top_dir)
+        # With the source cache, the archive isn't needed once its tree is
+        # cached
+        tree = util.get_source_tree(hash) if util.SOURCE_CACHE and hash else None
+        if tree is None:
+            # Tarballs are extracted while they download, unless they go in
+            # the source cache or cmake has to extract them
+            streaming = not util.SOURCE_CACHE and util.EXTRACT_BACKEND != 'cmake'
+            with util.StreamExtractor(self.top_dir) as extractor:
+                f = util.retrieve_url(url, self.top_dir, copy=copy, insecure=insecure, hash=hash, extractor=extractor if streaming else None)
+                if os.path.isfile(f):
+                    self.archive = f
+                    if util.SOURCE_CACHE:
+                        with display.status("Extracting archive..."):
+                            tree = util.add_source_tree(hash or 'sha256:' + util.hash_file(f, 'sha256'), util.get_fast_archive(f))
+                    elif not extractor.finish():
+                        with display.status("Extracting archive..."):
+                            util.extract_ar(archive=util.get_fast_archive(f), dst=self.top_dir)
+        # The cached files are copied when the build could change them
+        # through the links
+        if tree is not None: util.shadow_dir(tree, self.top_dir, copy=not util.can_protect_links())
         return next(util.get_dirs(self.top_dir))
 
     def configure(self, src_dir, defines=None, generator=None, install_prefix=None, test=True, variant=None):
@@ -82,7 +135,7 @@ class Builder:
         args.extend(['-DCMAKE_BUILD_TYPE={}'.format(variant or 'Release')])
         if install_prefix is not None: args.extend(['-DCMAKE_INSTALL_PREFIX=' + install_prefix])
         try:
-            self.cmake(args=args, cwd=self.build_dir, use_toolchain=True)
+            self.cmake(args=args, cwd=self.build_dir, use_toolchain=True, env=self.get_jobs_env())
         except:
             self.show_logs()
             raise
@@ -97,10 +150,16 @@ class Builder:
         args = ['--build', self.build_dir]
         if variant is not None: args.extend(['--config', variant])
         if target is not None: args.extend(['--target', target])
+        env = self.get_jobserver_env()
+        native = []
         if self.is_make_generator(): 
-            args.extend(['--', '-j', str(multiprocessing.cpu_count())])
-            if self.prefix.verbose: args.append('VERBOSE=1')
-        self.cmake(args=args, cwd=cwd)
+            if env is None: native.extend(['-j', str(self.get_jobs())])
+            if self.prefix.verbose: native.append('VERBOSE=1')
+        elif self.is_ninja_generator() and env is None:
+            native.extend(['-j', str(self.get_jobs())])
+        if native: args.extend(['--'] + native)
+        if env is None: self.cmake(args=args, cwd=cwd)
+        else: self.cmake(args=args, cwd=cwd, env=env, pass_fds=self.jobserver.fds())
 
     def test(self, variant=None):
         display.phase("Testing")
@@ -108,4 +167,4 @@ class Builder:
             self.build(target='check', variant=variant or 'Release')
         else:
             self.prefix.cmd.ctest((self.prefix.verbose and ['-VV'] or []) + ['-C', variant] +
-                                  ['-j', str(multiprocessing.cpu_count())] + ['--output-on-failure'], cwd=self.build_dir)
+                                  ['-j', str(self.get_jobs())] + ['--output-on-failure'], cwd=self.build_dir)
@@ -0,0 +1,302 @@
+import os, json, time, shutil, tarfile, tempfile, threading
+
+from concurrent import futures
+from six.moves.urllib import request, error
+
+import cget.util as util
+from cget import display
+
+# Each package is an entry under the key of its source, toolchain and
+# defines, with its meta.json and requirements. It holds an archive of the
+# installed files for every set of dependencies it was built against, named
+# by the keys of those dependencies.
+class BinaryCache:
+    def __init__(self, path=None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_path(self, *args):
+        if self.path: return os.path.join(self.path, *args)
+        return util.get_cache_path('binary', *args)
+
+    def get_archive(self, key, deps):
+        return self.get_path(key, deps + '.tar.gz')
+
+    def has(self, key):
+        return os.path.exists(self.get_path(key, 'meta.json'))
+
+    def has_build(self, key, deps):
+        return os.path.exists(self.get_archive(key, deps))
+
+    def count(self, hit):
+        with self.lock:
+            if hit: self.hits += 1
+            else: self.misses += 1
+        return hit
+
+    def lookup(self, key):
+        return self.has(key)
+
+    def load_meta(self, key):
+        with open(self.get_path(key, 'meta.json')) as f:
+            return json.load(f)
+
+    def create_entry(self):
+        return tempfile.mkdtemp(prefix='tmp-', dir=util.mkdir(self.get_path()))
+
+    # Entries are built next to their final location and renamed in place,
+    # so a reader never sees a partial entry. A package that is already in
+    # the cache only gets the archive of the new build.
+    def publish(self, key, deps, tmp):
+        try:
+            if not self.has(key):
+                try:
+                    os.rename(tmp, self.get_path(key))
+                    util.cache_added.set()
+                    return
+                except OSError:
+                    # Another process published the same entry first
+                    if not self.has(key): raise
+            os.replace(os.path.join(tmp, deps + '.tar.gz'), self.get_archive(key, deps))
+            util.cache_added.set()
+        finally:
+            util.delete_dir(tmp)
+
+    def save(self, key, deps, install_dir, meta, requirements=None):
+        if self.has_build(key, deps): return
+        tmp = self.create_entry()
+        try:
+            with tarfile.open(os.path.join(tmp, deps + '.tar.gz'), 'w:gz', compresslevel=1) as tar:
+                tar.add(install_dir, arcname='install')
+            if requirements is not None: shutil.copyfile(requirements, os.path.join(tmp, 'requirements.cget'))
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+        except:
+            util.delete_dir(tmp)
+            raise
+        self.publish(key, deps, tmp)
+
+    # Returns None when the package wasn't built against these dependencies
+    def restore(self, key, deps, install_dir):
+        if not self.has_build(key, deps): return None
+        meta = self.load_meta(key)
+        os.utime(self.get_path(key), None)
+        util.delete_dir(install_dir)
+        d = util.mkdir(os.path.dirname(install_dir))
+        # The archive may come from another machine, so its members are
+        # checked to stay in the package
+        util.extract_tar(self.get_archive(key, deps), d, 'gz')
+        return meta
+
+    def finish(self):
+        pass
+
+    def report(self):
+        return "Binary cache: {} hits, {} misses".format(self.hits, self.misses)
+
+# Seconds to wait for the remote binary cache, so a server that stops
+# responding doesn't hang the install
+REMOTE_TIMEOUT=float(os.environ.get('CGET_BINARY_CACHE_TIMEOUT', 60))
+
+class RemoteBinaryCache(BinaryCache):
+    def __init__(self, url, read_only=False, path=None, workers=4, timeout=None):
+        BinaryCache.__init__(self, path)
+        self.url = url.rstrip('/')
+        self.read_only = read_only
+        self.timeout = timeout or REMOTE_TIMEOUT
+        self.uploaded = 0
+        self.upload_failures = 0
+        self.remote = {}
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self.uploads = []
+
+    def get_url(self, key, name):
+        return '{0}/{1}/{2}'.format(self.url, key, name)
+
+    def get(self, key, name, dst=None):
+        try:
+            response = request.urlopen(self.get_url(key, name), timeout=self.timeout)
+        except error.HTTPError as e:
+            if e.code != 404: display.warning("Binary cache download failed with error {0} for: {1}".format(e.code, key))
+            return False
+        except (error.URLError, IOError) as e:
+            display.warning("Binary cache is not reachable: {}".format(e))
+            return False
+        try:
+            with open(dst, 'wb') as f:
+                shutil.copyfileobj(response, f, 1024 * 1024)
+        except Exception as e:
+            display.warning("Binary cache download failed for {0}: {1}".format(key, e))
+            if os.path.exists(dst): os.remove(dst)
+            return False
+        finally:
+            response.close()
+        return True
+
+    def put(self, key, name, src):
+        with open(src, 'rb') as f:
+            req = request.Request(self.get_url(key, name), data=f, method='PUT', headers={'Content-Length': str(os.path.getsize(src))})
+            request.urlopen(req, timeout=self.timeout).close()
+
+    def has_remote(self, key):
+        with self.lock:
+            if key in self.remote: return self.remote[key] is not None
+        # Keep the small files of the entry until an archive is needed
+        tmp = self.create_entry()
+        if self.get(key, 'meta.json', os.path.join(tmp, 'meta.json')):
+            self.get(key, 'requirements.cget', os.path.join(tmp, 'requirements.cget'))
+        else:
+            util.delete_dir(tmp)
+            tmp = None
+        with self.lock:
+            # Another thread looked it up at the same time
+            if key in self.remote: util.delete_dir(tmp)
+            else: self.remote[key] = tmp
+            return self.remote[key] is not None
+
+    def lookup(self, key):
+        return self.has(key) or self.has_remote(key)
+
+    def has(self, key):
+        return os.path.exists(BinaryCache.get_path(self, key, 'meta.json'))
+
+    # Entries found remotely are read from their staging directory until
+    # an archive is downloaded and the entry is published
+    def get_path(self, *args):
+        if args and self.remote.get(args[0]):
+            return os.path.join(self.remote[args[0]], *args[1:])
+        return BinaryCache.get_path(self, *args)
+
+    def restore(self, key, deps, install_dir):
+        if not self.has_build(key, deps) and (self.has(key) or self.has_remote(key)):
+            with self.lock: tmp = self.remote.pop(key, None)
+            tmp = tmp or self.create_entry()
+            if not self.get(key, deps + '.tar.gz', os.path.join(tmp, deps + '.tar.gz')):
+                util.delete_dir(tmp)
+                return None
+            self.publish(key, deps, tmp)
+        return BinaryCache.restore(self, key, deps, install_dir)
+
+    # The meta.json goes last, since the remote cache treats an entry with a
+    # meta.json as complete
+    def upload(self, key, deps):
+        try:
+            for name in ['requirements.cget', deps + '.tar.gz', 'meta.json']:
+                f = BinaryCache.get_path(self, key, name)
+                if os.path.exists(f): self.put(key, name, f)
+            with self.lock: self.uploaded += 1
+        except Exception as e:
+            display.warning("Binary cache upload failed for {0}: {1}".format(key, e))
+            with self.lock: self.upload_failures += 1
+
+    def save(self, key, deps, install_dir, meta, requirements=None):
+        BinaryCache.save(self, key, deps, install_dir, meta, requirements=requirements)
+        if not self.read_only: self.uploads.append(self.executor.submit(self.upload, key, deps))
+
+    def finish(self):
+        futures.wait(self.uploads)
+        self.executor.shutdown()
+        with self.lock:
+            for tmp in self.remote.values(): util.delete_dir(tmp)
+            self.remote = {}
+
+    def report(self):
+        result = BinaryCache.report(self)
+        if self.read_only: return result + " (read-only)"
+        result = result + ", {} uploaded".format(self.uploaded)
+        if self.upload_failures: result = result + ", {} failed uploads".format(self.upload_failures)
+        return result
+
+class CacheEntry:
+    def __init__(self, kind, key, path):
+        self.kind = kind
+        self.key = key
+        self.path = path
+        self.size = 0
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                self.size += os.lstat(os.path.join(root, file)).st_size
+        self.last_used = os.stat(path).st_mtime
+        self.lock_key = key if kind == 'archive' else kind + '-' + key
+
+# Archives are stored under their hash, archives without a hash under the
+# url, built packages under the binary cache key, and extracted sources
+# under the hash of their archive
+def get_cache_entries(root=None):
+    root = root or util.get_cache_path()
+    if not os.path.isdir(root): return
+    for name in sorted(os.listdir(root)):
+        p = os.path.join(root, name)
+        # Skip the locks and the entries that are still being written
+        if name.startswith('.') or not os.path.isdir(p): continue
+        if name in ['url', 'binary', 'src']:
+            for key in sorted(os.listdir(p)):
+                if key.startswith('tmp-') or not os.path.isdir(os.path.join(p, key)): continue
+                yield CacheEntry(name, key, os.path.join(p, key))
+        else:
+            yield CacheEntry('archive', name, p)
+
+def get_cache_size():
+    return util.parse_size(os.environ.get('CGET_CACHE_SIZE', '10G') or 0)
+
+def get_cache_max_age():
+    days = os.environ.get('CGET_CACHE_MAX_AGE')
+    if days: return float(days) * 24 * 60 * 60
+    return None
+
+def prune_cache(max_size=None, max_age=None, root=None, now=None):
+    now = now or time.time()
+    entries = sorted(get_cache_entries(root), key=lambda e: e.last_used)
+    total = sum(e.size for e in entries)
+    removed = []
+    # Least recently used entries are removed first
+    for e in entries:
+        old = max_age is not None and now - e.last_used > max_age
+        full = bool(max_size) and total > max_size
+        if not old and not full: continue
+        # Entries being downloaded or replaced by another process are kept
+        with util.cache_lock(e.lock_key, blocking=False) as locked:
+            if not locked: continue
+            util.delete_dir(e.path)
+        total -= e.size
+        removed.append(e)
+    return removed
+
+def verify_entry(e):
+    if e.kind == 'archive':
+        files = list(util.ls(e.path, lambda f: os.path.isfile(os.path.join(e.path, f))))
+        if len(files) != 1: return "Expected one archive"
+        if '-' not in e.key: return "Unknown hash"
+        t, h = e.key.split('-', 1)
+        try:
+            if not util.check_hash(os.path.join(e.path, files[0]), t + ':' + h): return "Hash doesn't match"
+        except ValueError:
+            return "Unknown hash"
+    elif e.kind == 'url':
+        try:
+            with open(os.path.join(e.path, 'meta.json')) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return "Missing meta.json"
+        f = os.path.join(e.path, meta.get('file', ''))
+        if not meta.get('file') or not os.path.isfile(f): return "Missing archive"
+        if meta.get('sha256') and util.hash_file(f, 'sha256') != meta['sha256']: return "Hash doesn't match"
+    elif e.kind == 'binary':
+        if not os.path.exists(os.path.join(e.path, 'meta.json')): return "Missing meta.json"
+        archives = [os.path.join(e.path, f) for f in os.listdir(e.path) if f.endswith('.tar.gz')]
+        if not archives or not all(tarfile.is_tarfile(f) for f in archives): return "Missing or corrupted archive of the installed files"
+    elif e.kind == 'src':
+        if not os.listdir(e.path): return "Empty source tree"
+    return None
+
+def verify_cache(root=None):
+    for e in get_cache_entries(root):
+        problem = verify_entry(e)
+        if problem: yield e, problem
+
+def create_binary_cache(enabled=False, url=None, read_only=False):
+    if url: return RemoteBinaryCache(url, read_only=read_only)
+    if enabled: return BinaryCache()
+    return None
@@ -1,10 +1,12 @@
-import click, os, functools, sys
+import click, os, functools, sys, time
 
 from cget import __version__
 from cget import display
 from cget.prefix import CGetPrefix
 from cget.prefix import PackageBuild
 from cget.prefix import find_requirements_file
+import cget.cache as cache
+import cget.lockfile as lockfile
 import cget.util as util
 
 
@@ -109,8 +111,14 @@ def init_command(prefix, toolchain, cc, cxx, cflags, cxxflags, ldflags, std, def
 @click.option('--release', is_flag=True, help="Install release version")
 @click.option('--build-type', help="Install custom version [Release, Debug, RelWithDebInfo or other cmake build type]")
 @click.option('--insecure', is_flag=True, help="Don't use https urls")
+@click.option('-j', '--jobs', type=int, envvar='CGET_JOBS', help="Total number of build jobs shared by all packages built in parallel")
+@click.option('--binary-cache', is_flag=True, envvar='CGET_BINARY_CACHE', help="Reuse packages built before with the same source, toolchain and defines")
+@click.option('--binary-cache-url', envvar='CGET_BINARY_CACHE_URL', help="Share built packages through a remote HTTP cache")
+@click.option('--binary-cache-read-only', is_flag=True, envvar='CGET_BINARY_CACHE_READ_ONLY', help="Don't upload packages to the remote binary cache")
+@click.option('--locked', is_flag=True, help="Install the packages pinned by the lockfile, and fail if it is out of date")
+@click.option('--lock-file', default='cget.lock', help="Lockfile to use with --locked")
 @click.argument('pkgs', nargs=-1, type=click.STRING)
-def install_command(prefix, pkgs, define, file, test, test_all, update, generator, cmake, debug, release, build_type, insecure):
+def install_command(prefix, pkgs, define, file, test, test_all, update, generator, cmake, debug, release, build_type, insecure, jobs, binary_cache, binary_cache_url, binary_cache_read_only, locked, lock_file):
     """ Install packages """
     variant = get_build_type(debug, release, build_type)
     if not file and not pkgs:
@@ -118,11 +126,83 @@ def install_command(prefix, pkgs, define, file, test, test_all, update, generato
         if dev_req is not None: file = dev_req
         else: file = find_requirements_file('.') or 'requirements.cget'
     pbs = [PackageBuild(pkg, cmake=cmake, variant=variant) for pkg in pkgs]
-    for pbu in util.flat([prefix.from_file(file), pbs]):
-        pb = pbu.merge_defines(define)
-        pb.variant = variant
-        with prefix.try_("Failed to build package {}".format(pb.to_name()), on_fail=lambda: prefix.remove(pb)):
-            display.console.print(prefix.install(pb, test=test, test_all=test_all, update=update, generator=generator, insecure=insecure))
+    # Returns the packages deferred until the ones before them are installed
+    def install(pbus, archives=None, locked=None):
+        packages = cache.create_binary_cache(binary_cache, binary_cache_url, binary_cache_read_only)
+        deferred = []
+        # Packages in the binary cache are not fetched
+        if archives is not None: prefix.prefetch(archives, test=test, test_all=test_all, update=update, insecure=insecure, binary_cache=packages)
+        else: pbus, deferred = prefix.resolve(pbus, test=test, test_all=test_all, update=update, insecure=insecure, binary_cache=packages, defer_guessed=True)
+        for msg in prefix.install_all(pbus, test=test, test_all=test_all, update=update, generator=generator, insecure=insecure, jobs=jobs, binary_cache=packages, locked=locked):
+            display.console.print(msg)
+        return deferred
+    if locked:
+        with prefix.try_("Failed to install packages"):
+            lock = lockfile.read(lock_file)
+            lockfile.check_roots(lock, [prefix.parse_pkg_build(pbu.merge_defines(define)) for pbu in util.flat([prefix.from_file(file), pbs])])
+            # Every archive is known, so they are all downloaded up front
+            # without reading their requirements
+            archives = [lockfile.to_pkg_build(lock, fname, variant=variant) for fname in lock['packages']]
+            for pb in archives: pb.ignore_requirements = True
+            install([lockfile.to_pkg_build(lock, fname, variant=variant) for fname in lock['roots']], archives=archives, locked=lock)
+        return
+    with prefix.try_("Failed to install packages"):
+        done = set()
+        while True:
+            pbus = []
+            for i, pbu in enumerate(util.flat([prefix.from_file(file), pbs])):
+                if i in done: continue
+                pb = pbu.merge_defines(define)
+                pb.variant = variant
+                # A package that matched no file or recipe may be in the
+                # recipes of the packages before it, so those are installed
+                # first
+                if pbus and prefix.is_guessed(pb): break
+                pbus.append((i, pb))
+            if not pbus: break
+            recipes = prefix.recipes_snapshot()
+            deferred = [id(pb) for pb in install([pb for _, pb in pbus])]
+            done.update(i for i, pb in pbus if id(pb) not in deferred)
+            # They added recipes, so the rest is parsed again
+            if prefix.recipes_snapshot() != recipes: prefix.forget_parsed()
+
+@cli.command(name='fetch')
+@use_prefix
+@click.option('-f', '--file', default=None, help="Fetch packages listed in the file")
+@click.option('-t', '--test', is_flag=True, help="Also fetch the dependencies needed for testing")
+@click.option('--insecure', is_flag=True, help="Don't use https urls")
+@click.option('-j', '--jobs', type=int, envvar='CGET_FETCH_JOBS', help="Number of concurrent downloads")
+@click.option('--host-connections', type=int, envvar='CGET_HOST_CONNECTIONS', help="Maximum number of concurrent downloads from the same host")
+@click.argument('pkgs', nargs=-1, type=click.STRING)
+def fetch_command(prefix, pkgs, file, test, insecure, jobs, host_connections):
+    """ Download packages and their dependencies into the cache """
+    if not file and not pkgs:
+        file = find_requirements_file('.') or 'requirements.cget'
+    with prefix.try_("Failed to fetch packages"):
+        n = prefix.prefetch(util.flat([prefix.from_file(file), pkgs]), test=test, update=True, insecure=insecure, jobs=jobs, host_connections=host_connections)
+        display.success("Fetched {} packages".format(n))
+
+@cli.command(name='lock')
+@use_prefix
+@click.option('-f', '--file', default=None, help="Lock packages listed in the file")
+@click.option('-t', '--test', is_flag=True, help="Also lock the dependencies needed for testing")
+@click.option('-D', '--define', multiple=True, help="Extra configuration variables to pass to CMake")
+@click.option('--insecure', is_flag=True, help="Don't use https urls")
+@click.option('-j', '--jobs', type=int, envvar='CGET_FETCH_JOBS', help="Number of concurrent downloads")
+@click.option('--host-connections', type=int, envvar='CGET_HOST_CONNECTIONS', help="Maximum number of concurrent downloads from the same host")
+@click.option('-o', '--output', default='cget.lock', help="Lockfile to write")
+@click.argument('pkgs', nargs=-1, type=click.STRING)
+def lock_command(prefix, pkgs, file, test, define, insecure, jobs, host_connections, output):
+    """ Write a lockfile pinning the packages and their dependencies """
+    if not file and not pkgs:
+        dev_req = find_requirements_file('.', 'dev-requirements')
+        if dev_req is not None: file = dev_req
+        else: file = find_requirements_file('.') or 'requirements.cget'
+    with prefix.try_("Failed to lock packages"):
+        pbs = [pb.merge_defines(define) for pb in util.flat([prefix.from_file(file), [PackageBuild(pkg) for pkg in pkgs]])]
+        lock = prefix.lock(pbs, test=test, insecure=insecure, jobs=jobs, host_connections=host_connections)
+        lockfile.write(output, lock)
+        display.success("Locked {} packages in {}".format(len(lock['packages']), output))
 
 @cli.command(name='ignore')
 @use_prefix
@@ -175,9 +255,8 @@ def remove_command(prefix, pkgs, yes, unlink, all):
     for pkg in pkgs_set: display.console.print("  {}".format(display.pkg(pkg)))
     if not yes: yes = display.confirm("Are you sure you want to {} these packages?".format(verb))
     if yes:
-        for pkg in pkgs_set:
-            with prefix.try_("Failed to {} package {}".format(verb, pkg)):
-                prefix.unlink(pkg, delete=not unlink)
+        with prefix.try_("Failed to {} packages".format(verb)):
+            for pkg in prefix.unlink_all(pkgs_set, delete=not unlink):
                 display.success("{} package {}".format(verb, display.pkg(pkg)))
 
 @cli.command(name='list')
@@ -209,6 +288,57 @@ def clean_command(prefix, yes, cache):
         if not yes: yes = display.confirm("Are you sure you want to delete all cget packages in {}?".format(prefix.prefix))
         if yes: prefix.clean()
 
+@cli.group(name='cache', invoke_without_command=True)
+@click.pass_context
+def cache_command(ctx):
+    """ Manage the download and binary cache """
+    if ctx.invoked_subcommand is None: ctx.invoke(cache_stats_command)
+
+@cache_command.command(name='stats')
+def cache_stats_command():
+    """ Show the size and hit rate of the cache """
+    entries = list(cache.get_cache_entries())
+    stats = util.get_cache_stats()
+    lookups = stats.get('hits', 0) + stats.get('misses', 0)
+    limit = cache.get_cache_size()
+    display.console.print("Path: {}".format(util.get_cache_path()))
+    display.console.print("Entries: {}".format(len(entries)))
+    for kind in ['archive', 'url', 'binary', 'src']:
+        xs = [e for e in entries if e.kind == kind]
+        if xs: display.console.print("  {}: {} ({})".format(kind, len(xs), display.size(sum(e.size for e in xs))))
+    display.console.print("Size: {} of {}".format(display.size(sum(e.size for e in entries)), display.size(limit) if limit else "unlimited"))
+    rate = "{:.0%}".format(float(stats.get('hits', 0)) / lookups) if lookups else "n/a"
+    display.console.print("Downloads: {} hits, {} misses, hit rate {}".format(stats.get('hits', 0), stats.get('misses', 0), rate))
+
+@cache_command.command(name='list')
+def cache_list_command():
+    """ List the entries of the cache, least recently used first """
+    entries = sorted(cache.get_cache_entries(), key=lambda e: e.last_used)
+    if entries: display.console.print(display.cache_table(entries, time.time()))
+
+@cache_command.command(name='prune')
+@click.option('--max-size', help="Remove least recently used entries until the cache is smaller than this size, such as 5G [default: CGET_CACHE_SIZE or 10G]")
+@click.option('--max-age', type=float, help="Remove entries not used for this many days [default: CGET_CACHE_MAX_AGE]")
+def cache_prune_command(max_size, max_age):
+    """ Remove old entries from the cache """
+    max_size = util.parse_size(max_size) if max_size else cache.get_cache_size()
+    max_age = max_age * 24 * 60 * 60 if max_age is not None else cache.get_cache_max_age()
+    removed = cache.prune_cache(max_size=max_size, max_age=max_age)
+    display.success("Removed {} entries ({})".format(len(removed), display.size(sum(e.size for e in removed))))
+
+@cache_command.command(name='verify')
+@click.option('--delete', is_flag=True, default=False, help="Delete the entries that are corrupted")
+def cache_verify_command(delete):
+    """ Check the integrity of the cache entries """
+    bad = list(cache.verify_cache())
+    for e, problem in bad:
+        display.warning("{} {}: {}".format(e.kind, e.key, problem))
+        if delete: util.delete_dir(e.path)
+    if not bad: display.success("All cache entries are valid")
+    elif not delete:
+        display.error("{} cache entries are corrupted".format(len(bad)))
+        sys.exit(1)
+
 @cli.command(name='pkg-config', context_settings=dict(
     ignore_unknown_options=True,
 ))
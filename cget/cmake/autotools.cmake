@@ -7,6 +7,17 @@ include(CTest)
 
 include(ProcessorCount)
 ProcessorCount(AUTOTOOLS_JOBS)
+if(DEFINED ENV{CGET_BUILD_JOBS})
+    set(AUTOTOOLS_JOBS $ENV{CGET_BUILD_JOBS})
+endif()
+# Join the jobserver of the outer build instead of starting a new one, when
+# the generator can pass it through to the custom command
+set(AUTOTOOLS_JOBS_FLAGS -j ${AUTOTOOLS_JOBS})
+set(AUTOTOOLS_JOBS_SERVER_AWARE)
+if("$ENV{CGET_JOBSERVER}" STREQUAL "On" AND CMAKE_GENERATOR STREQUAL "Unix Makefiles" AND NOT CMAKE_VERSION VERSION_LESS "3.28")
+    set(AUTOTOOLS_JOBS_FLAGS)
+    set(AUTOTOOLS_JOBS_SERVER_AWARE JOB_SERVER_AWARE ON)
+endif()
 
 find_program(MAKE_EXE make)
 if(NOT MAKE_EXE)
@@ -209,9 +220,10 @@ exec(COMMAND ${AUTOTOOLS_ENV_COMMAND} ${CMAKE_CURRENT_SOURCE_DIR}/configure
     WORKING_DIRECTORY ${BUILD_DIR})
 
 add_custom_target(autotools ALL
-    COMMAND ${MAKE_EXE} -j ${AUTOTOOLS_JOBS}
+    COMMAND ${MAKE_EXE} ${AUTOTOOLS_JOBS_FLAGS}
     COMMENT "${MAKE_EXE} -j ${AUTOTOOLS_JOBS}"
     VERBATIM
+    ${AUTOTOOLS_JOBS_SERVER_AWARE}
     WORKING_DIRECTORY ${BUILD_DIR}
 )
 
@@ -7,6 +7,10 @@ include(CTest)
 
 include(ProcessorCount)
 ProcessorCount(B2_JOBS)
+# b2 can't join a make jobserver, so use the job share cget gave this build
+if(DEFINED ENV{CGET_BUILD_JOBS})
+    set(B2_JOBS $ENV{CGET_BUILD_JOBS})
+endif()
 
 # preamble
 set(PATH_SEP ":")
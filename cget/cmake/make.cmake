@@ -7,6 +7,17 @@ include(CTest)
 
 include(ProcessorCount)
 ProcessorCount(MAKE_JOBS)
+if(DEFINED ENV{CGET_BUILD_JOBS})
+    set(MAKE_JOBS $ENV{CGET_BUILD_JOBS})
+endif()
+# Join the jobserver of the outer build instead of starting a new one, when
+# the generator can pass it through to the custom command
+set(MAKE_JOBS_FLAGS -j ${MAKE_JOBS})
+set(MAKE_JOBS_SERVER_AWARE)
+if("$ENV{CGET_JOBSERVER}" STREQUAL "On" AND CMAKE_GENERATOR STREQUAL "Unix Makefiles" AND NOT CMAKE_VERSION VERSION_LESS "3.28")
+    set(MAKE_JOBS_FLAGS)
+    set(MAKE_JOBS_SERVER_AWARE JOB_SERVER_AWARE ON)
+endif()
 
 find_program(MAKE_EXE make)
 if(NOT MAKE_EXE)
@@ -177,9 +188,10 @@ set(BUILD_DIR ${CMAKE_CURRENT_BINARY_DIR}/build)
 file(MAKE_DIRECTORY ${BUILD_DIR})
 
 add_custom_target(make_build ALL
-    COMMAND ${MAKE_ENV_COMMAND} ${MAKE_EXE} -C ${CMAKE_SOURCE_DIR} -j ${MAKE_JOBS} ${MAKE_VARIABLES}
+    COMMAND ${MAKE_ENV_COMMAND} ${MAKE_EXE} -C ${CMAKE_SOURCE_DIR} ${MAKE_JOBS_FLAGS} ${MAKE_VARIABLES}
     COMMENT "${MAKE_EXE} -j ${MAKE_JOBS}"
     VERBATIM
+    ${MAKE_JOBS_SERVER_AWARE}
     WORKING_DIRECTORY ${BUILD_DIR}
 )
 
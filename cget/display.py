@@ -1,3 +1,5 @@
+import contextlib, threading
+
 from rich.console import Console
 from rich.progress import (
     Progress, BarColumn, DownloadColumn, TransferSpeedColumn,
@@ -47,11 +49,33 @@ def pkg(name):
     return "[package]{}[/]".format(name)
 
 
+# Only one live display can be active at a time, so when packages are
+# prepared in parallel the others run without one
+live_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def live():
+    if not live_lock.acquire(False):
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        live_lock.release()
+
+
+@contextlib.contextmanager
 def status(msg):
-    return console.status("[bold]{}[/]".format(msg), spinner="dots")
+    with live() as active:
+        if not active:
+            yield None
+            return
+        with console.status("[bold]{}[/]".format(msg), spinner="dots") as s:
+            yield s
 
 
-def create_download_progress():
+def create_download_progress(disable=False):
     return Progress(
         SpinnerColumn(),
         TextColumn("[bold blue]{task.description}"),
@@ -61,9 +85,35 @@ def create_download_progress():
         TransferSpeedColumn(),
         TimeRemainingColumn(),
         console=console,
+        disable=disable,
     )
 
 
+shared_progress = None
+
+
+# Concurrent downloads share one progress display, since only one live
+# display can be active at a time
+@contextlib.contextmanager
+def download_progress():
+    if shared_progress is not None:
+        yield shared_progress
+    else:
+        with live() as active, create_download_progress(disable=not active) as progress:
+            yield progress
+
+
+@contextlib.contextmanager
+def concurrent_downloads():
+    global shared_progress
+    with live() as active, create_download_progress(disable=not active) as progress:
+        shared_progress = progress
+        try:
+            yield progress
+        finally:
+            shared_progress = None
+
+
 def confirm(msg):
     return Confirm.ask("[bold]{}[/]".format(msg), default=False, console=console)
 
@@ -74,3 +124,24 @@ def package_table(packages):
     for name in packages:
         table.add_row(name)
     return table
+
+
+def size(n):
+    for unit in ['B', 'K', 'M', 'G']:
+        if n < 1024: break
+        n = n / 1024.0
+    else:
+        unit = 'T'
+    if unit == 'B': return "{}B".format(int(n))
+    return "{:.1f}{}".format(n, unit)
+
+
+def cache_table(entries, now):
+    table = Table(box=None, padding=(0, 2))
+    table.add_column("kind", style="bold cyan")
+    table.add_column("key")
+    table.add_column("size", justify="right")
+    table.add_column("last used", justify="right")
+    for e in entries:
+        table.add_row(e.kind, e.key[:24], size(e.size), "{:.1f}d ago".format((now - e.last_used) / 86400.0))
+    return table
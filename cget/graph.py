@@ -0,0 +1,134 @@
+import collections, threading, contextlib
+
+from concurrent import futures
+
+import cget.util as util
+
+class Node:
+    def __init__(self, key, value=None):
+        self.key = key
+        self.value = value
+        self.deps = []
+
+class Graph:
+    def __init__(self):
+        self.nodes = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.nodes
+
+    def __getitem__(self, key):
+        return self.nodes[key]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes.values())
+
+    def add(self, key, value=None):
+        if key not in self.nodes: self.nodes[key] = Node(key, value)
+        return self.nodes[key]
+
+    def add_edge(self, key, dep):
+        node = self.nodes[key]
+        if dep not in node.deps: node.deps.append(dep)
+
+    # The keys reachable from keys, each after the keys it depends on
+    def topological_order(self, keys=None):
+        order = []
+        done = set()
+        path = []
+        def visit(key):
+            if key in done or key not in self.nodes: return
+            if key in path: raise util.BuildError("Dependency cycle between: {}".format(', '.join(path[path.index(key):])))
+            path.append(key)
+            for dep in self.nodes[key].deps: visit(dep)
+            path.pop()
+            done.add(key)
+            order.append(key)
+        for key in list(self.nodes) if keys is None else keys: visit(key)
+        return order
+
+class JobBudget:
+    def __init__(self, jobs, jobserver=None):
+        self.jobs = max(1, jobs)
+        self.jobserver = jobserver
+        self.active = 0
+        self.used = 0
+        self.lock = threading.Condition()
+
+    # Each build gets an even split of the jobs among the builds running when
+    # it starts, so a lone build on the critical path still uses every core.
+    # The shares come out of the jobs that are left. Without a jobserver
+    # nothing else bounds the compile jobs, so a build waits while they are
+    # all handed out. With one, the builds that join it take their jobs from
+    # it, so the others only get one job when none are left.
+    @contextlib.contextmanager
+    def share(self):
+        with self.lock:
+            self.active += 1
+            while self.jobserver is None and self.used >= self.jobs: self.lock.wait()
+            n = max(1, min(self.jobs // self.active, self.jobs - self.used))
+            self.used += n
+        try:
+            if self.jobserver is None: yield n
+            else:
+                with self.jobserver.slot(): yield n
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.used -= n
+                self.lock.notify_all()
+
+# Runs the nodes of a graph that is discovered while it runs. Each node is
+# prepared in the background, which returns the items it depends on, and it
+# runs once it is prepared and its dependencies have run. So the nodes found
+# later are prepared while the earlier ones run.
+def run_pipeline(graph, items, add, prepare, run, workers=1, prepare_workers=1, limit=None):
+    limit = limit or 2 * max(1, workers)
+    waiting = collections.deque()
+    preparing = {}
+    running = {}
+    prepared = set()
+    started = set()
+    finished = set()
+    error = None
+
+    def visit(item, parent=None):
+        key, new = add(item)
+        if parent is not None: graph.add_edge(parent, key)
+        if new: waiting.append(key)
+
+    for item in items: visit(item)
+    with futures.ThreadPoolExecutor(max_workers=max(1, prepare_workers)) as preparer, \
+         futures.ThreadPoolExecutor(max_workers=max(1, workers)) as runner:
+        while True:
+            if error is None:
+                for key in [k for k in prepared if k not in started and all(d in finished for d in graph[k].deps)]:
+                    started.add(key)
+                    running[runner.submit(run, graph[key])] = key
+                # Prepared nodes hold on to their sources until they run, so
+                # only a few are prepared ahead, unless nothing else can move
+                while waiting and (len(prepared - finished) + len(preparing) < limit or not (running or preparing)):
+                    key = waiting.popleft()
+                    preparing[preparer.submit(prepare, graph[key])] = key
+            if not preparing and not running:
+                if error is not None or len(finished) == len(graph): break
+                raise util.BuildError("Dependency cycle between: {}".format(', '.join(sorted(k for k in prepared if k not in finished))))
+            done, _ = futures.wait(list(preparing) + list(running), return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    preparing.pop(future, None)
+                    running.pop(future, None)
+                    # Stop scheduling, but let the work already running finish
+                    if error is None: error = future.exception()
+                elif future in preparing:
+                    key = preparing.pop(future)
+                    for item in future.result(): visit(item, key)
+                    prepared.add(key)
+                else:
+                    key = running.pop(future)
+                    finished.add(key)
+                    yield graph[key], future.result()
+    if error is not None: raise error
@@ -0,0 +1,100 @@
+import os, re, shutil, tempfile, threading, contextlib
+
+def parse_makeflags(makeflags):
+    jobs = None
+    auth = None
+    for flag in (makeflags or '').split():
+        m = re.match(r'^-j(\d+)$', flag)
+        if m: jobs = int(m.group(1))
+        for opt in ['--jobserver-auth=', '--jobserver-fds=']:
+            if flag.startswith(opt): auth = flag[len(opt):]
+    return jobs, auth
+
+def is_valid_fd(fd):
+    try:
+        os.fstat(fd)
+        return True
+    except OSError:
+        return False
+
+# Each client of a GNU make jobserver owns one implicit job slot and reads a
+# token for every additional job. cget takes a slot for each package it
+# builds, which make or ninja then use as their implicit slot.
+class JobServer:
+    def __init__(self, jobs, read_fd, write_fd, fifo=None, tmp_dir=None):
+        self.jobs = jobs
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.fifo = fifo
+        self.tmp_dir = tmp_dir
+        self.implicit = True
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, jobs):
+        if not hasattr(os, 'mkfifo'): return None
+        tmp_dir = tempfile.mkdtemp(prefix='cget-jobserver-')
+        fifo = os.path.join(tmp_dir, 'fifo')
+        os.mkfifo(fifo, 0o600)
+        # Opening read-write never blocks, and the same descriptor can be
+        # handed to older make versions that only understand "R,W" pipes
+        fd = os.open(fifo, os.O_RDWR)
+        if jobs > 1: os.write(fd, b'+' * (jobs - 1))
+        return cls(jobs, fd, fd, fifo=fifo, tmp_dir=tmp_dir)
+
+    @classmethod
+    def from_environ(cls, environ=None):
+        jobs, auth = parse_makeflags((environ or os.environ).get('MAKEFLAGS'))
+        if not auth or not jobs: return None
+        if auth.startswith('fifo:'):
+            try:
+                fd = os.open(auth[5:], os.O_RDWR)
+            except OSError:
+                return None
+            return cls(jobs, fd, fd, fifo=auth[5:])
+        fds = auth.split(',')
+        if len(fds) != 2 or not all(x.isdigit() for x in fds): return None
+        r, w = int(fds[0]), int(fds[1])
+        # make closes the pipe for recipes not marked as recursive
+        if not is_valid_fd(r) or not is_valid_fd(w): return None
+        return cls(jobs, r, w)
+
+    @classmethod
+    def get(cls, jobs):
+        return cls.from_environ() or cls.create(jobs)
+
+    def acquire(self):
+        with self.lock:
+            if self.implicit:
+                self.implicit = False
+                return None
+        return os.read(self.read_fd, 1)
+
+    def release(self, token):
+        if token is None:
+            with self.lock: self.implicit = True
+        else:
+            os.write(self.write_fd, token)
+
+    @contextlib.contextmanager
+    def slot(self):
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def fds(self):
+        return tuple(set([self.read_fd, self.write_fd]))
+
+    def makeflags(self, fifo=False):
+        if fifo: auth = 'fifo:' + self.fifo
+        else: auth = '{0},{1}'.format(self.read_fd, self.write_fd)
+        return ' -j{0} --jobserver-auth={1}'.format(self.jobs, auth)
+
+    def close(self):
+        # Only close descriptors that we opened ourselves
+        if self.fifo is not None:
+            os.close(self.read_fd)
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
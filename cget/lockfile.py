@@ -0,0 +1,72 @@
+import json
+
+import cget.util as util
+from cget.package import PackageSource, PackageBuild
+
+VERSION = 1
+
+# The lock pins each package of the graph to the url and hash it was
+# resolved to, with its defines and the packages it depends on. Packages
+# are keyed by their fname, like the package directories of the prefix.
+
+def to_entry(pb, h, deps):
+    return {
+        'name': pb.pkg_src.name,
+        'url': pb.pkg_src.url,
+        'hash': h or pb.hash,
+        'define': list(pb.define),
+        'cmake': pb.cmake,
+        'ignore_requirements': bool(pb.ignore_requirements),
+        # A recipe gives its own requirements instead of the archive's
+        'requirements': pb.requirements,
+        'deps': [{'fname': dep.to_fname(), 'test': bool(dep.test), 'build': bool(dep.build)} for dep in deps]
+    }
+
+def create(pbs, packages):
+    return {
+        'version': VERSION,
+        'roots': [pb.to_fname() for pb in pbs],
+        'packages': packages
+    }
+
+def write(path, lock):
+    with open(path, 'w') as f:
+        json.dump(lock, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+def read(path):
+    util.ensure_exists(path)
+    with open(path) as f:
+        lock = json.load(f)
+    if lock.get('version') != VERSION: raise util.BuildError("Unsupported lockfile version: {}".format(path))
+    return lock
+
+def to_pkg_build(lock, fname, variant=None):
+    entry = lock['packages'].get(fname)
+    if entry is None: raise util.BuildError("Package {} is missing from the lockfile".format(fname))
+    pkg_src = PackageSource(name=entry['name'], url=entry['url'], fname=fname)
+    return PackageBuild(pkg_src, define=list(entry['define']), hash=entry['hash'], cmake=entry['cmake'], variant=variant, requirements=entry.get('requirements'), ignore_requirements=entry['ignore_requirements'])
+
+# The locked dependencies of the package, built like PackageBuild.of, except
+# the defines of the parent were already added when the lock was made
+def get_dependents(lock, pb, test=False):
+    for dep in lock['packages'][pb.to_fname()]['deps']:
+        if dep['test'] and not test: continue
+        result = to_pkg_build(lock, dep['fname'], variant=pb.variant)
+        result.parent = pb.to_fname()
+        result.test = dep['test']
+        result.build = dep['build']
+        yield result
+
+# Raise when the packages asked for are no longer the ones that were locked
+def check_roots(lock, pbs):
+    roots = lock['roots']
+    fnames = [pb.to_fname() for pb in pbs]
+    if sorted(fnames) != sorted(roots):
+        locked = [to_pkg_build(lock, fname).to_name() for fname in roots]
+        raise util.BuildError("The lockfile is out of date: it has {} but {} were asked for".format(', '.join(sorted(locked)), ', '.join(sorted(pb.to_name() for pb in pbs))))
+    for pb in pbs:
+        entry = lock['packages'].get(pb.to_fname())
+        if entry is None: raise util.BuildError("Package {} is missing from the lockfile".format(pb.to_name()))
+        if pb.pkg_src.url != entry['url'] or sorted(set(pb.define)) != sorted(set(entry['define'])):
+            raise util.BuildError("The lockfile is out of date for package {}".format(pb.to_name()))
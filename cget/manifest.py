@@ -0,0 +1,90 @@
+import os, sqlite3, contextlib
+
+@contextlib.contextmanager
+def open_db(path):
+    d = os.path.dirname(path)
+    if not os.path.exists(d): os.makedirs(d)
+    # Packages are linked from several threads, each with its own connection
+    db = sqlite3.connect(path, timeout=60)
+    try:
+        with db: yield db
+    finally:
+        db.close()
+
+# Records the files each package put into the prefix, relative to the
+# prefix, so unlinking a package only has to touch those paths
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+
+    @contextlib.contextmanager
+    def connect(self):
+        with open_db(self.path) as db:
+            db.execute('CREATE TABLE IF NOT EXISTS files (package TEXT NOT NULL, path TEXT NOT NULL, PRIMARY KEY (package, path))')
+            yield db
+
+    def add(self, package, paths):
+        with self.connect() as db:
+            db.executemany('INSERT OR IGNORE INTO files VALUES (?, ?)', ((package, p) for p in paths))
+
+    def has(self, package):
+        if not os.path.exists(self.path): return False
+        with self.connect() as db:
+            return db.execute('SELECT 1 FROM files WHERE package = ? LIMIT 1', (package,)).fetchone() is not None
+
+    def get(self, package):
+        if not os.path.exists(self.path): return []
+        with self.connect() as db:
+            return [p for p, in db.execute('SELECT path FROM files WHERE package = ? ORDER BY path', (package,))]
+
+    # Replace a path of the package with the paths below it, when a
+    # directory it linked as a whole is unfolded
+    def replace(self, package, path, paths):
+        if not os.path.exists(self.path): return
+        with self.connect() as db:
+            if db.execute('DELETE FROM files WHERE package = ? AND path = ?', (package, path)).rowcount == 0: return
+            db.executemany('INSERT OR IGNORE INTO files VALUES (?, ?)', ((package, p) for p in paths))
+
+    def remove(self, *packages):
+        if not os.path.exists(self.path): return
+        with self.connect() as db:
+            db.executemany('DELETE FROM files WHERE package = ?', ((p,) for p in packages))
+
+
+# Records the packages that depend on each package, in both directions, so
+# the dependents and dependencies of a package are looked up instead of
+# listing the deps directory of every package. The load function returns
+# the (package, parent) pairs of a prefix from before the index was kept.
+class DependencyIndex:
+    def __init__(self, path, load=None):
+        self.path = path
+        self.load = load
+
+    @contextlib.contextmanager
+    def connect(self):
+        with open_db(self.path) as db:
+            if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'deps'").fetchone() is None:
+                db.execute('CREATE TABLE deps (package TEXT NOT NULL, parent TEXT NOT NULL, PRIMARY KEY (package, parent))')
+                db.execute('CREATE INDEX deps_parent ON deps (parent)')
+                if self.load is not None: db.executemany('INSERT OR IGNORE INTO deps VALUES (?, ?)', self.load())
+            yield db
+
+    def add(self, package, parent):
+        with self.connect() as db:
+            db.execute('INSERT OR IGNORE INTO deps VALUES (?, ?)', (package, parent))
+
+    # The packages that depend on the package
+    def dependents(self, package):
+        with self.connect() as db:
+            return [p for p, in db.execute('SELECT parent FROM deps WHERE package = ? ORDER BY parent', (package,))]
+
+    # The packages the package depends on
+    def dependencies(self, package):
+        with self.connect() as db:
+            return [p for p, in db.execute('SELECT package FROM deps WHERE parent = ? ORDER BY package', (package,))]
+
+    # Forget the dependents of the packages, when they are deleted
+    def remove(self, *packages):
+        if not os.path.exists(self.path): return
+        with self.connect() as db:
+            db.executemany('DELETE FROM deps WHERE package = ?', ((p,) for p in packages))
@@ -1,4 +1,6 @@
-import base64, copy, argparse, six, hashlib
+import base64, copy, shlex, six, hashlib
+
+import cget.util as util
 
 def encode_url(url):
     x = six.b(url[url.find('://')+3:])
@@ -62,15 +64,21 @@ class PackageBuild:
         self.ignore_requirements = ignore_requirements
         self.file = file
 
+    # A copy that can be changed without changing this one
+    def copy(self):
+        result = copy.copy(self)
+        result.define = list(self.define)
+        if isinstance(self.pkg_src, PackageSource): result.pkg_src = copy.copy(self.pkg_src)
+        return result
+
     def merge_defines(self, defines):
         result = copy.copy(self)
-        result.define.extend(defines)
+        result.define = self.define + list(defines)
         return result
 
     def merge(self, other):
         result = copy.copy(self)
-        if result.define: result.define.extend(other.define)
-        else: result.define = other.define
+        result.define = self.define + other.define
         for field in dir(self):
             if not callable(getattr(self, field)) and not field.startswith("__") and not field in ['define', 'pkg_src']:
                 x = getattr(self, field)
@@ -81,7 +89,7 @@ class PackageBuild:
     def of(self, parent):
         result = copy.copy(self)
         result.parent = parent.to_fname()
-        result.define.extend(parent.define)
+        result.define = self.define + parent.define
         result.variant = parent.variant
         return result
 
@@ -93,15 +101,80 @@ class PackageBuild:
         if isinstance(self.pkg_src, PackageSource): return self.pkg_src.to_name()
         else: return self.pkg_src
 
+# The options of a requirement, which take a value, and the flags
+PKG_BUILD_OPTIONS = {
+    '-D': 'define', '--define': 'define',
+    '-H': 'hash', '--hash': 'hash',
+    '-X': 'cmake', '--cmake': 'cmake',
+    '-f': 'file', '--file': 'file'
+}
+PKG_BUILD_FLAGS = {
+    '-t': 'test', '--test': 'test',
+    '-b': 'build', '--build': 'build',
+    '--ignore-requirements': 'ignore_requirements'
+}
+PKG_BUILD_LONG = sorted(x for x in list(PKG_BUILD_OPTIONS) + list(PKG_BUILD_FLAGS) if x.startswith('--'))
+
+# Split a line of a requirements file, like shlex.split with comments, but
+# only lines with quotes or escapes go through shlex
+def split_requirement(line):
+    if '"' in line or "'" in line or '\\' in line: return shlex.split(line, comments=True)
+    return line.split('#', 1)[0].split()
+
+def get_long_option(arg):
+    if arg in PKG_BUILD_OPTIONS or arg in PKG_BUILD_FLAGS: return arg
+    # Long options can be abbreviated, like with argparse
+    matches = [x for x in PKG_BUILD_LONG if x.startswith(arg)]
+    if len(matches) != 1: raise util.BuildError("Unknown option in requirement: " + arg)
+    return matches[0]
+
+def set_pkg_build_option(pb, option, value):
+    field = PKG_BUILD_OPTIONS[option]
+    if field == 'define': pb.define.append(value)
+    else: setattr(pb, field, value)
+
+# Parses the same arguments as an argparse parser with the options above
+# would, without building a parser for every requirement
 def parse_pkg_build_tokens(args):
-    parser = argparse.ArgumentParser()
-    parser.add_argument('pkg_src', nargs='?')
-    parser.add_argument('-D', '--define', action='append', default=[])
-    parser.add_argument('-H', '--hash')
-    parser.add_argument('-X', '--cmake')
-    parser.add_argument('-f', '--file')
-    parser.add_argument('-t', '--test', action='store_true')
-    parser.add_argument('-b', '--build', action='store_true')
-    parser.add_argument('--ignore-requirements', action='store_true')
-    return parser.parse_args(args=args, namespace=PackageBuild())
-
+    pb = PackageBuild()
+    positional = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if arg == '--':
+            positional.extend(args[i:])
+            break
+        elif arg.startswith('--'):
+            name, eq, value = arg.partition('=')
+            option = get_long_option(name)
+            if option in PKG_BUILD_FLAGS:
+                if eq: raise util.BuildError("Option doesn't take a value in requirement: " + arg)
+                setattr(pb, PKG_BUILD_FLAGS[option], True)
+                continue
+            if not eq:
+                if i >= len(args): raise util.BuildError("Missing value for option in requirement: " + arg)
+                value = args[i]
+                i += 1
+            set_pkg_build_option(pb, option, value)
+        elif arg.startswith('-') and len(arg) > 1:
+            # Short flags can be grouped, and the value of a short option can
+            # follow it directly, as in -DFOO=1
+            for j in range(1, len(arg)):
+                option = '-' + arg[j]
+                if option in PKG_BUILD_FLAGS:
+                    setattr(pb, PKG_BUILD_FLAGS[option], True)
+                elif option in PKG_BUILD_OPTIONS:
+                    value = arg[j+1:]
+                    if not value:
+                        if i >= len(args): raise util.BuildError("Missing value for option in requirement: " + arg)
+                        value = args[i]
+                        i += 1
+                    set_pkg_build_option(pb, option, value)
+                    break
+                else: raise util.BuildError("Unknown option in requirement: " + option)
+        else:
+            positional.append(arg)
+    if len(positional) > 1: raise util.BuildError("Too many arguments in requirement: " + ' '.join(positional))
+    pb.pkg_src = positional[0] if positional else None
+    return pb
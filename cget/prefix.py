@@ -1,12 +1,19 @@
-import os, shutil, shlex, six, inspect, contextlib, sys, functools, hashlib
+import os, shutil, six, inspect, contextlib, sys, functools, copy, hashlib, threading, platform, re, tempfile
+
+from concurrent import futures
 
 from cget.builder import Builder
+from cget.graph import Graph, JobBudget, run_pipeline
+from cget.jobserver import JobServer
+from cget.manifest import Manifest, DependencyIndex
+from cget.cache import get_cache_max_age, get_cache_size, prune_cache
 from cget.package import fname_to_pkg
 from cget.package import PackageSource
 from cget.package import PackageBuild
 from cget.package import parse_pkg_build_tokens
+from cget.package import split_requirement
 import cget.util as util
-from cget import display
+from cget import display, lockfile
 from cget.types import returns
 from cget.types import params
 
@@ -101,6 +108,23 @@ def find_cmake(p, start):
 
 PACKAGE_SOURCE_TYPES = (six.string_types, PackageSource, PackageBuild)
 
+class InstallStep:
+    def __init__(self, pb, action='build', test=False):
+        self.pb = pb
+        self.action = action
+        self.test = test
+        self.builder = None
+        self.src_dir = None
+        self.cache_key = None
+        # The keys of the dependencies it is built against, once they ran
+        self.deps_key = None
+        self.parents = []
+        # Set once the parents have been written, so parents found later are
+        # written as they are added
+        self.done = False
+        # Holds the temporary build directory until the step is done
+        self.stack = contextlib.ExitStack()
+
 class CGetPrefix:
     def __init__(self, prefix, verbose=False, build_path=None):
         self.prefix = os.path.abspath(prefix or 'cget')
@@ -108,6 +132,18 @@ class CGetPrefix:
         self.build_path_var = build_path
         self.cmd = util.Commander(paths=[self.get_path('bin')], env=self.get_env(), verbose=self.verbose)
         self.toolchain = self.write_cmake()
+        self.compiler_fingerprint = None
+        self.manifest = Manifest(self.get_private_path('manifest.db'))
+        self.deps = DependencyIndex(self.get_private_path('manifest.db'), load=self.scan_deps)
+        # Folded directories are shared between packages, so they are linked
+        # and unlinked one package at a time
+        self.link_lock = threading.RLock()
+        # Sources and requirements files are parsed once, however many
+        # packages depend on them
+        self.parsed = {}
+        self.parsed_lock = threading.Lock()
+        # The urls guessed for names that matched no file or recipe
+        self.guessed = set()
 
     def log(self, *args):
         if self.verbose: display.verbose(' '.join([str(arg) for arg in args]))
@@ -242,14 +278,45 @@ class CGetPrefix:
     def parse_pkg_src(self, pkg, start=None, no_recipe=False):
         if isinstance(pkg, PackageSource): return pkg
         if isinstance(pkg, PackageBuild): return self.parse_pkg_src(pkg.pkg_src, start)
+        return copy.copy(self.memoize(('src', pkg, start, no_recipe), lambda: self.find_pkg_src(pkg, start, no_recipe)))
+
+    def memoize(self, key, f):
+        with self.parsed_lock:
+            if key in self.parsed: return self.parsed[key]
+        result = f()
+        with self.parsed_lock:
+            return self.parsed.setdefault(key, result)
+
+    def find_pkg_src(self, pkg, start=None, no_recipe=False):
         name, url = parse_alias(pkg)
         self.log('parse_pkg_src:', name, url, pkg)
         if '://' not in url:
-            return self.parse_src_file(name, url, start) or \
-                (None if no_recipe else self.parse_src_recipe(name, url)) or \
-                self.parse_src_github(name, url)
+            src = self.parse_src_file(name, url, start) or (None if no_recipe else self.parse_src_recipe(name, url))
+            if src: return src
+            src = self.parse_src_github(name, url)
+            with self.parsed_lock: self.guessed.add(src.url)
+            return src
         return PackageSource(name=name, url=url)
 
+    # A package that could come from a recipe installed by the packages
+    # listed before it
+    def is_guessed(self, pb):
+        return self.parse_pkg_src(pb).url in self.guessed
+
+    def forget_parsed(self):
+        with self.parsed_lock:
+            self.parsed.clear()
+            self.guessed.clear()
+
+    def recipes_snapshot(self):
+        result = set()
+        for rpath in self.get_recipe_paths():
+            for root, dirs, files in os.walk(rpath, followlinks=True):
+                for f in files:
+                    p = os.path.join(root, f)
+                    if os.path.exists(p): result.add((os.path.relpath(p, rpath), os.path.getmtime(p)))
+        return result
+
     @returns(PackageBuild)
     @params(pkg=PACKAGE_SOURCE_TYPES)
     def parse_pkg_build(self, pkg, start=None, no_recipe=False):
@@ -287,67 +354,458 @@ class CGetPrefix:
         start = os.path.dirname(file)
         if url is not None and url.startswith('file://'):
             start = url[7:]
+        st = os.stat(file)
+        key = ('file', file, url, no_recipe, st.st_mtime, st.st_size)
+        # Each line is parsed when it is reached, since the packages installed
+        # before it can add the recipes it refers to
+        for i, tokens in enumerate(self.memoize(key, lambda: self.parse_file(file))):
+            pb = parse_pkg_build_tokens(tokens)
+            if pb.file: ps = self.from_file(util.actual_path(pb.file, start), no_recipe=no_recipe)
+            else: ps = self.memoize(key + (i,), lambda: [self.parse_pkg_build(pb, start=start, no_recipe=no_recipe)])
+            for p in ps: yield p.copy()
+
+    def parse_file(self, file):
         with open(file) as f:
             self.log("parse file: " + file)
-            for line in f.readlines():
-                tokens = shlex.split(line, comments=True)
-                if len(tokens) > 0: 
-                    pb = parse_pkg_build_tokens(tokens)
-                    ps = self.from_file(util.actual_path(pb.file, start), no_recipe=no_recipe) if pb.file else [self.parse_pkg_build(pb, start=start, no_recipe=no_recipe)]
-                    for p in ps: yield p
+            return [tokens for tokens in (split_requirement(line) for line in f.readlines()) if len(tokens) > 0]
 
     def write_parent(self, pb, track=True):
-        if track and pb.parent is not None: util.mkfile(self.get_deps_directory(pb.to_fname()), pb.parent, pb.parent)
-
-    def install_deps(self, pb, d, test=False, test_all=False, generator=None, insecure=False, ignore_requirements=False):
+        if track and pb.parent is not None:
+            util.mkfile(self.get_deps_directory(pb.to_fname()), pb.parent, pb.parent)
+            self.deps.add(pb.to_fname(), pb.parent)
+
+    # The dependents recorded in the deps directories, for a prefix from
+    # before the dependency index was kept
+    def scan_deps(self):
+        for d in [self.get_package_directory(), self.get_unlink_directory()]:
+            for name in util.ls(d, os.path.isdir):
+                for parent in util.ls(os.path.join(d, name, 'deps'), os.path.isfile):
+                    yield (name, parent)
+
+    def get_dependents(self, pb, d, test=False, test_all=False, ignore_requirements=False):
         req_txt = find_requirements_file(d) if not ignore_requirements else None
         for dependent in self.from_file(pb.requirements or req_txt, pb.pkg_src.url):
-            transient = dependent.test or dependent.build
             testing = test or test_all
             installable = not dependent.test or dependent.test == testing
-            if installable: 
-                self.install(dependent.of(pb), test_all=test_all, generator=generator, track=not transient, insecure=insecure)
+            if installable: yield dependent
 
-    @returns(six.string_types)
-    @params(pb=PACKAGE_SOURCE_TYPES, test=bool, test_all=bool, update=bool, track=bool)
-    def install(self, pb, test=False, test_all=False, generator=None, update=False, track=True, insecure=False):
-        pb = self.parse_pkg_build(pb)
-        pkg_dir = self.get_package_directory(pb.to_fname())
-        unlink_dir = self.get_unlink_directory(pb.to_fname())
+    def install_deps(self, pb, d, test=False, test_all=False, generator=None, insecure=False, ignore_requirements=False):
+        dependents = [dependent.of(pb) for dependent in self.get_dependents(pb, d, test=test, test_all=test_all, ignore_requirements=ignore_requirements)]
+        if not dependents: return
+        dependents, _ = self.resolve(dependents, test_all=test_all, insecure=insecure)
+        for msg in self.install_all(dependents, test_all=test_all, generator=generator, insecure=insecure):
+            display.console.print(msg)
+
+    def build_install(self, pb, builder, src_dir, test=False, test_all=False, generator=None):
         install_dir = self.get_package_directory(pb.to_fname(), 'install')
+        # Setup cmake file
+        if pb.cmake: 
+            target = os.path.join(src_dir, 'CMakeLists.txt')
+            if os.path.exists(target):
+                # The sources can be links to the files of the package, so
+                # the original is copied, and the link removed
+                shutil.copyfile(target, os.path.join(src_dir, builder.cmake_original_file))
+                os.remove(target)
+            shutil.copyfile(pb.cmake, target)
+        # Configure and build
+        builder.configure(src_dir, defines=pb.define, generator=generator, install_prefix=install_dir, test=test, variant=pb.variant)
+        builder.build(variant=pb.variant)
+        # Run tests if enabled
+        if test or test_all: builder.test(variant=pb.variant)
+        # Install
+        builder.build(target='install', variant=pb.variant)
+        self.link_install(install_dir)
+
+    # The package that linked a directory as a whole now links its entries
+    def unfold_link(self, path, target, children):
+        name = os.path.relpath(target, self.get_package_directory()).split(os.sep)[0]
+        if name != '..': self.manifest.replace(name, path, children)
+
+    def link_install(self, install_dir):
+        with self.link_lock:
+            if util.USE_SYMLINKS: files = util.symlink_dir(install_dir, self.prefix, fold=util.FOLD_SYMLINKS, on_unfold=self.unfold_link)
+            else: files = util.copy_dir(install_dir, self.prefix, mode=util.LINK_MODE)
+            self.manifest.add(os.path.basename(os.path.dirname(install_dir)), files)
+
+    def unlink_install(self, install_dir):
+        with self.link_lock:
+            name = os.path.basename(os.path.dirname(install_dir))
+            if self.manifest.has(name):
+                files = self.manifest.get(name)
+                util.rm_prefix_files(self.prefix, files, src=install_dir, mode=util.LINK_MODE)
+                util.rm_empty_parents(self.prefix, files)
+                self.manifest.remove(name)
+            elif os.path.exists(install_dir):
+                # Packages installed before the manifest was kept
+                if util.USE_SYMLINKS: util.rm_symlink_from(install_dir, self.prefix)
+                else: util.rm_dup_dir(install_dir, self.prefix, remove_both=False, mode=util.LINK_MODE)
+                util.rm_empty_dirs(self.prefix)
+
+    def get_compiler_fingerprint(self):
+        if self.compiler_fingerprint is None:
+            with open(self.toolchain) as f:
+                toolchain = f.read()
+            compilers = re.findall(r'set\(CMAKE_(?:C|CXX)_COMPILER "([^"]*)"\)', toolchain)
+            compilers.extend([os.environ.get('CC', 'cc'), os.environ.get('CXX', 'c++')])
+            h = hashlib.sha256(six.b(platform.machine() + sys.platform))
+            for compiler in compilers:
+                exe = util.which(compiler, throws=False) or compiler
+                h.update(util.to_bytes(exe))
+                try:
+                    out, err = util.cmd([exe, '--version'], capture='all')
+                    h.update(out)
+                except:
+                    pass
+            self.compiler_fingerprint = h.hexdigest()
+        return self.compiler_fingerprint
+
+    def get_binary_cache_key(self, pb, archive_hash):
+        # get_hash covers the fname, which is only filled in lazily
+        pb.to_fname()
+        h = hashlib.sha256()
+        # The toolchain names the prefix, which is also embedded in the rpath
+        # of the binaries, so packages are only reused in the same prefix
+        with open(self.toolchain, 'rb') as f:
+            h.update(f.read())
+        if pb.cmake:
+            with open(pb.cmake, 'rb') as f:
+                h.update(f.read())
+        for x in [pb.pkg_src.get_hash(), archive_hash.lower(), self.get_compiler_fingerprint(), pb.variant] + sorted(pb.define):
+            h.update(util.to_bytes(x + '\n'))
+        return h.hexdigest()
+
+    # The cache key of an installed package, with the keys of the packages
+    # it was built against
+    def get_installed_cache_key(self, pb):
+        f = self.get_package_directory(pb.to_fname(), 'binary_cache_key')
+        if not os.path.exists(f): return None
+        with open(f) as k:
+            return k.read().strip()
+
+    # A package can only be reused when every package it is built against
+    # has a cache key, which packages from local directories don't have
+    def get_dependency_cache_key(self, deps):
+        keys = []
+        for dep in deps:
+            key = self.get_installed_cache_key(dep.pb)
+            if key is None: return None
+            keys.append(key)
+        h = hashlib.sha256()
+        for key in sorted(keys): h.update(util.to_bytes(key + '\n'))
+        return h.hexdigest()
+
+    def close_steps(self, graph):
+        for node in graph: node.value.stack.close()
+
+    def run_steps(self, graph, pbs, run, test=False, test_all=False, update=False, insecure=False, binary_cache=None, lock=None, workers=1, prepare_workers=1, limit=None, locked=None):
+        lock = lock or threading.Lock()
+        add = lambda item: self.add_step(graph, *item, lock=lock)
+        prepare = lambda node: self.prepare_step(node.value, test_all=test_all, update=update, insecure=insecure, binary_cache=binary_cache, lock=lock, locked=locked)
+        # The dependencies only needed to test or build a package aren't
+        # recorded as its dependencies
+        items = [(pb, test, not (pb.test or pb.build)) for pb in pbs]
+        return run_pipeline(graph, items, add, prepare, run, workers=workers, prepare_workers=prepare_workers, limit=limit)
+
+    def add_step(self, graph, pb, test=False, track=True, lock=None):
+        pb = self.parse_pkg_build(pb)
+        key = pb.to_fname()
+        if key in graph:
+            step = graph[key].value
+            with lock or threading.Lock():
+                step.parents.append((pb, track))
+                # The package may have been installed before this parent was found
+                if step.done: self.write_parent(pb, track=track)
+            return key, False
+        step = graph.add(key, InstallStep(pb, test=test)).value
+        step.parents.append((pb, track))
+        return key, True
+
+    # The defines a package asks for itself, without the ones a dependency
+    # copies from its parent
+    def own_defines(self, pb, parent=None):
+        inherited = parent.define if parent is not None else []
+        if inherited and pb.define[-len(inherited):] == inherited: return pb.define[:-len(inherited)]
+        return pb.define
+
+    def get_step_dependents(self, step, d, test_all=False, locked=None):
+        pb = step.pb
+        dependents = [dependent.of(pb) for dependent in self.get_dependents(pb, d, test=step.test, test_all=test_all, ignore_requirements=pb.ignore_requirements)]
+        if locked is not None:
+            # The requirements must still be the ones that were locked
+            expected = list(lockfile.get_dependents(locked, pb, test=step.test or test_all))
+            if sorted(set(x.to_fname() for x in dependents)) != sorted(set(x.to_fname() for x in expected)):
+                raise util.BuildError("The lockfile is out of date: the requirements of {} have changed".format(pb.to_name()))
+            dependents = expected
+        return [(dependent, False, not (dependent.test or dependent.build)) for dependent in dependents]
+
+    def prepare_step(self, step, test_all=False, update=False, insecure=False, binary_cache=None, lock=None, locked=None):
+        pb = step.pb
+        key = pb.to_fname()
+        pkg_dir = self.get_package_directory(key)
+        unlink_dir = self.get_unlink_directory(key)
         # If its been unlinked, then link it in
         if os.path.exists(unlink_dir):
-            if update: shutil.rmtree(unlink_dir)
+            if update:
+                with lock:
+                    shutil.rmtree(unlink_dir)
+                    self.deps.remove(key)
             else:
-                self.link(pb)
-                self.write_parent(pb, track=track)
-                return "[green]\u2713[/] Linking package {}".format(display.pkg(pb.to_name()))
-        if os.path.exists(pkg_dir): 
-            self.write_parent(pb, track=track)
-            if update: self.remove(pb)
-            else: return "[yellow]![/] Package {} already installed".format(display.pkg(pb.to_name()))
-        with self.create_builder(pb.pkg_src.get_hash(), tmp=True) as builder:
-            # Fetch package
-            src_dir = builder.fetch(pb.pkg_src.url, pb.hash, (pb.cmake != None), insecure=insecure)
-            # Install any dependencies first
-            self.install_deps(pb, src_dir, test=test, test_all=test_all, generator=generator, insecure=insecure, ignore_requirements=pb.ignore_requirements)
-            # Setup cmake file
-            if pb.cmake: 
-                target = os.path.join(src_dir, 'CMakeLists.txt')
-                if os.path.exists(target):
-                    os.rename(target, os.path.join(src_dir, builder.cmake_original_file))
-                shutil.copyfile(pb.cmake, target)
-            # Configure and build
-            builder.configure(src_dir, defines=pb.define, generator=generator, install_prefix=install_dir, test=test, variant=pb.variant)
-            builder.build(variant=pb.variant)
-            # Run tests if enabled
-            if test or test_all: builder.test(variant=pb.variant)
-            # Install
-            builder.build(target='install', variant=pb.variant)
-            if util.USE_SYMLINKS: util.symlink_dir(install_dir, self.prefix)
-            else: util.copy_dir(install_dir, self.prefix)
-        self.write_parent(pb, track=track)
-        return "[green]\u2713[/] Successfully installed {}".format(display.pkg(pb.to_name()))
+                step.action = 'link'
+                return []
+        if os.path.exists(pkg_dir):
+            if update:
+                with lock: self.remove(pb)
+            else:
+                step.action = 'skip'
+                return []
+        # With a known archive hash a cached build can be used without fetching
+        if binary_cache is not None and pb.hash:
+            step.cache_key = self.get_binary_cache_key(pb, pb.hash)
+            if not update and binary_cache.lookup(step.cache_key):
+                step.action = 'unpack'
+                return self.get_step_dependents(step, binary_cache.get_path(step.cache_key), test_all=test_all, locked=locked)
+        step.builder = step.stack.enter_context(self.create_builder(pb.pkg_src.get_hash(), tmp=True))
+        step.src_dir = step.builder.fetch(pb.pkg_src.url, pb.hash, (pb.cmake != None), insecure=insecure)
+        if binary_cache is not None and step.cache_key is None and step.builder.archive:
+            step.cache_key = self.get_binary_cache_key(pb, 'sha256:' + util.hash_file(step.builder.archive, 'sha256'))
+            if not update and binary_cache.lookup(step.cache_key): step.action = 'unpack'
+        return self.get_step_dependents(step, step.src_dir, test_all=test_all, locked=locked)
+
+    # Returns the sha256 of the archive, when hash_archive is set, and the
+    # dependencies of the package
+    def fetch_archive(self, pb, limiter, test=False, test_all=False, insecure=False, hash_archive=False, binary_cache=None):
+        url = pb.pkg_src.url
+        if insecure: url = url.replace('https', 'http')
+        # A package in the binary cache is installed without its archive, and
+        # its requirements are kept in the cache
+        if binary_cache is not None and pb.hash:
+            key = self.get_binary_cache_key(pb, pb.hash)
+            if binary_cache.lookup(key):
+                if pb.ignore_requirements: return None, []
+                return None, [dependent.of(pb) for dependent in self.get_dependents(pb, binary_cache.get_path(key), test=test, test_all=test_all)]
+        # Local directories are not fetched, but their dependencies are
+        if url.startswith('file://') and os.path.isdir(url[7:]):
+            if pb.ignore_requirements: return None, []
+            return None, [dependent.of(pb) for dependent in self.get_dependents(pb, url[7:], test=test, test_all=test_all)]
+        with self.create_builder('fetch-' + pb.pkg_src.get_hash(), tmp=True) as builder:
+            if url.startswith('file://'): archive = url[7:]
+            else:
+                with limiter.connection(url):
+                    archive = util.retrieve_url(url, builder.top_dir, insecure=insecure, hash=pb.hash)
+            if not os.path.isfile(archive): return None, []
+            h = 'sha256:' + util.hash_file(archive, 'sha256') if hash_archive else None
+            if pb.ignore_requirements: return h, []
+            # The requirements are read from the archive, so it is only
+            # extracted once it is installed
+            d = builder.top_dir
+            if not pb.requirements:
+                name, content = util.read_archive_file(util.get_fast_archive(archive), ['requirements.cget', 'requirements.txt'])
+                if name is None: return h, []
+                d = util.mkdir(os.path.join(builder.top_dir, 'requirements'))
+                with open(os.path.join(d, name), 'wb') as f:
+                    f.write(content)
+            return h, [dependent.of(pb) for dependent in self.get_dependents(pb, d, test=test, test_all=test_all)]
+
+    # Record is called with each package fetched, the hash of its archive
+    # when strict, and its dependencies. With strict, every package is
+    # fetched and any failure is raised. The packages that defer returns true
+    # for are not fetched.
+    def prefetch(self, pbs, test=False, test_all=False, update=False, insecure=False, jobs=None, host_connections=None, record=None, strict=False, binary_cache=None, defer=None):
+        jobs = jobs or int(os.environ.get('CGET_FETCH_JOBS', 8))
+        limiter = util.HostLimiter(host_connections or int(os.environ.get('CGET_HOST_CONNECTIONS', 4)))
+        seen = set()
+        running = {}
+        fetched = 0
+        with futures.ThreadPoolExecutor(max_workers=jobs) as executor, display.concurrent_downloads():
+            def submit(pbs):
+                for pb in pbs:
+                    pb = self.parse_pkg_build(pb)
+                    url = pb.pkg_src.url
+                    if not url or url in seen: continue
+                    if defer is not None and defer(pb): continue
+                    seen.add(url)
+                    # Installed packages are not fetched again, nor their dependencies
+                    installed = [self.get_package_directory(pb.to_fname()), self.get_unlink_directory(pb.to_fname())]
+                    if not strict and not update and any(os.path.exists(d) for d in installed): continue
+                    running[executor.submit(self.fetch_archive, pb, limiter, test=test, test_all=test_all, insecure=insecure, hash_archive=strict, binary_cache=None if update else binary_cache)] = pb
+            # Dependencies are fetched as soon as the requirements of their
+            # parent are known
+            submit(pbs)
+            while running:
+                done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    pb = running.pop(future)
+                    try:
+                        h, deps = future.result()
+                    except Exception as e:
+                        if strict: raise
+                        # The install reports the error if it needs the package
+                        display.warning("Failed to fetch {0}: {1}".format(pb.to_name(), e))
+                        continue
+                    fetched += 1
+                    if record is not None: record(pb, h, deps)
+                    submit(deps)
+        return fetched
+
+    # Fetch the packages and all of their dependencies, and return the lock
+    # that pins their urls, hashes and defines, and the edges between them
+    def lock(self, pbs, test=False, test_all=False, insecure=False, jobs=None, host_connections=None):
+        pbs = [self.parse_pkg_build(pb) for pb in pbs]
+        packages = {}
+        def record(pb, h, deps):
+            packages[pb.to_fname()] = lockfile.to_entry(pb, h, [self.parse_pkg_build(dep) for dep in deps])
+        self.prefetch(pbs, test=test, test_all=test_all, insecure=insecure, jobs=jobs, host_connections=host_connections, record=record, strict=True)
+        return lockfile.create(pbs, packages)
+
+    # Fetches the packages and their dependencies, and returns the packages
+    # to install now, each after the ones it depends on, and the ones
+    # deferred. A dependency cycle, or a package asked for with different
+    # defines, fails before anything is built, since a package is built
+    # once. With defer_guessed, a package that needs a guessed url waits for
+    # the packages before it, which may install the recipe it should come
+    # from, unless nothing else can be installed.
+    def resolve(self, pbs, test=False, test_all=False, update=False, insecure=False, binary_cache=None, defer_guessed=False):
+        graph = Graph()
+        def add(pb):
+            pb = self.parse_pkg_build(pb)
+            key = pb.to_fname()
+            if key in graph:
+                first, other = graph[key].value, pb
+                first_defines = self.own_defines(first, graph[first.parent].value if first.parent in graph else None)
+                other_defines = self.own_defines(other, graph[other.parent].value if other.parent in graph else None)
+                if sorted(set(first_defines)) != sorted(set(other_defines)):
+                    raise util.BuildError("Package {} is asked for with {} and with {}".format(pb.to_name(), ' '.join(first_defines) or 'no defines', ' '.join(other_defines) or 'no defines'))
+            graph.add(key, pb)
+            return key
+        roots = [(pb, add(pb)) for pb in pbs]
+        guessed = {}
+        def record(pb, h, deps):
+            for dep in deps: graph.add_edge(pb.to_fname(), add(dep))
+        def defer(pb):
+            if not defer_guessed or pb.to_fname() in [key for _, key in roots] or not self.is_guessed(pb): return False
+            guessed[pb.to_fname()] = pb
+            return True
+        self.prefetch([pb for pb, _ in roots], test=test, test_all=test_all, update=update, insecure=insecure, record=record, binary_cache=binary_cache, defer=defer)
+        def is_deferred(key, seen):
+            if key in guessed: return True
+            if key in seen or key not in graph: return False
+            seen.add(key)
+            return any(is_deferred(dep, seen) for dep in graph[key].deps)
+        deferred = [key for _, key in roots if is_deferred(key, set())]
+        if len(deferred) == len(roots):
+            self.prefetch(list(guessed.values()), test=test, test_all=test_all, update=update, insecure=insecure, record=record, binary_cache=binary_cache)
+            deferred = []
+        order = graph.topological_order([key for _, key in roots])
+        plan = sorted([(pb, key) for pb, key in roots if key not in deferred], key=lambda x: order.index(x[1]))
+        return [pb for pb, _ in plan], [pb for pb, key in roots if key in deferred]
+
+    def save_binary(self, binary_cache, step):
+        pb = step.pb
+        requirements = None
+        if not pb.ignore_requirements: requirements = pb.requirements or find_requirements_file(step.src_dir)
+        install_dir = self.get_package_directory(pb.to_fname(), 'install')
+        binary_cache.save(step.cache_key, step.deps_key, install_dir, {
+            'name': pb.to_name(),
+            'url': pb.pkg_src.url,
+            'install_dir': install_dir,
+            'prefix': self.prefix
+        }, requirements=requirements)
+
+    def install_step(self, step, deps=(), test_all=False, generator=None, budget=None, lock=None, binary_cache=None, insecure=False):
+        # Remove the sources as soon as the package is installed
+        with step.stack:
+            return self.run_step(step, deps=deps, test_all=test_all, generator=generator, budget=budget, lock=lock, binary_cache=binary_cache, insecure=insecure)
+
+    def run_step(self, step, deps=(), test_all=False, generator=None, budget=None, lock=None, binary_cache=None, insecure=False):
+        pb = step.pb
+        if step.action == 'link':
+            # Relinking can touch the unlinked dependents of other packages
+            with lock: self.link(pb)
+            msg = "[green]\u2713[/] Linking package {}".format(display.pkg(pb.to_name()))
+        elif step.action == 'skip':
+            msg = "[yellow]![/] Package {} already installed".format(display.pkg(pb.to_name()))
+        else:
+            # The dependencies have run, so their keys are known
+            if binary_cache is not None and step.cache_key is not None: step.deps_key = self.get_dependency_cache_key(deps)
+            if step.action == 'unpack' and self.unpack_step(step, binary_cache):
+                msg = "[green]\u2713[/] Successfully installed {} from binary cache".format(display.pkg(pb.to_name()))
+            else:
+                self.build_step(step, test_all=test_all, generator=generator, budget=budget, binary_cache=binary_cache, insecure=insecure)
+                msg = "[green]\u2713[/] Successfully installed {}".format(display.pkg(pb.to_name()))
+            if step.deps_key is not None:
+                with open(self.get_package_directory(pb.to_fname(), 'binary_cache_key'), 'w') as f:
+                    f.write('{0}/{1}'.format(step.cache_key, step.deps_key))
+        with lock:
+            for parent, track in step.parents: self.write_parent(parent, track=track)
+            step.done = True
+        return msg
+
+    # Returns false when the package wasn't built against these dependencies
+    def unpack_step(self, step, binary_cache):
+        pb = step.pb
+        if step.deps_key is None: return False
+        install_dir = self.get_package_directory(pb.to_fname(), 'install')
+        # The package is built instead when the cache fails
+        try:
+            if binary_cache.restore(step.cache_key, step.deps_key, install_dir) is None: return False
+        except Exception as e:
+            display.warning("Failed to restore package {0} from the binary cache: {1}".format(pb.to_name(), e))
+            util.delete_dir(self.get_package_directory(pb.to_fname()))
+            return False
+        try:
+            self.link_install(install_dir)
+        except:
+            display.error("Failed to restore package {}".format(pb.to_name()))
+            self.remove(pb)
+            raise
+        return binary_cache.count(True)
+
+    def build_step(self, step, test_all=False, generator=None, budget=None, binary_cache=None, insecure=False):
+        pb = step.pb
+        step.action = 'build'
+        if binary_cache is not None and step.cache_key is not None: binary_cache.count(False)
+        # A package found in the binary cache before it was fetched
+        if step.builder is None:
+            step.builder = step.stack.enter_context(self.create_builder(pb.pkg_src.get_hash(), tmp=True))
+            step.src_dir = step.builder.fetch(pb.pkg_src.url, pb.hash, (pb.cmake != None), insecure=insecure)
+        with budget.share() as jobs:
+            step.builder.jobs = jobs
+            step.builder.jobserver = budget.jobserver
+            try:
+                self.build_install(pb, step.builder, step.src_dir, test=step.test, test_all=test_all, generator=generator)
+            except:
+                display.error("Failed to build package {}".format(pb.to_name()))
+                self.remove(pb)
+                raise
+        if step.deps_key is not None: self.save_binary(binary_cache, step)
+
+    # With locked, the dependencies are taken from the lock instead of the
+    # requirements files, which must still match it
+    def install_all(self, pbs, test=False, test_all=False, generator=None, update=False, insecure=False, jobs=None, binary_cache=None, locked=None):
+        # Join the jobserver of a parent make, or else start our own
+        jobs = jobs or util.default_jobs()
+        jobserver = JobServer.get(jobs)
+        budget = JobBudget(jobserver.jobs if jobserver else jobs, jobserver)
+        lock = threading.Lock()
+        graph = Graph()
+        with contextlib.ExitStack() as stack:
+            if jobserver is not None: stack.callback(jobserver.close)
+            if binary_cache is not None: stack.callback(binary_cache.finish)
+            stack.callback(self.close_steps, graph)
+            # Packages are fetched and extracted in the background while the
+            # packages found before them are built
+            f = lambda node: self.install_step(node.value, deps=[graph[dep].value for dep in node.deps], test_all=test_all, generator=generator, budget=budget, lock=lock, binary_cache=binary_cache, insecure=insecure)
+            for node, msg in self.run_steps(graph, pbs, f, test=test, test_all=test_all, update=update, insecure=insecure, binary_cache=binary_cache, lock=lock, workers=budget.jobs, prepare_workers=2, locked=locked):
+                yield msg
+            if binary_cache is not None:
+                # Wait for the uploads before reporting them
+                binary_cache.finish()
+                yield "[info]\u25cf[/] {}".format(binary_cache.report())
+            # Sizing the cache walks every entry, so it's skipped when
+            # nothing was added
+            if util.cache_added.is_set():
+                util.cache_added.clear()
+                prune_cache(max_size=get_cache_size(), max_age=get_cache_max_age())
 
     @returns(six.string_types)
     @params(pb=PACKAGE_SOURCE_TYPES)
@@ -412,16 +870,56 @@ class CGetPrefix:
         unlink_dir = self.get_unlink_directory(pkg.to_fname())
         self.log("Unlink:", pkg_dir)
         if os.path.exists(pkg_dir):
-            if util.USE_SYMLINKS:
-                util.rm_symlink_from(os.path.join(pkg_dir, 'install'), self.prefix)
-            else:
-                util.rm_dup_dir(os.path.join(pkg_dir, 'install'), self.prefix, remove_both=False)
-            util.rm_empty_dirs(self.prefix)
-            if delete: util.delete_dir(pkg_dir)
+            self.unlink_install(os.path.join(pkg_dir, 'install'))
+            if delete:
+                util.delete_dir(pkg_dir)
+                self.deps.remove(pkg.to_fname())
             else:
                 util.mkdir(self.get_unlink_directory())
                 os.rename(pkg_dir, unlink_dir)
 
+    # Unlink several packages at once: their files are removed in parallel,
+    # the empty directories are pruned once, and the package directories
+    # are deleted in the background
+    def unlink_all(self, pkgs, delete=False, workers=None):
+        pkgs = [self.parse_pkg_src(pkg) for pkg in pkgs]
+        pkgs = [pkg for pkg in pkgs if os.path.exists(self.get_package_directory(pkg.to_fname()))]
+        names = [pkg.to_fname() for pkg in pkgs]
+        with futures.ThreadPoolExecutor(max_workers=workers or util.cpu_count()) as executor:
+            with self.link_lock:
+                files = []
+                removals = []
+                unrecorded = []
+                for name in names:
+                    install_dir = self.get_package_directory(name, 'install')
+                    if self.manifest.has(name):
+                        paths = self.manifest.get(name)
+                        files.extend(paths)
+                        removals.append(executor.submit(util.rm_prefix_files, self.prefix, paths, src=install_dir, mode=util.LINK_MODE))
+                    elif os.path.exists(install_dir):
+                        unrecorded.append(install_dir)
+                # Packages installed before the manifest was kept
+                if unrecorded:
+                    if util.USE_SYMLINKS: removals.append(executor.submit(util.rm_symlink_from, tuple(unrecorded), self.prefix))
+                    else: removals.extend(executor.submit(util.rm_dup_dir, d, self.prefix, remove_both=False, mode=util.LINK_MODE) for d in unrecorded)
+                for removal in removals: removal.result()
+                self.manifest.remove(*names)
+                util.rm_empty_parents(self.prefix, files)
+                if unrecorded: util.rm_empty_dirs(self.prefix)
+            trash = None
+            if delete:
+                trash = tempfile.mkdtemp(prefix='trash-', dir=self.get_private_path())
+                self.deps.remove(*names)
+            else: util.mkdir(self.get_unlink_directory())
+            for pkg, name in zip(pkgs, names):
+                if delete:
+                    os.rename(self.get_package_directory(name), os.path.join(trash, name))
+                    executor.submit(util.delete_dir, os.path.join(trash, name))
+                else:
+                    os.rename(self.get_package_directory(name), self.get_unlink_directory(name))
+                yield pkg.to_name()
+        if trash is not None: util.delete_dir(trash)
+
     @params(pkg=PACKAGE_SOURCE_TYPES)
     def link(self, pkg):
         pkg = self.parse_pkg_src(pkg)
@@ -430,28 +928,31 @@ class CGetPrefix:
         if os.path.exists(unlink_dir):
             util.mkdir(self.get_package_directory())
             os.rename(unlink_dir, pkg_dir)
-            if util.USE_SYMLINKS: util.symlink_dir(os.path.join(pkg_dir, 'install'), self.prefix)
-            else: util.copy_dir(os.path.join(pkg_dir, 'install'), self.prefix)
+            self.link_install(os.path.join(pkg_dir, 'install'))
         # Relink dependencies
-        for dep in util.ls(self.get_unlink_directory(), os.path.isdir):
-            ls = util.ls(self.get_unlink_deps_directory(dep), os.path.isfile)
-            if pkg.to_fname() in ls: self.link(dep)
+        for dep in self.deps.dependencies(pkg.to_fname()):
+            if os.path.exists(self.get_unlink_directory(dep)): self.link(fname_to_pkg(dep))
 
     def _list_files(self, pkg=None, top=True):
         if pkg is None:
             return util.ls(self.get_package_directory(), os.path.isdir)
         else:
             p = self.parse_pkg_src(pkg)
-            ls = util.ls(self.get_deps_directory(p.to_fname()), os.path.isfile)
+            ls = self.deps.dependents(p.to_fname())
             if top: return [p.to_fname()]+list(ls)
             else: return ls
 
-    def list(self, pkg=None, recursive=False, top=True):
+    # Each package is listed once, even when several of the packages listed
+    # depend on it
+    def list(self, pkg=None, recursive=False, top=True, seen=None):
+        seen = set() if seen is None else seen
         for d in self._list_files(pkg, top):
+            if d in seen: continue
+            seen.add(d)
             p = fname_to_pkg(d)
             if os.path.exists(self.get_package_directory(d)): yield p
             if recursive:
-                for child in self.list(p, recursive=recursive, top=False):
+                for child in self.list(p, recursive=recursive, top=False, seen=seen):
                     yield child
 
     def clean(self):
@@ -460,8 +961,7 @@ class CGetPrefix:
             util.rm_symlink_dir(self.prefix)
             util.rm_empty_dirs(self.prefix)
         else:
-            for p in self.list():
-                self.remove(p)
+            list(self.unlink_all(self.list(), delete=True))
             util.delete_dir(self.get_private_path())
 
     def clean_cache(self):
@@ -1,22 +1,38 @@
-import click, os, sys, shutil, json, six, hashlib, ssl
+import click, os, sys, re, shutil, json, six, hashlib, ssl, multiprocessing, math, time, tempfile, contextlib, threading, errno
 
-if sys.version_info[0] < 3:
+try:
+    import lzma
+except:
     try:
-        import contextlib
-        import lzma
+        from backports import lzma
     except:
-        try:
-            from backports import lzma
-        except:
-            pass
-import tarfile, zipfile
+        lzma = None
+import tarfile, zipfile, gzip, bz2, stat
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from concurrent import futures
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 if os.name == 'posix' and sys.version_info[0] < 3:
     import subprocess32 as subprocess
 else:
     import subprocess
 
-from six.moves.urllib import request, error
+from six.moves import queue
+from six.moves.urllib import request, error, parse
 
 from cget import display
 
@@ -26,7 +42,16 @@ def to_bool(value):
     return True
 
 USE_SYMLINKS=to_bool(os.environ.get('CGET_USE_SYMLINKS', (os.name == 'posix')))
-USE_CMAKE_TAR=to_bool(os.environ.get('CGET_USE_CMAKE_TAR', True))
+# How archives are extracted: cget, cmake, or auto to use the fastest one
+EXTRACT_BACKEND=os.environ.get('CGET_EXTRACT_BACKEND', 'auto')
+# Link whole directories that only one package puts files into
+FOLD_SYMLINKS=to_bool(os.environ.get('CGET_FOLD_SYMLINKS', False))
+# How files are put into the prefix when symlinks are not used
+LINK_MODE=os.environ.get('CGET_LINK_MODE', 'copy')
+# Keep the extracted sources of each archive in the cache
+SOURCE_CACHE=to_bool(os.environ.get('CGET_SOURCE_CACHE', False))
+# Recompress the cached archives to zstd or tar, which extract faster
+RECOMPRESS_CACHE=os.environ.get('CGET_RECOMPRESS_CACHE', '').lower()
 
 __CGET_DIR__ = os.path.dirname(os.path.realpath(__file__))
 
@@ -39,6 +64,10 @@ def is_string(obj):
 def quote(s):
     return json.dumps(s)
 
+def to_bytes(s):
+    if isinstance(s, six.text_type): return s.encode('utf-8')
+    return s
+
 class BuildError(Exception):
     def __init__(self, msg=None, data=None):
         self.msg = msg
@@ -79,7 +108,12 @@ def write_to(file, lines):
             f.writelines(content)
 
 def mkdir(p):
-    if not os.path.exists(p): os.makedirs(p)
+    if not os.path.exists(p):
+        try:
+            os.makedirs(p)
+        except OSError:
+            # Another build may have created it concurrently
+            if not os.path.isdir(p): raise
     return p
 
 def mkfile(d, file, content, always_write=True):
@@ -107,46 +141,299 @@ def adjust_path(p):
         return "\\\\?\\" + p
     return p
 
+# The modification time of an entry records when it was last used, since
+# access times are often not updated by the filesystem
+def touch_cache_entry(*args):
+    try:
+        os.utime(get_cache_path(*args), None)
+    except OSError:
+        pass
+
+def lock_file(f, blocking=True):
+    if fcntl is not None:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError):
+            if blocking: raise
+            return False
+    f.seek(0)
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except (IOError, OSError):
+            if not blocking: return False
+            time.sleep(0.1)
+
+def unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+# Several cget processes can share the cache, so an entry is only written
+# while its lock is held. The lock files are kept apart from the entries,
+# so that removing an entry doesn't remove a lock that is waited on.
+@contextlib.contextmanager
+def cache_lock(key, blocking=True, msg=None):
+    p = get_cache_path('.locks', key + '.lock')
+    mkdir(os.path.dirname(p))
+    with open(p, 'a+') as f:
+        locked = lock_file(f, blocking=False)
+        if not locked and blocking:
+            if msg: display.info(msg)
+            locked = lock_file(f)
+        try:
+            yield locked
+        finally:
+            if locked: unlock_file(f)
+
+def replace_file(f, content):
+    tmp = '{0}.{1}.tmp'.format(f, os.getpid())
+    with open(tmp, 'w') as out:
+        out.write(content)
+    os.replace(tmp, f)
+
+def get_cache_stats():
+    try:
+        with open(get_cache_path('stats.json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {'hits': 0, 'misses': 0}
+
+def count_cache(hit):
+    with cache_lock('stats'):
+        stats = get_cache_stats()
+        stats['hits' if hit else 'misses'] = stats.get('hits' if hit else 'misses', 0) + 1
+        replace_file(get_cache_path('stats.json'), json.dumps(stats))
+    return hit
+
+# Set when this process adds to the cache, since sizing the entries to
+# prune the cache is only worth it then
+cache_added = threading.Event()
+
 def add_cache_file(key, f):
-    mkdir(get_cache_path(key))
-    shutil.copy2(f, get_cache_path(key, os.path.basename(f)))
+    # Move the download into a temporary entry and rename it into place, so
+    # other processes never see a partially written archive
+    tmp = tempfile.mkdtemp(prefix='.tmp-', dir=mkdir(get_cache_path()))
+    try:
+        shutil.move(f, os.path.join(tmp, os.path.basename(f)))
+        try:
+            os.rename(tmp, get_cache_path(key))
+            cache_added.set()
+        except OSError:
+            # Another process published the same entry first
+            if not os.path.exists(get_cache_path(key)): raise
+    finally:
+        delete_dir(tmp)
+    return get_cache_path(key, os.path.basename(f))
 
 def get_cache_file(key):
     p = get_cache_path(key)
-    if os.path.exists(p):
-        return os.path.join(p, next(ls(p)))
-    else:
-        return None
+    f = next(iter(ls(p, os.path.isfile)), None)
+    if f is None: return None
+    touch_cache_entry(key)
+    return os.path.join(p, f)
 
 def delete_dir(path):
     if path is not None and os.path.exists(path): shutil.rmtree(adjust_path(path))
 
-def symlink_dir(src, dst):
-    for root, dirs, files in os.walk(src):
-        all_files = (
-            file
-            for x in [dirs, files]
-            for file in x
-            if os.path.islink(os.path.join(root, file)) or os.path.isfile(os.path.join(root, file))
-        )
-        for file in all_files:
-            path = os.path.relpath(root, src)
-            d = os.path.join(dst, path)
-            mkdir(d)
-            relpath = os.path.relpath(os.path.join(root, file), d)
+# Walks the tree with scandir, so the types cached by each entry are used
+# instead of stat'ing every file again. Returns the files below src, relative
+# to it, with whether they are symlinks to a directory. Symlinked directories
+# are not followed, like os.walk.
+def scan_tree(src):
+    result = []
+    if not os.path.isdir(src): return result
+    stack = ['']
+    while stack:
+        d = stack.pop()
+        with os.scandir(os.path.join(src, d) if d else src) as entries:
+            for entry in entries:
+                path = os.path.join(d, entry.name)
+                if entry.is_symlink(): result.append((path, entry.is_dir()))
+                elif entry.is_dir(): stack.append(path)
+                elif entry.is_file(): result.append((path, False))
+    return result
+
+LINK_CHUNK_SIZE = 256
+
+def link_tree(src, dst, files, f, workers=None):
+    # Each directory is created once, parents before their children
+    for d in sorted(set(os.path.dirname(path) for path in files)):
+        mkdir(os.path.join(dst, d))
+    chunks = [files[i:i+LINK_CHUNK_SIZE] for i in range(0, len(files), LINK_CHUNK_SIZE)]
+    if len(chunks) < 2: workers = 1
+    workers = workers or cpu_count()
+    def run(chunk):
+        for path in chunk: f(path)
+    if workers == 1:
+        for chunk in chunks: run(chunk)
+    else:
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(run, chunks))
+    return files
+
+# Replace the symlink to a directory with a directory of symlinks to its
+# entries, so another package can add files to it. Returns the new links
+# relative to dst.
+def unfold_dir(dst, path):
+    link = os.path.join(dst, path)
+    target = readlink(link)
+    os.remove(link)
+    os.mkdir(link)
+    children = []
+    for name in sorted(os.listdir(target)):
+        os.symlink(os.path.relpath(os.path.join(target, name), link), os.path.join(link, name))
+        children.append(os.path.join(path, name))
+    return target, children
+
+# Returns the paths of src to link into dst. With fold, a directory missing
+# from dst is linked as a whole, except at the top level, and directories
+# that were linked as a whole by another package are unfolded first.
+def plan_links(src, dst, fold=False, on_unfold=None):
+    result = []
+    if not os.path.isdir(src): return result
+    stack = ['']
+    while stack:
+        d = stack.pop()
+        with os.scandir(os.path.join(src, d) if d else src) as entries:
+            for entry in entries:
+                path = os.path.join(d, entry.name)
+                if entry.is_symlink() or not entry.is_dir():
+                    if entry.is_symlink() or entry.is_file(): result.append(path)
+                    continue
+                target = os.path.join(dst, path)
+                if os.path.islink(target) and os.path.isdir(target):
+                    target, children = unfold_dir(dst, path)
+                    if on_unfold is not None: on_unfold(path, target, children)
+                    stack.append(path)
+                elif fold and d and not os.path.lexists(target): result.append(path)
+                else: stack.append(path)
+    return result
+
+# Returns the linked paths relative to dst
+def symlink_dir(src, dst, workers=None, fold=False, on_unfold=None):
+    targets = {}
+    def link(path):
+        d = os.path.dirname(path)
+        if d not in targets: targets[d] = os.path.relpath(os.path.join(src, d), os.path.join(dst, d))
+        try:
+            os.symlink(os.path.join(targets[d], os.path.basename(path)), os.path.join(dst, path))
+        except:
+            raise BuildError("Failed to link: {} -> {}".format(os.path.join(src, path), os.path.join(dst, path)))
+    return link_tree(src, dst, plan_links(src, dst, fold=fold, on_unfold=on_unfold), link, workers=workers)
+
+# Linux ioctl that clones the extents of a file on filesystems with
+# copy-on-write, such as btrfs and xfs
+FICLONE = 0x40049409
+
+def reflink_file(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            if fcntl is None or not sys.platform.startswith('linux'): raise OSError(errno.ENOTSUP, "Reflinks are not supported")
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except (IOError, OSError):
+            if not hasattr(os, 'copy_file_range'): raise
+            # Copies in the kernel, which shares the extents where the
+            # filesystem can
+            size = os.fstat(fsrc.fileno()).st_size
+            offset = 0
+            while offset < size:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - offset)
+                if n == 0: break
+                offset += n
+    shutil.copystat(src, dst)
+
+LINK_METHODS = {
+    'copy': [],
+    'reflink': [reflink_file],
+    'hardlink': [os.link, reflink_file]
+}
+
+# The errors that mean the method doesn't work between these directories
+LINK_UNSUPPORTED = set([errno.EXDEV, errno.EPERM, errno.EACCES, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.EBADF])
+
+def link_file(src, dst, mode='copy', unsupported=None):
+    if mode not in LINK_METHODS: raise BuildError("Unknown link mode: " + mode)
+    for method in LINK_METHODS[mode]:
+        if unsupported is not None and method in unsupported: continue
+        try:
+            method(src, dst)
+            return method
+        except (IOError, OSError) as e:
+            if os.path.lexists(dst) and not os.path.isdir(dst): os.remove(dst)
+            # Other errors, such as too many links, only skip this file
+            if unsupported is not None and e.errno in LINK_UNSUPPORTED: unsupported.add(method)
+    shutil.copy2(src, dst)
+    return shutil.copy2
+
+# A hardlink is the same file, and a reflink or a copy keeps the size and
+# modification time of the file it was made from
+def is_dup_file(src, dst):
+    if os.path.samefile(src, dst): return True
+    s = os.stat(src)
+    d = os.stat(dst)
+    return s.st_size == d.st_size and int(s.st_mtime) == int(d.st_mtime)
+
+# Returns the copied paths relative to dst
+def copy_dir(src, dst, workers=None, mode='copy'):
+    # Once a method fails for the tree, it isn't tried again for each file
+    unsupported = set()
+    def copy(path):
+        link_file(adjust_path(os.path.join(src, path)), os.path.join(dst, path), mode=mode, unsupported=unsupported)
+    return link_tree(src, dst, [path for path, is_dir in scan_tree(src) if not is_dir], copy, workers=workers)
+
+# Link every file of src into dst, so a build can use the tree without
+# copying it. Files are hardlinked, or symlinked where hardlinks can't be
+# made, such as across filesystems, or reflinked or copied with copy. Returns
+# the linked paths relative to dst.
+def shadow_dir(src, dst, workers=None, copy=False):
+    files = []
+    for root, dirs, names in os.walk(src):
+        d = os.path.relpath(root, src)
+        mkdir(os.path.join(dst, d))
+        # Symlinked directories are listed with the directories
+        for name in names + [x for x in dirs if os.path.islink(os.path.join(root, x))]:
+            files.append(os.path.normpath(os.path.join(d, name)))
+    unsupported = set()
+    def link(path):
+        source = os.path.join(src, path)
+        target = os.path.join(dst, path)
+        if os.path.islink(source):
+            f = os.readlink(source)
+            # Relative links that leave the tree would be broken in the shadow
+            outside = os.path.join(os.path.dirname(source), f)
+            if not os.path.isabs(f) and os.path.relpath(outside, src).split(os.sep)[0] == '..': f = os.path.abspath(outside)
+            os.symlink(f, target)
+            return
+        if copy:
+            link_file(source, target, mode='reflink', unsupported=unsupported)
+            return
+        if not unsupported:
             try:
-                os.symlink(relpath, os.path.join(d, file))
-            except:
-                raise BuildError("Failed to link: {} -> {}".format(os.path.join(root, file), os.path.join(d, file)))
+                os.link(source, target)
+                return
+            except OSError as e:
+                if e.errno in LINK_UNSUPPORTED: unsupported.add(os.link)
+        os.symlink(os.path.abspath(source), target)
+    return link_tree(src, dst, files, link, workers=workers)
 
-def copy_dir(src, dst):
-    for root, dirs, files in os.walk(src):
-        for file in files:
-            path = os.path.relpath(root, src)
-            d = os.path.join(dst, path)
-            mkdir(d)
-            src_file = os.path.join(root, file)
-            shutil.copy2(adjust_path(src_file), os.path.join(d, file))
+# Root, and Windows where the permissions aren't changed, can still write
+# to the files through the links to them
+def can_protect_links():
+    return os.name == 'posix' and os.geteuid() != 0
+
+# Remove the write permissions, so a build can't change the files through
+# the links to them
+def make_read_only(d):
+    if os.name != 'posix': return
+    for root, dirs, files in os.walk(d):
+        for name in files:
+            p = os.path.join(root, name)
+            if not os.path.islink(p): os.chmod(p, os.stat(p).st_mode & ~0o222)
 
 def readlink(file):
     f = os.readlink(file)
@@ -170,22 +457,55 @@ def rm_symlink_dir(d):
         for file in files:
             rm_symlink(os.path.join(root, file))
 
+# The d can also be a tuple of directories, so several packages are
+# removed with one walk
 def rm_symlink_from(d, prefix):
     for root, dirs, files in os.walk(prefix):
         if not root.startswith(d):
-            for file in files:
+            # Directories linked as a whole are listed with the directories
+            for file in files + [x for x in dirs if os.path.islink(os.path.join(root, x))]:
                 rm_symlink_in(os.path.join(root, file), d)
 
-def rm_dup_dir(d, prefix, remove_both=True):
+def rm_dup_dir(d, prefix, remove_both=True, mode='copy'):
     for root, dirs, files in os.walk(d):
         for file in files:
             fullpath = os.path.join(root, file)
             relpath = os.path.relpath(fullpath, d)
             if '..' in relpath:
                 raise BuildError('Trying to remove link outside of prefix directory: ' + relpath)
-            os.remove(os.path.join(prefix, relpath))
+            target = os.path.join(prefix, relpath)
+            # Files linked by another package are kept
+            if mode == 'copy' or (os.path.exists(target) and is_dup_file(fullpath, target)): os.remove(target)
             if remove_both: os.remove(fullpath)
 
+# Remove the listed paths of the prefix, where a symlink is only removed if it
+# still points into src, since another package may have replaced it. With
+# hardlinks or reflinks, a file is only removed if it is still a duplicate
+# of the file in src.
+def rm_prefix_files(prefix, paths, src=None, mode='copy'):
+    for path in paths:
+        f = os.path.join(prefix, path)
+        if '..' in os.path.relpath(f, prefix).split(os.sep):
+            raise BuildError('Trying to remove link outside of prefix directory: ' + path)
+        if os.path.islink(f):
+            if src is None or readlink(f).startswith(src): os.remove(f)
+        elif os.path.isfile(f):
+            if mode == 'copy' or src is None or not os.path.exists(os.path.join(src, path)) or is_dup_file(os.path.join(src, path), f): os.remove(f)
+
+# Remove the directories left empty by removing the paths, without going
+# above the prefix
+def rm_empty_parents(prefix, paths):
+    dirs = set()
+    for path in paths:
+        d = os.path.dirname(os.path.normpath(path))
+        while d and d not in dirs:
+            dirs.add(d)
+            d = os.path.dirname(d)
+    # Children sort after their parents, so they are removed first
+    for d in sorted(dirs, reverse=True):
+        p = os.path.join(prefix, d)
+        if os.path.isdir(p) and not os.path.islink(p) and not os.listdir(p): os.rmdir(p)
+
 def rm_empty_dirs(d):
     has_files = False
     for x in os.listdir(d):
@@ -213,10 +533,12 @@ def symlink_to(src, dst_dir):
     os.symlink(src, target)
     return target
 
-def url_retrieve(url, filename, reporthook=None, context=None):
+def url_retrieve(url, filename, reporthook=None, context=None, hasher=None, headers=None, extractor=None):
     # Replacement for the removed urllib FancyURLopener.retrieve (gone in
     # Python 3.14) that still supports a custom SSL context and a reporthook.
+    # The hasher is updated with each block, so the file isn't read again.
     block_size = 1024 * 8
+    if headers: url = request.Request(url, headers=headers)
     response = request.urlopen(url, context=context)
     try:
         total_size = int(response.headers.get("Content-Length", -1))
@@ -227,16 +549,20 @@ def url_retrieve(url, filename, reporthook=None, context=None):
                 block = response.read(block_size)
                 if not block: break
                 out.write(block)
+                if hasher: hasher.update(block)
+                if extractor: extractor.write(block)
                 count += 1
                 if reporthook: reporthook(count, block_size, total_size)
+        if extractor: extractor.close()
+        return response.headers
     finally:
         response.close()
 
-def download_to(url, download_dir, insecure=False):
+def download_to(url, download_dir, insecure=False, hasher=None, headers=None, validators=None, extractor=None):
     name = url.split('/')[-1]
     file = os.path.join(download_dir, name)
     display.info("Downloading [bold]{}[/bold]".format(url))
-    with display.create_download_progress() as progress:
+    with display.download_progress() as progress:
         task = progress.add_task(name, total=None)
         def hook(count, block_size, total_size):
             if total_size > 0:
@@ -246,63 +572,771 @@ def download_to(url, download_dir, insecure=False):
         context = None
         if insecure: context = ssl._create_unverified_context()
         try:
-            url_retrieve(url, file, reporthook=hook, context=context)
+            response_headers = url_retrieve(url, file, reporthook=hook, context=context, hasher=hasher, headers=headers, extractor=extractor)
         except error.HTTPError as e:
+            # The cached copy is still current
+            if e.code == 304 and headers:
+                progress.remove_task(task)
+                return None
             raise BuildError("Download failed with error {0} for: {1}".format(e.code, url))
-        if progress.tasks[0].total is not None:
-            progress.update(task, completed=progress.tasks[0].total)
+        if validators is not None and response_headers is not None:
+            for name in ['ETag', 'Last-Modified']:
+                if response_headers.get(name): validators[name] = response_headers.get(name)
+        total = next(t.total for t in progress.tasks if t.id == task)
+        if total is not None:
+            progress.update(task, completed=total)
     if not os.path.exists(file):
         raise BuildError("Download failed for: {0}".format(url))
     return file
 
+class HostLimiter:
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    # Limit the number of connections to the same server
+    @contextlib.contextmanager
+    def connection(self, url):
+        host = parse.urlparse(url).netloc
+        with self.lock:
+            if host not in self.semaphores: self.semaphores[host] = threading.Semaphore(self.limit)
+            semaphore = self.semaphores[host]
+        with semaphore:
+            yield
+
+def read_archive_file(archive, names):
+    # Read a file from the top directory of an archive without extracting it
+    def match(path):
+        parts = path.strip('/').split('/')
+        return len(parts) == 2 and parts[1] in names
+    fmt = get_archive_format(archive)
+    if fmt == 'zip':
+        with zipfile.ZipFile(archive) as z:
+            for info in z.infolist():
+                if match(info.filename): return info.filename.split('/')[-1], z.read(info)
+    elif fmt is not None and can_decompress(fmt):
+        with open_tar(archive, fmt) as tar:
+            for member in tar:
+                if member.isfile() and match(member.name): return member.name.split('/')[-1], tar.extractfile(member).read()
+    return None, None
+
 def transfer_to(f, dst, copy=False):
     if USE_SYMLINKS and not copy: return symlink_to(f, dst)
+    # A directory is only copied so that some of its files can be replaced,
+    # so it's shadowed with links to its files instead. A build that rewrites
+    # an existing file in place still changes the file of the directory.
+    elif USE_SYMLINKS and os.path.isdir(f):
+        target = os.path.join(dst, os.path.basename(f))
+        shadow_dir(f, target)
+        return target
     else: return copy_to(f, dst)
 
-def retrieve_url(url, dst, copy=False, insecure=False, hash=None):
-    remote = not url.startswith('file://')
-    # Retrieve from cache
-    if remote and hash:
-        f = get_cache_file(hash.replace(':', '-'))
-        if f: return f
-    f = download_to(url, dst, insecure=insecure) if remote else transfer_to(url[7:], dst, copy=copy)
-    if os.path.isfile(f) and hash:
-        with display.status("Computing hash..."):
-            result = check_hash(f, hash)
-        if result:
-            if remote: add_cache_file(hash.replace(':', '-'), f)
-        else:
+# Archives of a tag or a commit on github never change, so they don't need
+# to be revalidated. Branches, such as the default HEAD, do change.
+def is_immutable_url(url):
+    m = re.match(r'^https?://github\.com/[^/]+/[^/]+/(archive|releases/download)/(.+)$', url)
+    if not m: return False
+    if m.group(1) == 'releases/download': return True
+    ref = re.sub(r'\.(tar\.gz|tar\.bz2|tar\.xz|tgz|zip)$', '', m.group(2))
+    if ref.startswith('refs/tags/'): return True
+    return bool(re.match(r'^[0-9a-f]{40}$', ref) or re.match(r'^v?\d+(\.\d+)+([-.+]?\w+)*$', ref))
+
+def get_url_cache_path(url, *args):
+    return get_cache_path('url', hashlib.sha256(to_bytes(url)).hexdigest(), *args)
+
+def get_url_cache(url):
+    try:
+        with open(get_url_cache_path(url, 'meta.json')) as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None, None
+    f = get_url_cache_path(url, meta.get('file', ''))
+    if not meta.get('file') or not os.path.isfile(f): return None, None
+    return f, meta
+
+def get_url_cache_key(url):
+    return 'url-' + os.path.basename(get_url_cache_path(url))
+
+def add_url_cache_file(url, f, validators, sha256=None):
+    # Each file is replaced atomically, since a previous version of the
+    # archive can be in use by another process
+    d = mkdir(get_url_cache_path(url))
+    dst = os.path.join(d, os.path.basename(f))
+    tmp = os.path.join(d, '.{0}.{1}.tmp'.format(os.path.basename(f), os.getpid()))
+    shutil.move(f, tmp)
+    os.replace(tmp, dst)
+    cache_added.set()
+    replace_file(os.path.join(d, 'meta.json'), json.dumps({'url': url, 'file': os.path.basename(f), 'validators': validators, 'sha256': sha256}))
+    return dst
+
+# Urls already revalidated by this process, such as by the prefetch
+validated_urls = set()
+
+def get_recompress_format():
+    if RECOMPRESS_CACHE == 'tar': return 'tar'
+    if not to_bool(RECOMPRESS_CACHE): return None
+    # zstd, or any other value that turns it on, uses zstd when it's there
+    if can_decompress('zst'): return 'zst'
+    return 'tar'
+
+# The hash a cached archive is looked up by, from the directory of its entry
+def get_cached_archive_hash(f):
+    d = os.path.dirname(os.path.abspath(f))
+    if os.path.dirname(d) == os.path.abspath(get_cache_path('url')):
+        with open(os.path.join(d, 'meta.json')) as m:
+            h = json.load(m).get('sha256')
+        return 'sha256:' + h if h else None
+    if os.path.dirname(d) != os.path.abspath(get_cache_path()) or '-' not in os.path.basename(d): return None
+    return os.path.basename(d).replace('-', ':', 1)
+
+def recompress_archive(f, h, fmt, target):
+    d = mkdir(os.path.join(os.path.dirname(f), 'fast'))
+    name = 'archive.tar' + ('.zst' if target == 'zst' else '')
+    tmp = os.path.join(d, '.{0}.{1}.tmp'.format(name, os.getpid()))
+    try:
+        with open(f, 'rb') as src, open(tmp, 'wb') as dst:
+            with ARCHIVE_COMPRESSORS[target](dst) as out:
+                shutil.copyfileobj(ARCHIVE_DECOMPRESSORS[fmt](src), out, ARCHIVE_BUFFER_SIZE)
+        os.replace(tmp, os.path.join(d, name))
+        cache_added.set()
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+    replace_file(os.path.join(d, 'meta.json'), json.dumps({'source': os.path.basename(f), 'hash': h, 'file': name, 'format': target}))
+    return os.path.join(d, name)
+
+# The copy of a cached archive that is faster to extract. It is made once,
+# and kept next to the archive in its cache entry. The original archive is
+# kept as well, since the cache is looked up by its hash.
+def get_fast_archive(f):
+    d = os.path.join(os.path.dirname(f), 'fast')
+    try:
+        with open(os.path.join(d, 'meta.json')) as m:
+            meta = json.load(m)
+        if meta.get('source') == os.path.basename(f) and os.path.isfile(os.path.join(d, meta['file'])): return os.path.join(d, meta['file'])
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    target = get_recompress_format()
+    if target is None or not os.path.isfile(f): return f
+    fmt = get_archive_format(f)
+    # Zips are left, since their members can't be streamed
+    if fmt not in ('gz', 'bz2', 'xz') or not can_decompress(fmt): return f
+    h = get_cached_archive_hash(f)
+    if h is None: return f
+    try:
+        return recompress_archive(f, h, fmt, target)
+    except Exception as e:
+        display.warning("Failed to recompress {0}: {1}".format(f, e))
+        return f
+
+def get_source_cache_key(hash):
+    return hash.lower().replace(':', '-')
+
+# The extracted sources of an archive, stored under its hash. The trees are
+# never changed, so builds link to their files.
+def get_source_tree(hash):
+    key = get_source_cache_key(hash)
+    p = get_cache_path('src', key)
+    if not os.path.isdir(p): return None
+    touch_cache_entry('src', key)
+    return p
+
+def add_source_tree(hash, archive):
+    key = get_source_cache_key(hash)
+    with cache_lock('src-' + key, msg="Waiting for another extraction of {}".format(archive)):
+        p = get_source_tree(hash)
+        if p: return p
+        tmp = tempfile.mkdtemp(prefix='tmp-', dir=mkdir(get_cache_path('src')))
+        try:
+            extract_ar(archive, tmp)
+            make_read_only(tmp)
+            os.rename(tmp, get_cache_path('src', key))
+            cache_added.set()
+        finally:
+            delete_dir(tmp)
+        return get_cache_path('src', key)
+
+def download_cached(url, download_dir, insecure=False, extractor=None):
+    with cache_lock(get_url_cache_key(url), msg="Waiting for another download of {}".format(url)):
+        return download_cached_locked(url, download_dir, insecure=insecure, extractor=extractor)
+
+def download_cached_locked(url, download_dir, insecure=False, extractor=None):
+    cached, meta = get_url_cache(url)
+    if cached: os.utime(os.path.dirname(cached), None)
+    if cached and (is_immutable_url(url) or url in validated_urls): return count_cache(cached)
+    headers = {}
+    if cached:
+        validators = meta.get('validators', {})
+        if 'ETag' in validators: headers['If-None-Match'] = validators['ETag']
+        if 'Last-Modified' in validators: headers['If-Modified-Since'] = validators['Last-Modified']
+        # Without validators the cached copy can't be checked, so download again
+        if not headers: cached = None
+    validators = {}
+    # Record the hash so the cache entry can be verified later
+    hasher = hashlib.sha256()
+    try:
+        f = download_to(url, download_dir, insecure=insecure, hasher=hasher, headers=headers, validators=validators, extractor=extractor)
+    except (BuildError, IOError):
+        if not cached: raise
+        display.warning("Using cached archive, since it could not be revalidated: {}".format(url))
+        return count_cache(cached)
+    validated_urls.add(url)
+    if f is None: return count_cache(cached)
+    count_cache(False)
+    return add_url_cache_file(url, f, validators, sha256=hasher.hexdigest())
+
+def retrieve_url(url, dst, copy=False, insecure=False, hash=None, extractor=None):
+    if url.startswith('file://'):
+        f = transfer_to(url[7:], dst, copy=copy)
+        if os.path.isfile(f) and hash:
+            with display.status("Computing hash..."):
+                if not check_hash(f, hash): raise BuildError("Hash doesn't match for {0}: {1}".format(url, hash))
+        return f
+    if not hash: return download_cached(url, dst, insecure=insecure, extractor=extractor)
+    key = hash.replace(':', '-')
+    # Only one process downloads an archive, the others wait for it to be
+    # added to the cache
+    with cache_lock(key, msg="Waiting for another download of {}".format(url)):
+        f = get_cache_file(key)
+        if f: return count_cache(f)
+        # The archive may have been cached by its url, such as by cget lock
+        cached, meta = get_url_cache(url)
+        if cached and parse_hash(hash) == ('sha256', meta.get('sha256')): return count_cache(cached)
+        count_cache(False)
+        hasher = new_hash(hash)
+        f = download_to(url, dst, insecure=insecure, hasher=hasher, extractor=extractor)
+        if hasher.hexdigest() != parse_hash(hash)[1]:
+            os.remove(f)
             raise BuildError("Hash doesn't match for {0}: {1}".format(url, hash))
-    return f
+        return add_cache_file(key, f)
 
-def extract_ar(archive, dst, *kwargs):
-    if sys.version_info[0] < 3 and archive.endswith('.xz'):
-        with contextlib.closing(lzma.LZMAFile(archive)) as xz:
-            with tarfile.open(fileobj=xz, *kwargs) as f:
-                f.extractall(dst)
-    elif archive.endswith('.zip'):
-        with zipfile.ZipFile(archive,'r') as f:
-            f.extractall(dst)
-    elif tarfile.is_tarfile(archive):
-        if USE_CMAKE_TAR:
-            cmd([which('cmake'), '-E', 'tar', 'xzf', os.path.abspath(archive)], cwd=dst)
+ARCHIVE_BUFFER_SIZE = 1024 * 1024
+
+# The bytes each kind of archive starts with
+ARCHIVE_MAGIC = [
+    (b'PK\x03\x04', 'zip'),
+    (b'PK\x05\x06', 'zip'),
+    (b'\x1f\x8b', 'gz'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zst')
+]
+
+ARCHIVE_DECOMPRESSORS = {
+    'tar': lambda f: f,
+    'gz': lambda f: gzip.GzipFile(fileobj=f),
+    'bz2': lambda f: bz2.BZ2File(f),
+    'xz': lambda f: lzma.LZMAFile(f),
+    'zst': lambda f: zstd.ZstdFile(f) if zstd else zstandard.ZstdDecompressor().stream_reader(f)
+}
+
+ARCHIVE_COMPRESSORS = {
+    'tar': lambda f: f,
+    'zst': lambda f: zstd.ZstdFile(f, 'wb') if zstd else zstandard.ZstdCompressor().stream_writer(f)
+}
+
+def get_header_format(header):
+    for magic, fmt in ARCHIVE_MAGIC:
+        if header.startswith(magic): return fmt
+    if header[257:262] == b'ustar': return 'tar'
+    return None
+
+def get_archive_format(archive):
+    with open(archive, 'rb') as f:
+        fmt = get_header_format(f.read(512))
+    # Old tar archives don't have the ustar magic
+    if fmt is None and tarfile.is_tarfile(archive): return 'tar'
+    return fmt
+
+def can_decompress(fmt):
+    if fmt == 'zst': return zstd is not None or zstandard is not None
+    if fmt == 'xz': return lzma is not None
+    return True
+
+@contextlib.contextmanager
+def open_tar(archive, fmt):
+    with open(archive, 'rb') as f:
+        with tarfile.open(fileobj=ARCHIVE_DECOMPRESSORS[fmt](f), mode='r|') as tar:
+            yield tar
+
+def get_member_path(dst, name):
+    parts = [x for x in name.split('/') if x not in ('', '.')]
+    if name.startswith('/') or '..' in parts: raise BuildError("Archive member is outside of the destination: " + name)
+    return os.path.join(dst, *parts)
+
+class TarStream:
+    def __init__(self, f):
+        self.f = f
+        self.data = b''
+        self.offset = 0
+
+    # Read ahead in large blocks, so the small members don't each need a
+    # call into the decompressor
+    def fill(self, n):
+        size = len(self.data) - self.offset
+        if size >= n: return True
+        chunks = [self.data[self.offset:]]
+        while size < n:
+            chunk = self.f.read(max(n - size, ARCHIVE_BUFFER_SIZE))
+            if not chunk: break
+            chunks.append(chunk)
+            size += len(chunk)
+        self.data = b''.join(chunks)
+        self.offset = 0
+        return size >= n
+
+    def read(self, n):
+        if not self.fill(n): raise BuildError("Unexpected end of archive")
+        start = self.offset
+        self.offset += n
+        return self.data[start:self.offset]
+
+    def skip(self, n):
+        if n > 0: self.read(n)
+
+    def copy_to(self, f, n):
+        while n > 0:
+            if not self.fill(min(n, ARCHIVE_BUFFER_SIZE)): raise BuildError("Unexpected end of archive")
+            size = min(n, len(self.data) - self.offset)
+            f.write(memoryview(self.data)[self.offset:self.offset + size])
+            self.offset += size
+            n -= size
+
+def parse_pax_headers(data):
+    result = {}
+    for record in data.split(b'\n'):
+        if not record: continue
+        key, _, value = record.split(b' ', 1)[1].partition(b'=')
+        result[key.decode('utf-8')] = value.decode('utf-8', 'surrogateescape')
+    return result
+
+# Yield the name, type, mode, mtime, size and link of each member, with the
+# stream at the start of its data, which the caller reads or skips
+def read_tar_members(stream):
+    extended = {}
+    while stream.fill(512):
+        header = stream.read(512)
+        if header.count(b'\0') == 512: break
+        if tarfile.nti(header[148:156]) not in tarfile.calc_chksums(header): raise BuildError("Invalid tar header")
+        t = header[156:157]
+        size = tarfile.nti(header[124:136])
+        # Pax and GNU headers hold the long names of the next member
+        if t in (b'x', b'L', b'K', b'g'):
+            data = stream.read(size)
+            stream.skip(-size % 512)
+            if t == b'x': extended.update(parse_pax_headers(data))
+            elif t == b'L': extended['path'] = tarfile.nts(data, 'utf-8', 'surrogateescape')
+            elif t == b'K': extended['linkpath'] = tarfile.nts(data, 'utf-8', 'surrogateescape')
+            continue
+        name = tarfile.nts(header[0:100], 'utf-8', 'surrogateescape')
+        if header[257:263] == b'ustar\x00':
+            prefix = tarfile.nts(header[345:500], 'utf-8', 'surrogateescape')
+            if prefix: name = prefix + '/' + name
+        name = extended.get('path', name)
+        link = extended.get('linkpath', tarfile.nts(header[157:257], 'utf-8', 'surrogateescape'))
+        mtime = float(extended.get('mtime', tarfile.nti(header[136:148])))
+        size = int(extended.get('size', size))
+        if t in (b'0', b'\0') and name.endswith('/'): t = b'5'
+        extended = {}
+        yield name, t, tarfile.nti(header[100:108]), mtime, size, link
+        stream.skip(-size % 512)
+
+def extract_tar(archive, dst, fmt='tar'):
+    with open(archive, 'rb') as f:
+        extract_tar_from(f, dst, fmt)
+
+# Whether the path, once its symlinks are resolved, is in the directory
+def is_inside(path, d):
+    return (os.path.realpath(path) + os.sep).startswith(os.path.realpath(d) + os.sep)
+
+def extract_tar_from(f, dst, fmt='tar'):
+    dirs = set()
+    written = set()
+    links = []
+    stream = TarStream(ARCHIVE_DECOMPRESSORS[fmt](f))
+    for name, t, mode, mtime, size, link in read_tar_members(stream):
+        path = get_member_path(dst, name)
+        parent = os.path.dirname(path)
+        # A symlink from the archive could point the member outside
+        if links and not is_inside(parent, dst):
+            raise BuildError("Archive member is outside of the destination: " + name)
+        if t == b'5':
+            mkdir(path)
+            dirs.add(path)
+            stream.skip(size)
+            continue
+        if parent not in dirs: dirs.add(mkdir(parent))
+        if path in written: os.remove(path)
+        written.add(path)
+        if t in (b'0', b'\0', b'7'):
+            with open(path, 'wb') as out:
+                stream.copy_to(out, size)
+            if mode & 0o111: os.chmod(path, mode & 0o777)
+            os.utime(path, (mtime, mtime))
+        elif t == b'2':
+            links.append(path)
+            try:
+                os.symlink(link, path)
+            except (OSError, AttributeError):
+                # Copy the target instead when symlinks can't be made
+                target = os.path.join(parent, link)
+                if not is_inside(target, dst): raise BuildError("Archive member is outside of the destination: " + name)
+                if os.path.isfile(target): shutil.copy2(target, path)
+                elif os.path.isdir(target): shutil.copytree(target, path)
+        elif t == b'1':
+            target = get_member_path(dst, link)
+            # The target is linked itself, even when it is a symlink, but
+            # the directories above it could be symlinks from the archive
+            if links and not is_inside(os.path.dirname(target), dst):
+                raise BuildError("Archive member is outside of the destination: " + link)
+            try:
+                os.link(target, path, follow_symlinks=False)
+            except OSError:
+                shutil.copy2(target, path, follow_symlinks=False)
         else:
-            tarfile.open(archive, *kwargs).extractall(dst)
+            # Devices, fifos and sparse files are not needed for sources
+            written.discard(path)
+            stream.skip(size)
+
+def extract_zip_member(z, info, path):
+    mode = info.external_attr >> 16
+    if stat.S_ISLNK(mode):
+        os.symlink(z.read(info).decode('utf-8'), path)
+        return
+    with z.open(info) as src, open(path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, ARCHIVE_BUFFER_SIZE)
+    if mode & 0o111: os.chmod(path, mode & 0o777)
+
+# The members are decompressed in parallel, since zip compresses each one
+# on its own. The directories are created first so the workers don't race.
+def extract_zip(archive, dst, workers=None):
+    with zipfile.ZipFile(archive) as z:
+        files = []
+        for info in z.infolist():
+            path = get_member_path(dst, info.filename.replace('\\', '/'))
+            if info.filename.endswith('/'): mkdir(path)
+            else:
+                mkdir(os.path.dirname(path))
+                files.append((info, path))
+        with futures.ThreadPoolExecutor(max_workers=workers or min(8, cpu_count())) as executor:
+            for future in [executor.submit(extract_zip_member, z, info, path) for info, path in files]: future.result()
+
+def extract_in_process(archive, dst, fmt):
+    if fmt == 'zip': extract_zip(archive, dst)
+    else: extract_tar(archive, dst, fmt)
+
+def extract_with_cmake(archive, dst, fmt):
+    mkdir(dst)
+    cmd([which('cmake'), '-E', 'tar', 'xf', os.path.abspath(archive)], cwd=dst)
+
+EXTRACT_BACKENDS = {
+    'cget': extract_in_process,
+    'cmake': extract_with_cmake
+}
+
+def get_extract_backends(fmt):
+    result = []
+    if can_decompress(fmt): result.append('cget')
+    if which('cmake', throws=False): result.append('cmake')
+    return result
+
+# A sample archive like the sources of a small package
+def write_sample_archive(d, fmt):
+    src = mkdir(os.path.join(d, 'sample'))
+    for i in range(100):
+        lines = ['int f{0}_{1}(int x) {{ return x * {1} + {0}; }}'.format(i, j) for j in range(200)]
+        with open(os.path.join(src, 'f{}.cpp'.format(i)), 'w') as f:
+            f.write('\n'.join(lines))
+    archive = os.path.join(d, 'sample.' + fmt)
+    if fmt == 'zip':
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as z:
+            for name in os.listdir(src): z.write(os.path.join(src, name), 'sample/' + name)
+    elif fmt == 'zst':
+        with open(archive, 'wb') as f:
+            with ARCHIVE_COMPRESSORS['zst'](f) as z:
+                with tarfile.open(fileobj=z, mode='w|') as tar: tar.add(src, arcname='sample')
     else:
+        with tarfile.open(archive, 'w:' + fmt.replace('tar', '')) as tar: tar.add(src, arcname='sample')
+    return archive
+
+def benchmark_extract(fmt, backends):
+    d = tempfile.mkdtemp()
+    try:
+        archive = write_sample_archive(d, fmt)
+        times = {}
+        for backend in backends:
+            dst = mkdir(os.path.join(d, backend))
+            start = time.time()
+            EXTRACT_BACKENDS[backend](archive, dst, fmt)
+            times[backend] = time.time() - start
+        return min(backends, key=lambda backend: times[backend])
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+extract_choices = {}
+extract_choices_lock = threading.Lock()
+
+def get_extract_choices_key():
+    cmake = which('cmake', throws=False)
+    return '{0} {1} {2}'.format(sys.version, cmake, os.path.getmtime(cmake) if cmake else None)
+
+# The fastest backend is found once for each format, and kept in the cache
+# until python or cmake changes
+def choose_extract_backend(fmt, backends):
+    f = get_cache_path('extract.json')
+    key = get_extract_choices_key()
+    with extract_choices_lock:
+        if fmt in extract_choices: return extract_choices[fmt]
+        try:
+            with open(f) as c:
+                saved = json.load(c)
+        except (IOError, OSError, ValueError):
+            saved = {}
+        if saved.get('key') != key: saved = {'key': key, 'formats': {}}
+        backend = saved['formats'].get(fmt)
+        if backend not in backends:
+            backend = benchmark_extract(fmt, backends)
+            saved['formats'][fmt] = backend
+            mkdir(os.path.dirname(f))
+            replace_file(f, json.dumps(saved))
+        extract_choices[fmt] = backend
+        return backend
+
+def get_extract_backend(fmt):
+    backends = get_extract_backends(fmt)
+    if not backends: raise BuildError("Can't extract {} archives without cmake".format(fmt))
+    if EXTRACT_BACKEND in backends: return EXTRACT_BACKEND
+    if len(backends) == 1 or EXTRACT_BACKEND != 'auto': return backends[0]
+    return choose_extract_backend(fmt, backends)
+
+def extract_ar(archive, dst, *kwargs):
+    fmt = get_archive_format(archive)
+    if fmt is None:
         # Treat as a single source file
         d = os.path.join(dst, 'header')
         mkdir(d)
         copy_to(archive, d)
+    else:
+        EXTRACT_BACKENDS[get_extract_backend(fmt)](archive, dst, fmt)
+
+class StreamAborted(Exception):
+    pass
+
+# Extracts a tarball while it is being downloaded. The blocks written by the
+# download are passed to a thread, which extracts them into a temporary
+# directory. The files are only moved into place by finish, once the
+# download is complete and checked, and are removed otherwise.
+class StreamExtractor:
+    def __init__(self, dst, limit=64):
+        self.dst = dst
+        self.tmp = None
+        self.blocks = queue.Queue(limit)
+        self.data = b''
+        self.thread = None
+        self.closed = False
+        self.stopped = False
+        self.error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        delete_dir(self.tmp)
+
+    def write(self, block):
+        if self.stopped: return
+        if self.thread is None:
+            self.tmp = tempfile.mkdtemp(prefix='.extract-', dir=self.dst)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        # The thread stops early when the archive can't be streamed
+        while not self.stopped:
+            try:
+                self.blocks.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        if self.thread is not None and not self.stopped: self.blocks.put(None)
+        self.closed = True
+
+    def stop(self):
+        if self.thread is None: return
+        if not self.closed and not self.stopped:
+            self.stopped = True
+            try:
+                self.blocks.put_nowait(StreamAborted)
+            except queue.Full:
+                pass
+        self.thread.join()
+
+    def read(self, n=-1):
+        while not self.data:
+            block = self.blocks.get()
+            if block is None:
+                self.blocks.put(None)
+                return b''
+            if block is StreamAborted or self.stopped: raise StreamAborted()
+            self.data = block
+        if n < 0: n = len(self.data)
+        result = self.data[:n]
+        self.data = self.data[n:]
+        return result
+
+    def peek(self, n):
+        chunks = [self.data]
+        size = len(self.data)
+        while size < n:
+            self.data = b''
+            block = self.read()
+            if not block: break
+            chunks.append(block)
+            size += len(block)
+        self.data = b''.join(chunks)
+        return self.data[:n]
+
+    def run(self):
+        try:
+            fmt = get_header_format(self.peek(512))
+            if fmt in (None, 'zip') or not can_decompress(fmt): raise StreamAborted()
+            extract_tar_from(self, self.tmp, fmt)
+        except Exception as e:
+            self.error = e
+        finally:
+            # Tar stops reading at its end marker, and whatever follows it
+            # is dropped instead of filling the queue
+            self.stopped = True
+
+    # Returns whether the whole archive was extracted
+    def finish(self):
+        if self.thread is None: return False
+        if not self.closed: self.stop()
+        self.thread.join()
+        if self.error is not None or not self.closed: return False
+        for name in os.listdir(self.tmp):
+            os.rename(os.path.join(self.tmp, name), os.path.join(self.dst, name))
+        return True
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def parse_hash(hash):
+    t, h = hash.lower().split(':')
+    return t, h
+
+def new_hash(hash):
+    return hashlib.new(parse_hash(hash)[0])
 
 def hash_file(f, t):
     h = hashlib.new(t)
-    h.update(open(f, 'rb').read())
+    # Read in blocks so memory stays flat for large archives
+    with open(f, 'rb') as x:
+        for block in iter(lambda: x.read(HASH_BLOCK_SIZE), b''):
+            h.update(block)
     return h.hexdigest()
 
 def check_hash(f, hash):
-    t, h = hash.lower().split(':')
+    t, h = parse_hash(hash)
     return hash_file(f, t) == h
 
+def read_file(f, default=None):
+    try:
+        with open(f) as x:
+            return x.read().strip()
+    except (IOError, OSError):
+        return default
+
+def parse_size(s):
+    s = str(s).strip().upper()
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    if s and s[-1] == 'B': s = s[:-1]
+    if s and s[-1] in units: return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+def get_cgroup_dirs(root='/sys/fs/cgroup', proc='/proc/self/cgroup'):
+    # Limits can be set on any ancestor cgroup, so check all of them
+    seen = set()
+    for line in (read_file(proc) or '').splitlines():
+        p = line.split(':', 2)
+        if len(p) < 3: continue
+        controllers = p[1].split(',')
+        path = p[2].strip('/')
+        bases = [root] if p[0] == '0' else [os.path.join(root, c) for c in controllers + [p[1]]]
+        for base in bases:
+            parts = path.split('/') if path else []
+            for i in range(len(parts), -1, -1):
+                d = os.path.join(base, *parts[:i])
+                if d not in seen and os.path.isdir(d):
+                    seen.add(d)
+                    yield d
+    if root not in seen: yield root
+
+def cgroup_cpu_limit(root='/sys/fs/cgroup', proc='/proc/self/cgroup'):
+    limits = []
+    for d in get_cgroup_dirs(root, proc):
+        # cgroup v2
+        cpu_max = read_file(os.path.join(d, 'cpu.max'))
+        if cpu_max:
+            quota, period = (cpu_max.split() + ['100000'])[:2]
+            if quota != 'max': limits.append(float(quota) / float(period))
+        # cgroup v1
+        for v1 in [d, os.path.join(d, 'cpu'), os.path.join(d, 'cpu,cpuacct')]:
+            quota = read_file(os.path.join(v1, 'cpu.cfs_quota_us'))
+            period = read_file(os.path.join(v1, 'cpu.cfs_period_us'))
+            if quota and period and int(quota) > 0: limits.append(float(quota) / float(period))
+    if limits: return max(1, int(math.ceil(min(limits))))
+    return None
+
+# The page cache that can be reclaimed, which the usage of a cgroup counts
+def cgroup_inactive_file(d, key):
+    for line in (read_file(os.path.join(d, 'memory.stat')) or '').splitlines():
+        name, _, value = line.partition(' ')
+        if name == key and value.strip().isdigit(): return int(value)
+    return 0
+
+def cgroup_memory_limit(root='/sys/fs/cgroup', proc='/proc/self/cgroup'):
+    limits = []
+    for d in get_cgroup_dirs(root, proc):
+        for limit_file, usage_file, inactive in [('memory.max', 'memory.current', 'inactive_file'), ('memory.limit_in_bytes', 'memory.usage_in_bytes', 'total_inactive_file')]:
+            for m in [d, os.path.join(d, 'memory')]:
+                limit = read_file(os.path.join(m, limit_file))
+                if not limit or not limit.isdigit(): continue
+                # v1 reports "no limit" as a huge number
+                if int(limit) >= 2**60: continue
+                # Only the working set is used, like the kubelet does
+                usage = int(read_file(os.path.join(m, usage_file), 0))
+                usage = max(0, usage - cgroup_inactive_file(m, inactive))
+                limits.append(max(0, int(limit) - usage))
+    if limits: return min(limits)
+    return None
+
+def available_memory(meminfo='/proc/meminfo', root='/sys/fs/cgroup', proc='/proc/self/cgroup'):
+    result = None
+    for line in (read_file(meminfo) or '').splitlines():
+        if line.startswith('MemAvailable:'):
+            result = int(line.split()[1]) * 1024
+    limit = cgroup_memory_limit(root, proc)
+    if limit is not None and (result is None or limit < result): result = limit
+    return result
+
+def cpu_count():
+    if hasattr(os, 'sched_getaffinity'): n = len(os.sched_getaffinity(0))
+    else: n = multiprocessing.cpu_count()
+    limit = cgroup_cpu_limit()
+    if limit is not None: n = min(n, limit)
+    return max(1, n)
+
+def default_jobs():
+    jobs = os.environ.get('CGET_JOBS')
+    if jobs: return max(1, int(jobs))
+    n = cpu_count()
+    memory = available_memory()
+    job_memory = parse_size(os.environ.get('CGET_JOB_MEMORY', '1G'))
+    if memory is not None and job_memory > 0: n = min(n, memory // job_memory)
+    return max(1, int(n))
+
 def is_executable(filepath):
     if not os.path.isfile(filepath):
         return False
@@ -1,4 +1,5 @@
 import os
+import tarfile
 import shutil
 from unittest import mock
 
@@ -457,6 +458,84 @@ class TestFetch:
                 mock_extract.assert_called_once()
                 assert result == extracted_dir
 
+    def test_fetch_extracts_while_downloading(self, tmp_path):
+        prefix = MockPrefix(str(tmp_path))
+        top = str(tmp_path / "top")
+        os.makedirs(top)
+        b = Builder(prefix, top)
+        src = tmp_path / "src"
+        src.mkdir()
+        (src / "CMakeLists.txt").write_text("project(x)")
+        archive = str(tmp_path / "pkg.tar.gz")
+        with tarfile.open(archive, "w:gz") as tar:
+            tar.add(str(src), arcname="project-1.0")
+        def fake_retrieve(url, dst, copy=False, insecure=False, hash=None, extractor=None):
+            with open(archive, 'rb') as f:
+                extractor.write(f.read())
+            extractor.close()
+            return archive
+        with mock.patch('cget.util.retrieve_url', side_effect=fake_retrieve):
+            with mock.patch('cget.util.extract_ar') as mock_extract:
+                result = b.fetch("https://example.com/pkg.tar.gz")
+        mock_extract.assert_not_called()
+        assert result == os.path.join(top, "project-1.0")
+        assert os.listdir(top) == ["project-1.0"]
+
+    @pytest.mark.skipif(os.name != 'posix', reason="needs posix links")
+    def test_fetch_from_source_cache(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'SOURCE_CACHE', True)
+        monkeypatch.setattr(util, 'can_protect_links', lambda: True)
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path / "cache"), *args))
+        tree = tmp_path / "cache" / "src" / "sha256-abc" / "project-1.0"
+        tree.mkdir(parents=True)
+        (tree / "CMakeLists.txt").write_text("project(x)")
+        prefix = MockPrefix(str(tmp_path))
+        top = str(tmp_path / "top")
+        os.makedirs(top)
+        b = Builder(prefix, top)
+        with mock.patch('cget.util.retrieve_url') as mock_retrieve:
+            result = b.fetch("https://example.com/pkg.tar.gz", hash="sha256:abc")
+        mock_retrieve.assert_not_called()
+        assert result == os.path.join(top, "project-1.0")
+        assert os.path.samefile(os.path.join(result, "CMakeLists.txt"), str(tree / "CMakeLists.txt"))
+
+    def test_fetch_from_source_cache_as_root(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'SOURCE_CACHE', True)
+        monkeypatch.setattr(util, 'can_protect_links', lambda: False)
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path / "cache"), *args))
+        tree = tmp_path / "cache" / "src" / "sha256-abc" / "project-1.0"
+        tree.mkdir(parents=True)
+        (tree / "CMakeLists.txt").write_text("project(x)")
+        top = str(tmp_path / "top")
+        os.makedirs(top)
+        b = Builder(MockPrefix(str(tmp_path)), top)
+        result = b.fetch("https://example.com/pkg.tar.gz", hash="sha256:abc")
+        # Root could write through a link, so the cached file is copied
+        assert not os.path.samefile(os.path.join(result, "CMakeLists.txt"), str(tree / "CMakeLists.txt"))
+        assert not os.path.islink(os.path.join(result, "CMakeLists.txt"))
+        with open(os.path.join(result, "CMakeLists.txt")) as f: assert f.read() == "project(x)"
+
+    @pytest.mark.skipif(os.name != 'posix', reason="needs posix links")
+    def test_fetch_adds_to_source_cache(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'SOURCE_CACHE', True)
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path / "cache"), *args))
+        src = tmp_path / "src"
+        src.mkdir()
+        (src / "CMakeLists.txt").write_text("project(x)")
+        archive = str(tmp_path / "pkg.tar.gz")
+        with tarfile.open(archive, "w:gz") as tar:
+            tar.add(str(src), arcname="project-1.0")
+        for name in ["top1", "top2"]:
+            top = str(tmp_path / name)
+            os.makedirs(top)
+            b = Builder(MockPrefix(str(tmp_path)), top)
+            with mock.patch('cget.util.extract_ar', wraps=util.extract_ar) as mock_extract:
+                result = b.fetch("file://" + archive)
+            assert os.path.exists(os.path.join(result, "CMakeLists.txt"))
+        # Extracted for the first build only
+        assert mock_extract.call_count == 0
+        assert len(os.listdir(str(tmp_path / "cache" / "src"))) == 1
+
     def test_fetch_with_hash(self, tmp_path):
         prefix = MockPrefix(str(tmp_path))
         top = str(tmp_path / "top")
@@ -688,3 +767,44 @@ class TestPathsAdditional:
         os.makedirs(top)
         b = Builder(prefix, top)
         assert b.get_build_path() == os.path.join(top, "build")
+
+
+# ── jobserver ───────────────────────────────────────────────────────────────
+
+class TestBuildJobServer:
+    def test_make_uses_jobserver(self, tmp_path):
+        prefix = MockPrefix(str(tmp_path))
+        top = str(tmp_path / "top")
+        build_dir = os.path.join(top, "build")
+        os.makedirs(build_dir)
+        with open(os.path.join(build_dir, "Makefile"), "w") as f:
+            f.write("")
+        b = Builder(prefix, top)
+        b.jobserver = mock.MagicMock(fifo=None)
+        b.jobserver.makeflags.return_value = ' -j4 --jobserver-auth=3,4'
+        b.jobserver.fds.return_value = (3, 4)
+
+        with mock.patch.object(b, 'cmake') as mock_cmake:
+            b.build()
+            kwargs = mock_cmake.call_args[1]
+            assert '-j' not in kwargs['args']
+            assert kwargs['env'] == {'MAKEFLAGS': ' -j4 --jobserver-auth=3,4'}
+            assert kwargs['pass_fds'] == (3, 4)
+
+    def test_old_ninja_gets_job_share(self, tmp_path):
+        prefix = MockPrefix(str(tmp_path))
+        top = str(tmp_path / "top")
+        build_dir = os.path.join(top, "build")
+        os.makedirs(build_dir)
+        with open(os.path.join(build_dir, "CMakeCache.txt"), "w") as f:
+            f.write("CMAKE_GENERATOR:INTERNAL=Ninja\n")
+        b = Builder(prefix, top)
+        b.jobs = 3
+        b.jobserver = mock.MagicMock(fifo='/tmp/fifo')
+
+        with mock.patch.object(b, 'get_ninja_version', return_value=(1, 11)):
+            with mock.patch.object(b, 'cmake') as mock_cmake:
+                b.build()
+                args = mock_cmake.call_args[1]['args']
+                assert args[-3:] == ['--', '-j', '3']
+                assert 'env' not in mock_cmake.call_args[1]
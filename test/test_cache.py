@@ -0,0 +1,339 @@
+import hashlib, json, os, shutil, socket, threading
+
+import pytest
+from six.moves import BaseHTTPServer
+
+from cget.cache import BinaryCache, RemoteBinaryCache, create_binary_cache, get_cache_entries, prune_cache, verify_cache
+
+
+def make_install(d, prefix_text):
+    os.makedirs(os.path.join(d, "lib", "pkgconfig"))
+    with open(os.path.join(d, "lib", "pkgconfig", "foo.pc"), "w") as f:
+        f.write("prefix={}\n".format(prefix_text))
+    with open(os.path.join(d, "lib", "libfoo.a"), "wb") as f:
+        f.write(b"\0" + prefix_text.encode())
+
+
+# ── BinaryCache ─────────────────────────────────────────────────────────────
+
+class TestBinaryCache:
+    def test_miss(self, tmp_path):
+        cache = BinaryCache(str(tmp_path / "cache"))
+        assert not cache.has("abc")
+
+    def test_save_and_restore(self, tmp_path):
+        cache = BinaryCache(str(tmp_path / "cache"))
+        old = str(tmp_path / "p1" / "cget" / "pkg" / "foo" / "install")
+        make_install(old, old)
+        req = tmp_path / "requirements.cget"
+        req.write_text("dep/lib\n")
+        cache.save("abc", "d1", old, {'install_dir': old, 'prefix': str(tmp_path / "p1")}, requirements=str(req))
+        assert cache.has("abc")
+        assert cache.has_build("abc", "d1")
+        assert os.path.exists(cache.get_path("abc", "requirements.cget"))
+        # No temporary entries are left behind
+        assert os.listdir(str(tmp_path / "cache")) == ["abc"]
+
+        shutil.rmtree(old)
+        assert cache.restore("abc", "d1", old) is not None
+        with open(os.path.join(old, "lib", "pkgconfig", "foo.pc")) as f:
+            assert f.read() == "prefix={}\n".format(old)
+
+    def test_other_dependencies(self, tmp_path):
+        cache = BinaryCache(str(tmp_path / "cache"))
+        d = str(tmp_path / "install")
+        make_install(d, "/x")
+        cache.save("abc", "d1", d, {'install_dir': d, 'prefix': '/p'})
+        new = str(tmp_path / "new")
+        # A build against other dependencies is a miss
+        assert cache.restore("abc", "d2", new) is None
+        assert not os.path.exists(new)
+        cache.save("abc", "d2", d, {'install_dir': d, 'prefix': '/p'})
+        assert sorted(os.listdir(cache.get_path("abc"))) == ["d1.tar.gz", "d2.tar.gz", "meta.json"]
+        assert cache.restore("abc", "d2", new) is not None
+        assert os.listdir(str(tmp_path / "cache")) == ["abc"]
+
+    def test_restore_checks_members(self, tmp_path):
+        import tarfile
+        import cget.util as util
+        cache = BinaryCache(str(tmp_path / "cache"))
+        d = str(tmp_path / "install")
+        make_install(d, "/x")
+        cache.save("abc", "d1", d, {'install_dir': d, 'prefix': '/p'})
+        evil = tmp_path / "evil.txt"
+        evil.write_text("x")
+        with tarfile.open(cache.get_archive("abc", "d1"), "w:gz") as tar:
+            tar.add(str(evil), arcname="install/../../evil.txt")
+        with pytest.raises(util.BuildError):
+            cache.restore("abc", "d1", str(tmp_path / "p" / "pkg" / "install"))
+        assert not os.path.exists(str(tmp_path / "p" / "evil.txt"))
+
+    def test_save_existing_is_kept(self, tmp_path):
+        cache = BinaryCache(str(tmp_path / "cache"))
+        d = str(tmp_path / "install")
+        make_install(d, "/x")
+        cache.save("abc", "d1", d, {'install_dir': d, 'prefix': '/p', 'n': 1})
+        cache.save("abc", "d1", d, {'install_dir': d, 'prefix': '/p', 'n': 2})
+        assert cache.load_meta("abc")['n'] == 1
+
+    def test_default_path(self, tmp_path, monkeypatch):
+        import cget.util as util
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path), *args))
+        assert BinaryCache().get_path("k") == os.path.join(str(tmp_path), "binary", "k")
+
+
+# ── RemoteBinaryCache ───────────────────────────────────────────────────────
+
+@pytest.fixture
+def server(tmp_path):
+    """A local stand-in for a remote cache that stores files with GET/PUT."""
+    root = str(tmp_path / "remote")
+    os.makedirs(root)
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            p = os.path.join(root, self.path.lstrip('/'))
+            if not os.path.isfile(p):
+                self.send_error(404)
+                return
+            with open(p, 'rb') as f:
+                content = f.read()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_PUT(self):
+            p = os.path.join(root, self.path.lstrip('/'))
+            if not os.path.isdir(os.path.dirname(p)): os.makedirs(os.path.dirname(p))
+            with open(p, 'wb') as f:
+                f.write(self.rfile.read(int(self.headers['Content-Length'])))
+            self.send_response(201)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    yield 'http://127.0.0.1:{}/'.format(httpd.server_port), root
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def save_package(cache, tmp_path):
+    old = str(tmp_path / "p1" / "cget" / "pkg" / "foo" / "install")
+    make_install(old, old)
+    req = tmp_path / "requirements.cget"
+    req.write_text("dep/lib\n")
+    cache.save("abc", "d1", old, {'install_dir': old, 'prefix': str(tmp_path / "p1")}, requirements=str(req))
+
+
+class TestRemoteBinaryCache:
+    def test_upload_and_download(self, tmp_path, server):
+        url, root = server
+        cache = RemoteBinaryCache(url, path=str(tmp_path / "c1"))
+        save_package(cache, tmp_path)
+        cache.finish()
+        assert sorted(os.listdir(os.path.join(root, "abc"))) == ["d1.tar.gz", "meta.json", "requirements.cget"]
+        assert "1 uploaded" in cache.report()
+
+        # A machine with an empty local cache downloads the entry
+        other = RemoteBinaryCache(url, path=str(tmp_path / "c2"))
+        assert other.lookup("abc")
+        with open(other.get_path("abc", "requirements.cget")) as f:
+            assert f.read() == "dep/lib\n"
+        new = str(tmp_path / "p2" / "cget" / "pkg" / "foo" / "install")
+        assert other.restore("abc", "d2", new) is None
+        assert other.restore("abc", "d1", new) is not None
+        other.finish()
+        assert other.has("abc")
+        with open(os.path.join(new, "lib", "pkgconfig", "foo.pc")) as f:
+            assert f.read() == "prefix={}\n".format(tmp_path / "p1" / "cget" / "pkg" / "foo" / "install")
+        # Staging entries are removed
+        assert os.listdir(str(tmp_path / "c2")) == ["abc"]
+
+    def test_miss(self, tmp_path, server):
+        url, root = server
+        cache = RemoteBinaryCache(url, path=str(tmp_path / "c"))
+        assert not cache.lookup("missing")
+        cache.finish()
+        assert os.listdir(str(tmp_path / "c")) == []
+
+    def test_failed_download_is_a_miss(self, tmp_path, server, monkeypatch):
+        url, root = server
+        cache = RemoteBinaryCache(url, path=str(tmp_path / "c1"))
+        save_package(cache, tmp_path)
+        cache.finish()
+        other = RemoteBinaryCache(url, path=str(tmp_path / "c2"))
+        assert other.lookup("abc")
+        def copy(src, dst, size):
+            dst.write(b"partial")
+            raise IOError("connection reset")
+        monkeypatch.setattr(shutil, 'copyfileobj', copy)
+        assert other.restore("abc", "d1", str(tmp_path / "new")) is None
+        other.finish()
+        assert not other.has("abc")
+        assert os.listdir(str(tmp_path / "c2")) == []
+
+    def test_read_only(self, tmp_path, server):
+        url, root = server
+        cache = RemoteBinaryCache(url, read_only=True, path=str(tmp_path / "c"))
+        save_package(cache, tmp_path)
+        cache.finish()
+        assert cache.has("abc")
+        assert os.listdir(root) == []
+        assert cache.report().endswith("(read-only)")
+
+    def test_unreachable(self, tmp_path):
+        cache = RemoteBinaryCache('http://127.0.0.1:1/', path=str(tmp_path / "c"))
+        assert not cache.lookup("abc")
+        save_package(cache, tmp_path)
+        cache.finish()
+        assert "1 failed uploads" in cache.report()
+
+    def test_concurrent_lookups(self, tmp_path, server):
+        url, root = server
+        cache = RemoteBinaryCache(url, path=str(tmp_path / "c1"))
+        save_package(cache, tmp_path)
+        cache.finish()
+        other = RemoteBinaryCache(url, path=str(tmp_path / "c2"))
+        barrier = threading.Barrier(4)
+        get = other.get
+        def wait_get(key, name, dst=None):
+            if name == 'meta.json': barrier.wait(timeout=5)
+            return get(key, name, dst)
+        other.get = wait_get
+        threads = [threading.Thread(target=other.lookup, args=("abc",)) for i in range(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        assert other.lookup("abc")
+        other.finish()
+        # Only one staging entry is kept, and it's removed at the end
+        assert os.listdir(str(tmp_path / "c2")) == []
+
+    def test_timeout(self, tmp_path):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        s.listen(1)
+        try:
+            cache = RemoteBinaryCache('http://127.0.0.1:{}/'.format(s.getsockname()[1]), path=str(tmp_path / "c"), timeout=0.2)
+            assert not cache.lookup("abc")
+            cache.finish()
+        finally:
+            s.close()
+
+    def test_create(self):
+        assert create_binary_cache() is None
+        assert type(create_binary_cache(enabled=True)) is BinaryCache
+        assert isinstance(create_binary_cache(url='http://localhost/'), RemoteBinaryCache)
+
+
+# ── cache management ────────────────────────────────────────────────────────
+
+def add_archive(root, content, last_used):
+    h = hashlib.sha256(content).hexdigest()
+    d = os.path.join(root, "sha256-" + h)
+    os.makedirs(d)
+    with open(os.path.join(d, "pkg.tar.gz"), "wb") as f:
+        f.write(content)
+    os.utime(d, (last_used, last_used))
+    return d
+
+
+class TestCacheEntries:
+    def test_kinds(self, tmp_path):
+        root = str(tmp_path)
+        add_archive(root, b"a", 0)
+        os.makedirs(os.path.join(root, "url", "u1"))
+        os.makedirs(os.path.join(root, "binary", "b1"))
+        os.makedirs(os.path.join(root, "binary", "tmp-123"))
+        os.makedirs(os.path.join(root, "src", "sha256-abc", "proj"))
+        os.makedirs(os.path.join(root, "src", "tmp-456"))
+        (tmp_path / "stats.json").write_text("{}")
+        entries = list(get_cache_entries(root))
+        assert sorted(e.kind for e in entries) == ["archive", "binary", "src", "url"]
+        assert [e.lock_key for e in entries if e.kind == "src"] == ["src-sha256-abc"]
+        assert [e.size for e in entries if e.kind == "archive"] == [1]
+
+    def test_missing_root(self, tmp_path):
+        assert list(get_cache_entries(str(tmp_path / "none"))) == []
+
+
+class TestPruneCache:
+    @pytest.fixture(autouse=True)
+    def locks(self, tmp_path, monkeypatch):
+        import cget.util as util
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path), *args))
+
+    def test_least_recently_used_first(self, tmp_path):
+        root = str(tmp_path)
+        old = add_archive(root, b"x" * 100, 1000)
+        new = add_archive(root, b"y" * 100, 2000)
+        removed = prune_cache(max_size=150, root=root, now=3000)
+        assert [e.path for e in removed] == [old]
+        assert os.path.exists(new)
+
+    def test_max_age(self, tmp_path):
+        root = str(tmp_path)
+        old = add_archive(root, b"x", 1000)
+        new = add_archive(root, b"y", 2000)
+        prune_cache(max_age=1500, root=root, now=3000)
+        assert not os.path.exists(old)
+        assert os.path.exists(new)
+
+    def test_locked_entry_is_kept(self, tmp_path):
+        import cget.util as util
+        root = str(tmp_path)
+        d = add_archive(root, b"x", 1000)
+        with util.cache_lock(os.path.basename(d)):
+            assert prune_cache(max_age=0, root=root, now=3000) == []
+        assert os.path.exists(d)
+        # The locks are not cache entries
+        assert len(prune_cache(max_age=0, root=root, now=3000)) == 1
+        assert os.path.exists(os.path.join(root, ".locks"))
+
+    def test_unlimited(self, tmp_path):
+        root = str(tmp_path)
+        add_archive(root, b"x" * 100, 1000)
+        assert prune_cache(max_size=0, root=root) == []
+
+
+class TestVerifyCache:
+    def test_valid(self, tmp_path):
+        root = str(tmp_path / "cache")
+        add_archive(root, b"x", 0)
+        cache = BinaryCache(os.path.join(root, "binary"))
+        d = str(tmp_path / "install")
+        make_install(d, "/x")
+        cache.save("abc", "d1", d, {'install_dir': d, 'prefix': '/p'})
+        assert list(verify_cache(root)) == []
+        with open(cache.get_archive("abc", "d1"), "wb") as f:
+            f.write(b"x")
+        assert [problem for e, problem in verify_cache(root)] == ["Missing or corrupted archive of the installed files"]
+
+    def test_corrupted_archive(self, tmp_path):
+        root = str(tmp_path)
+        d = add_archive(root, b"x", 0)
+        with open(os.path.join(d, "pkg.tar.gz"), "wb") as f:
+            f.write(b"y")
+        assert [problem for e, problem in verify_cache(root)] == ["Hash doesn't match"]
+
+    def test_url_entry(self, tmp_path):
+        d = tmp_path / "url" / "u1"
+        d.mkdir(parents=True)
+        (d / "pkg.tar.gz").write_bytes(b"x")
+        (d / "meta.json").write_text(json.dumps({'file': 'pkg.tar.gz', 'sha256': hashlib.sha256(b"z").hexdigest()}))
+        assert [problem for e, problem in verify_cache(str(tmp_path))] == ["Hash doesn't match"]
+        (d / "pkg.tar.gz").unlink()
+        assert [problem for e, problem in verify_cache(str(tmp_path))] == ["Missing archive"]
+
+    def test_src_entry(self, tmp_path):
+        (tmp_path / "src" / "sha256-abc").mkdir(parents=True)
+        assert [problem for e, problem in verify_cache(str(tmp_path))] == ["Empty source tree"]
+
+    def test_binary_entry(self, tmp_path):
+        (tmp_path / "binary" / "b1").mkdir(parents=True)
+        assert [problem for e, problem in verify_cache(str(tmp_path))] == ["Missing meta.json"]
@@ -230,6 +230,16 @@ def test_recipe_simple_x(d):
     recipes=get_exists_path('basicrecipes') + ' -DCGET_TEST_DIR="' + __test_dir__ + '"'
     d.cmds(install_cmds(url='simpleheader', recipes=recipes))
 
+@appveyor_skip
+def test_recipe_locked(d):
+    recipes=get_exists_path('basicrecipes') + ' -DCGET_TEST_DIR="' + __test_dir__ + '"'
+    d.cmds([
+        cget_cmd('install', recipes),
+        cget_cmd('lock', 'basicappnoreq'),
+        cget_cmd('install', '--locked', 'basicappnoreq'),
+        cget_cmd('size', '3')
+    ])
+
 @appveyor_skip
 def test_symlink_in_prefix(d):
     p = d.get_path('usr')
@@ -657,6 +667,18 @@ def test_reqs_recipe(d):
     reqs_file = d.write_to('reqs', [recipes, 'simple'])
     d.cmds(install_cmds(url='--file {}'.format(reqs_file), lib='simple', alias='simple', base_size=1))
 
+@appveyor_skip
+def test_reqs_recipe_dependency(d):
+    recipes=shlex_quote(get_exists_path('basicrecipes')) + ' -DCGET_TEST_DIR="' + __test_dir__ + '"'
+    app = d.get_path('app')
+    shutil.copytree(get_exists_path('basicappnoreq'), app)
+    d.write_to(os.path.join('app', 'requirements.cget'), ['simple'])
+    reqs_file = d.write_to('reqs', [recipes, shlex_quote(app)])
+    d.cmds([
+        cget_cmd('install', '--verbose', '--file {}'.format(reqs_file)),
+        cget_cmd('size', '3')
+    ])
+
 @appveyor_skip
 def test_app_include_dir(d):
     d.cmds(install_cmds(url=get_exists_path('basicapp-include'), lib='simple', alias='simple', size=2))
@@ -0,0 +1,157 @@
+import threading, time
+from unittest import mock
+
+import pytest
+
+from cget.graph import Graph, JobBudget, run_pipeline
+import cget.util as util
+
+
+def diamond():
+    g = Graph()
+    for key in ['app', 'left', 'right', 'base']:
+        g.add(key)
+    g.add_edge('app', 'left')
+    g.add_edge('app', 'right')
+    g.add_edge('left', 'base')
+    g.add_edge('right', 'base')
+    return g
+
+
+# ── Graph ────────────────────────────────────────────────────────────────────
+
+class TestGraph:
+    def test_add_is_idempotent(self):
+        g = Graph()
+        a = g.add('a', 1)
+        assert g.add('a', 2) is a
+        assert a.value == 1
+        assert len(g) == 1
+
+    def test_add_edge_dedup(self):
+        g = Graph()
+        g.add('a')
+        g.add('b')
+        g.add_edge('a', 'b')
+        g.add_edge('a', 'b')
+        assert g['a'].deps == ['b']
+
+    def test_topological_order(self):
+        assert diamond().topological_order(['app']) == ['base', 'left', 'right', 'app']
+
+    def test_topological_order_from_keys(self):
+        assert diamond().topological_order(['left']) == ['base', 'left']
+
+    def test_topological_order_cycle(self):
+        g = diamond()
+        g.add_edge('base', 'app')
+        with pytest.raises(util.BuildError, match="Dependency cycle between: app, left, base"):
+            g.topological_order()
+
+
+# ── run_pipeline ─────────────────────────────────────────────────────────────
+
+def pipeline(graph, deps, prepare=None, run=None, **kwargs):
+    def add(key):
+        new = key not in graph
+        graph.add(key)
+        return key, new
+    def default_prepare(node):
+        return deps.get(node.key, [])
+    return run_pipeline(graph, ['app'], add, prepare or default_prepare, run or (lambda node: node.key), **kwargs)
+
+
+class TestRunPipeline:
+    def test_discovers_graph(self):
+        g = Graph()
+        deps = {'app': ['left', 'right'], 'left': ['base'], 'right': ['base']}
+        results = [r for n, r in pipeline(g, deps, workers=2)]
+        assert sorted(results) == ['app', 'base', 'left', 'right']
+        assert results[0] == 'base'
+        assert results[-1] == 'app'
+        assert g['app'].deps == ['left', 'right']
+
+    def test_prepares_while_running(self):
+        g = Graph()
+        deps = {'app': ['leaf', 'mid'], 'mid': ['deep']}
+        deep_prepared = threading.Event()
+        def prepare(node):
+            if node.key == 'deep': deep_prepared.set()
+            return deps.get(node.key, [])
+        def run(node):
+            # The leaf can only finish once later nodes were prepared
+            if node.key == 'leaf': assert deep_prepared.wait(10)
+            return node.key
+        results = [r for n, r in pipeline(g, deps, prepare=prepare, run=run, workers=1, prepare_workers=1, limit=4)]
+        assert results[-1] == 'app'
+
+    def test_limit(self):
+        g = Graph()
+        deps = {'app': ['leaf{}'.format(i) for i in range(8)]}
+        lock = threading.Lock()
+        outstanding = [0]
+        peak = [0]
+        def prepare(node):
+            with lock:
+                outstanding[0] += 1
+                peak[0] = max(peak[0], outstanding[0])
+            return deps.get(node.key, [])
+        def run(node):
+            with lock: outstanding[0] -= 1
+        list(pipeline(g, deps, prepare=prepare, run=run, workers=1, limit=2))
+        assert len(g) == 9
+        assert peak[0] <= 2
+
+    def test_prepare_failure(self):
+        def prepare(node):
+            if node.key == 'base': raise util.BuildError("boom")
+            return {'app': ['base']}.get(node.key, [])
+        with pytest.raises(util.BuildError):
+            list(pipeline(Graph(), {}, prepare=prepare))
+
+    def test_cycle(self):
+        with pytest.raises(util.BuildError, match="cycle"):
+            list(pipeline(Graph(), {'app': ['a'], 'a': ['app']}))
+
+
+# ── JobBudget ────────────────────────────────────────────────────────────────
+
+class TestJobBudget:
+    def test_split_between_active_builds(self):
+        budget = JobBudget(8, jobserver=mock.MagicMock())
+        with budget.share() as a:
+            assert a == 8
+            with budget.share() as b:
+                assert b == 1
+        with budget.share() as c:
+            assert c == 8
+
+    def test_shares_within_budget(self):
+        budget = JobBudget(8)
+        shares = []
+        running = []
+        lock = threading.Lock()
+        first = budget.share()
+        assert first.__enter__() == 8
+        def build():
+            with budget.share() as n:
+                with lock:
+                    running.append(n)
+                    shares.append(sum(running))
+                time.sleep(0.01)
+                with lock: running.remove(n)
+        threads = [threading.Thread(target=build) for i in range(8)]
+        for t in threads: t.start()
+        time.sleep(0.05)
+        # Every job is taken by the first build
+        assert shares == []
+        first.__exit__(None, None, None)
+        for t in threads: t.join()
+        assert len(shares) == 8
+        assert max(shares) <= 8
+
+    def test_at_least_one(self):
+        budget = JobBudget(1, jobserver=mock.MagicMock())
+        with budget.share():
+            with budget.share() as b:
+                assert b == 1
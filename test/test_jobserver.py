@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from cget.jobserver import JobServer, parse_makeflags
+
+posix_only = pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason="jobserver needs fifos")
+
+
+# ── parse_makeflags ──────────────────────────────────────────────────────────
+
+class TestParseMakeflags:
+    def test_empty(self):
+        assert parse_makeflags(None) == (None, None)
+
+    def test_pipe_auth(self):
+        assert parse_makeflags(" -j8 --jobserver-auth=3,4") == (8, "3,4")
+
+    def test_fifo_auth(self):
+        assert parse_makeflags("-j4 --jobserver-auth=fifo:/tmp/GMfifo1") == (4, "fifo:/tmp/GMfifo1")
+
+    def test_old_fds_option(self):
+        assert parse_makeflags("-j2 --jobserver-fds=5,6") == (2, "5,6")
+
+    def test_no_jobserver(self):
+        assert parse_makeflags("-k") == (None, None)
+
+
+# ── JobServer ────────────────────────────────────────────────────────────────
+
+@posix_only
+class TestJobServer:
+    def test_create_tokens(self):
+        js = JobServer.create(3)
+        try:
+            # One implicit slot plus two tokens in the fifo
+            tokens = [js.acquire() for _ in range(3)]
+            assert tokens[0] is None
+            assert tokens[1:] == [b'+', b'+']
+            for token in tokens: js.release(token)
+            assert js.acquire() is None
+        finally:
+            js.close()
+        assert not os.path.exists(js.tmp_dir)
+
+    def test_makeflags(self):
+        js = JobServer.create(4)
+        try:
+            assert js.makeflags() == ' -j4 --jobserver-auth={0},{0}'.format(js.read_fd)
+            assert js.makeflags(fifo=True) == ' -j4 --jobserver-auth=fifo:' + js.fifo
+        finally:
+            js.close()
+
+    def test_inherit_fifo(self):
+        parent = JobServer.create(2)
+        try:
+            js = JobServer.from_environ({'MAKEFLAGS': parent.makeflags(fifo=True)})
+            assert js.jobs == 2
+            assert js.acquire() is None
+            # The token written by the parent is shared
+            assert js.acquire() == b'+'
+            js.close()
+        finally:
+            parent.close()
+
+    def test_inherit_closed_fds(self):
+        r, w = os.pipe()
+        os.close(r)
+        os.close(w)
+        assert JobServer.from_environ({'MAKEFLAGS': '-j4 --jobserver-auth={0},{1}'.format(r, w)}) is None
+
+    def test_inherit_nothing(self):
+        assert JobServer.from_environ({}) is None
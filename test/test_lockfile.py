@@ -0,0 +1,71 @@
+import pytest
+
+from cget.package import PackageSource, PackageBuild
+import cget.lockfile as lockfile
+import cget.util as util
+
+
+def diamond():
+    pbs = {}
+    for name in ['app', 'left', 'right', 'base']:
+        pbs[name] = PackageBuild(PackageSource(name=name, url='https://example.com/{}.tar.gz'.format(name)), define=['A=1'])
+    edges = {'app': ['left', 'right'], 'left': ['base'], 'right': ['base'], 'base': []}
+    packages = dict((name, lockfile.to_entry(pb, 'sha256:' + name, [pbs[dep] for dep in edges[name]])) for name, pb in pbs.items())
+    return lockfile.create([pbs['app']], packages)
+
+
+class TestLockfile:
+    def test_write_and_read(self, tmp_path):
+        path = str(tmp_path / "cget.lock")
+        lockfile.write(path, diamond())
+        assert lockfile.read(path) == diamond()
+
+    def test_read_other_version(self, tmp_path):
+        path = str(tmp_path / "cget.lock")
+        lock = diamond()
+        lock['version'] = 0
+        lockfile.write(path, lock)
+        with pytest.raises(util.BuildError):
+            lockfile.read(path)
+
+    def test_to_pkg_build(self):
+        pb = lockfile.to_pkg_build(diamond(), 'left', variant='Debug')
+        assert pb.pkg_src.url == 'https://example.com/left.tar.gz'
+        assert pb.to_fname() == 'left'
+        assert pb.hash == 'sha256:left'
+        assert pb.define == ['A=1']
+        assert pb.variant == 'Debug'
+
+    def test_recipe_requirements(self):
+        pb = PackageBuild(PackageSource(name='app', url='https://example.com/app.tar.gz'), requirements='/recipes/app/requirements.cget')
+        lock = lockfile.create([pb], {'app': lockfile.to_entry(pb, 'sha256:app', [])})
+        assert lockfile.to_pkg_build(lock, 'app').requirements == '/recipes/app/requirements.cget'
+        assert lockfile.to_pkg_build(diamond(), 'app').requirements is None
+
+    def test_missing_package(self):
+        with pytest.raises(util.BuildError):
+            lockfile.to_pkg_build(diamond(), 'other')
+
+    def test_get_dependents(self):
+        lock = diamond()
+        app = lockfile.to_pkg_build(lock, 'app', variant='Debug')
+        deps = list(lockfile.get_dependents(lock, app))
+        assert [dep.to_fname() for dep in deps] == ['left', 'right']
+        assert all(dep.parent == 'app' and dep.variant == 'Debug' for dep in deps)
+        # The defines of the parent are not added again
+        assert deps[0].define == ['A=1']
+
+    def test_get_dependents_skips_test_dependencies(self):
+        lock = diamond()
+        lock['packages']['app']['deps'][0]['test'] = True
+        app = lockfile.to_pkg_build(lock, 'app')
+        assert [dep.to_fname() for dep in lockfile.get_dependents(lock, app)] == ['right']
+        assert [dep.to_fname() for dep in lockfile.get_dependents(lock, app, test=True)] == ['left', 'right']
+
+    def test_check_roots(self):
+        lock = diamond()
+        lockfile.check_roots(lock, [lockfile.to_pkg_build(lock, 'app')])
+        with pytest.raises(util.BuildError, match="out of date"):
+            lockfile.check_roots(lock, [lockfile.to_pkg_build(lock, 'left')])
+        with pytest.raises(util.BuildError, match="out of date"):
+            lockfile.check_roots(lock, [lockfile.to_pkg_build(lock, 'app').merge_defines(['B=2'])])
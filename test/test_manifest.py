@@ -0,0 +1,69 @@
+import os
+
+from cget.manifest import Manifest, DependencyIndex
+
+
+class TestManifest:
+    def test_add_and_get(self, tmp_path):
+        m = Manifest(str(tmp_path / "cget" / "manifest.db"))
+        m.add("pkg", ["lib/libfoo.a", "include/foo.h"])
+        assert m.has("pkg")
+        assert m.get("pkg") == ["include/foo.h", "lib/libfoo.a"]
+
+    def test_add_is_idempotent(self, tmp_path):
+        m = Manifest(str(tmp_path / "manifest.db"))
+        m.add("pkg", ["a"])
+        m.add("pkg", ["a", "b"])
+        assert m.get("pkg") == ["a", "b"]
+
+    def test_packages_are_separate(self, tmp_path):
+        m = Manifest(str(tmp_path / "manifest.db"))
+        m.add("a", ["lib/a"])
+        m.add("b", ["lib/b"])
+        m.remove("a")
+        assert not m.has("a")
+        assert m.get("b") == ["lib/b"]
+
+    def test_replace(self, tmp_path):
+        m = Manifest(str(tmp_path / "manifest.db"))
+        m.add("pkg", ["include/foo", "lib/a"])
+        m.replace("pkg", "include/foo", ["include/foo/a.h", "include/foo/b.h"])
+        assert m.get("pkg") == ["include/foo/a.h", "include/foo/b.h", "lib/a"]
+        # Packages without the path are left alone
+        m.replace("other", "include/foo", ["include/foo/a.h"])
+        assert not m.has("other")
+
+    def test_missing_database(self, tmp_path):
+        m = Manifest(str(tmp_path / "manifest.db"))
+        assert not m.has("pkg")
+        assert m.get("pkg") == []
+        m.remove("pkg")
+        assert not os.path.exists(m.path)
+
+
+class TestDependencyIndex:
+    def test_add_and_lookup(self, tmp_path):
+        index = DependencyIndex(str(tmp_path / "manifest.db"))
+        index.add("base", "left")
+        index.add("base", "right")
+        index.add("left", "app")
+        assert index.dependents("base") == ["left", "right"]
+        assert index.dependencies("left") == ["base"]
+        assert index.dependencies("app") == ["left"]
+
+    def test_remove(self, tmp_path):
+        index = DependencyIndex(str(tmp_path / "manifest.db"))
+        index.add("base", "app")
+        index.add("other", "app")
+        index.remove("base")
+        assert index.dependents("base") == []
+        assert index.dependencies("app") == ["other"]
+
+    def test_loads_existing_prefix(self, tmp_path):
+        path = str(tmp_path / "manifest.db")
+        Manifest(path).add("base", ["include/base.h"])
+        index = DependencyIndex(path, load=lambda: [("base", "app")])
+        assert index.dependents("base") == ["app"]
+        # Only loaded when the index is created
+        index = DependencyIndex(path, load=lambda: [("base", "other")])
+        assert index.dependents("base") == ["app"]
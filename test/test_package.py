@@ -1,5 +1,7 @@
+import argparse
 import copy
 import hashlib
+import shlex
 
 import pytest
 
@@ -10,7 +12,9 @@ from cget.package import (
     decode_url,
     fname_to_pkg,
     parse_pkg_build_tokens,
+    split_requirement,
 )
+from cget.util import BuildError
 
 
 # ── encode_url / decode_url ─────────────────────────────────────────────────
@@ -165,9 +169,8 @@ class TestPackageBuild:
         pb = PackageBuild(define=["A=1"])
         original_define = list(pb.define)
         result = pb.merge_defines(["B=2"])
-        # Note: copy.copy is shallow, so define list is shared
-        # This is current behavior
         assert "B=2" in result.define
+        assert pb.define == original_define
 
     def test_merge_other(self):
         ps1 = PackageSource(name="pkg1")
@@ -198,6 +201,20 @@ class TestPackageBuild:
         assert "PARENT_DEF=1" in result.define
         assert result.variant == "Debug"
 
+    def test_of_does_not_modify_child(self):
+        parent = PackageBuild(pkg_src=PackageSource(name="parent"), define=["PARENT_DEF=1"])
+        child = PackageBuild(pkg_src=PackageSource(name="child"), define=["CHILD_DEF=1"])
+        child.of(parent)
+        assert child.define == ["CHILD_DEF=1"]
+
+    def test_copy(self):
+        pb = PackageBuild(pkg_src=PackageSource(name="pkg"), define=["A=1"])
+        result = pb.copy()
+        result.define.append("B=2")
+        result.pkg_src.name = "other"
+        assert pb.define == ["A=1"]
+        assert pb.pkg_src.name == "pkg"
+
     def test_to_fname_with_package_source(self):
         ps = PackageSource(name="mypackage")
         pb = PackageBuild(pkg_src=ps)
@@ -290,6 +307,85 @@ class TestParsePkgBuildTokens:
         pb = parse_pkg_build_tokens(["pkg"])
         assert pb.variant == 'Release'
 
+    def test_equals_forms(self):
+        pb = parse_pkg_build_tokens(["pkg", "--define=A=1", "--hash=sha256:abc", "--cmake", "x.cmake"])
+        assert pb.define == ["A=1"]
+        assert pb.hash == "sha256:abc"
+        assert pb.cmake == "x.cmake"
+
+    def test_separate_short_value(self):
+        pb = parse_pkg_build_tokens(["pkg", "-D", "A=1", "-f", "reqs.txt"])
+        assert pb.define == ["A=1"]
+        assert pb.file == "reqs.txt"
+
+    def test_grouped_flags(self):
+        pb = parse_pkg_build_tokens(["-tbDA=1", "pkg"])
+        assert pb.test is True
+        assert pb.build is True
+        assert pb.define == ["A=1"]
+        assert pb.pkg_src == "pkg"
+
+    def test_abbreviated_long_option(self):
+        pb = parse_pkg_build_tokens(["pkg", "--ignore", "--def", "A=1"])
+        assert pb.ignore_requirements is True
+        assert pb.define == ["A=1"]
+
+    def test_defaults(self):
+        pb = parse_pkg_build_tokens(["pkg"])
+        assert pb.define == []
+        assert pb.test is False
+        assert pb.build is None
+        assert pb.ignore_requirements is None
+        assert pb.hash is None
+
+    @pytest.mark.parametrize("tokens", [
+        ["a", "b"],
+        ["pkg", "-Z"],
+        ["pkg", "--nope"],
+        ["pkg", "-D"],
+        ["pkg", "--test=1"],
+    ])
+    def test_invalid(self, tokens):
+        with pytest.raises(BuildError):
+            parse_pkg_build_tokens(tokens)
+
+
+def argparse_pkg_build_tokens(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pkg_src', nargs='?')
+    parser.add_argument('-D', '--define', action='append', default=[])
+    parser.add_argument('-H', '--hash')
+    parser.add_argument('-X', '--cmake')
+    parser.add_argument('-f', '--file')
+    parser.add_argument('-t', '--test', action='store_true')
+    parser.add_argument('-b', '--build', action='store_true')
+    parser.add_argument('--ignore-requirements', action='store_true')
+    return parser.parse_args(args=args, namespace=PackageBuild())
+
+REQUIREMENT_LINES = [
+    "user/repo",
+    "user/repo@v1.0 -DFOO=1 -DBAR=2 # pinned",
+    "zlib,http://zlib.net/zlib-1.2.11.tar.gz -H sha256:abc -X recipe.cmake",
+    "-f dev-requirements.txt",
+    "pkg --define=A=1 --test -b --ignore-requirements",
+    "pkg -D 'A=with space' -t",
+    "# just a comment",
+    "",
+]
+
+class TestSplitRequirement:
+    @pytest.mark.parametrize("line", REQUIREMENT_LINES + ["pkg \\ x", 'pkg "#notcomment"', "a#b c"])
+    def test_same_as_shlex(self, line):
+        assert split_requirement(line) == shlex.split(line, comments=True)
+
+    @pytest.mark.parametrize("line", REQUIREMENT_LINES)
+    def test_same_as_argparse(self, line):
+        tokens = split_requirement(line)
+        expected = argparse_pkg_build_tokens(tokens)
+        pb = parse_pkg_build_tokens(tokens)
+        for field in ['pkg_src', 'define', 'hash', 'cmake', 'file', 'test', 'build', 'ignore_requirements']:
+            assert getattr(pb, field) == getattr(expected, field)
+
 
 # ── Additional encode_url / decode_url tests ─────────────────────────────────
 
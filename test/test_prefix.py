@@ -1,6 +1,9 @@
 import os
+import contextlib
 import shutil
+import tarfile
 import textwrap
+import threading
 from unittest import mock
 
 import pytest
@@ -20,6 +23,7 @@ from cget.prefix import (
 )
 from cget.package import PackageSource, PackageBuild
 import cget.util as util
+import cget.lockfile as lockfile
 
 
 # ── parse_deprecated_alias ───────────────────────────────────────────────────
@@ -615,6 +619,97 @@ class TestCGetPrefixList:
         assert names == ["pkg1", "pkg2", "pkg3"]
 
 
+# ── CGetPrefix.unlink / link ────────────────────────────────────────────────
+
+class TestUnlink:
+    def _install(self, p, name):
+        src = PackageSource(name=name)
+        install = p.get_package_directory(src.to_fname(), "install")
+        os.makedirs(os.path.join(install, "include", name))
+        util.mkfile(os.path.join(install, "include", name), "a.h", ["a"])
+        p.link_install(install)
+        return src
+
+    def test_only_removes_manifest_files(self, tmp_path, monkeypatch):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        src = self._install(p, "foo")
+        self._install(p, "bar")
+        os.makedirs(p.get_path("share", "empty"))
+        assert p.manifest.get(src.to_fname()) == [os.path.join("include", "foo", "a.h")]
+        # The prefix is not walked
+        monkeypatch.setattr(util, 'rm_symlink_from', mock.Mock(side_effect=AssertionError))
+        monkeypatch.setattr(util, 'rm_empty_dirs', mock.Mock(side_effect=AssertionError))
+        p.unlink(src)
+        assert not os.path.exists(p.get_path("include", "foo"))
+        assert os.path.exists(p.get_path("include", "bar", "a.h"))
+        assert os.path.exists(p.get_path("share", "empty"))
+        assert not p.manifest.has(src.to_fname())
+        assert os.path.exists(p.get_unlink_directory(src.to_fname()))
+
+    def test_relink(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        src = self._install(p, "foo")
+        p.unlink(src)
+        p.link(src)
+        assert os.path.exists(p.get_path("include", "foo", "a.h"))
+        assert p.manifest.has(src.to_fname())
+
+    def test_unlink_all(self, tmp_path, monkeypatch):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        srcs = [self._install(p, name) for name in ["foo", "bar", "baz"]]
+        monkeypatch.setattr(util, 'rm_empty_dirs', mock.Mock(side_effect=AssertionError))
+        names = list(p.unlink_all(srcs[:2], delete=True))
+        assert names == ["foo", "bar"]
+        assert not os.path.exists(p.get_path("include", "foo"))
+        assert not os.path.exists(p.get_path("include", "bar"))
+        assert os.path.exists(p.get_path("include", "baz", "a.h"))
+        assert [d for d in os.listdir(p.get_private_path()) if d.startswith("trash-")] == []
+        assert sorted(os.listdir(p.get_package_directory())) == [srcs[2].to_fname()]
+
+    def test_unlink_all_keeps_packages(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        srcs = [self._install(p, name) for name in ["foo", "bar"]]
+        list(p.unlink_all(srcs))
+        assert not os.path.exists(p.get_path("include"))
+        assert sorted(os.listdir(p.get_unlink_directory())) == sorted(src.to_fname() for src in srcs)
+
+    def test_unlink_all_without_manifest(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        srcs = [self._install(p, name) for name in ["foo", "bar"]]
+        p.manifest.remove(*[src.to_fname() for src in srcs])
+        list(p.unlink_all(srcs, delete=True))
+        assert not os.path.exists(p.get_path("include"))
+
+    @pytest.mark.skipif(os.name != 'posix', reason="symlinks need posix")
+    def test_folded_dir_unfolded_by_second_package(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'FOLD_SYMLINKS', True)
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        foo = self._install(p, "foo")
+        assert os.path.islink(p.get_path("include", "foo"))
+        assert p.manifest.get(foo.to_fname()) == [os.path.join("include", "foo")]
+        # Another package adds a file to the folded directory
+        bar = PackageSource(name="bar")
+        install = p.get_package_directory(bar.to_fname(), "install")
+        os.makedirs(os.path.join(install, "include", "foo"))
+        util.mkfile(os.path.join(install, "include", "foo"), "b.h", ["b"])
+        p.link_install(install)
+        assert not os.path.islink(p.get_path("include", "foo"))
+        assert p.manifest.get(foo.to_fname()) == [os.path.join("include", "foo", "a.h")]
+        p.remove(foo)
+        assert not os.path.exists(p.get_path("include", "foo", "a.h"))
+        assert os.path.exists(p.get_path("include", "foo", "b.h"))
+        p.remove(bar)
+        assert not os.path.exists(p.get_path("include"))
+
+    def test_without_manifest(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        src = self._install(p, "foo")
+        p.manifest.remove(src.to_fname())
+        p.remove(src)
+        assert not os.path.exists(p.get_path("include", "foo"))
+        assert not os.path.exists(p.get_package_directory(src.to_fname()))
+
+
 # ── CGetPrefix.try_ ─────────────────────────────────────────────────────────
 
 class TestTry:
@@ -1275,6 +1370,23 @@ class TestCGetPrefixListAdditional:
         assert "parent" in names
         assert "child" in names
 
+    def test_list_recursive_diamond(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        for name in ["base", "left", "right", "app"]:
+            os.makedirs(p.get_package_directory(name))
+        for child, parent in [("base", "left"), ("base", "right"), ("left", "app"), ("right", "app")]:
+            p.write_parent(PackageBuild(pkg_src=PackageSource(name=child), parent=parent))
+        names = [r.name for r in p.list("base", recursive=True)]
+        assert names == ["base", "left", "app", "right"]
+
+    def test_list_recursive_uses_index(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        for name in ["parent", "child"]:
+            os.makedirs(p.get_package_directory(name))
+        p.write_parent(PackageBuild(pkg_src=PackageSource(name="parent"), parent="child"))
+        shutil.rmtree(p.get_deps_directory("parent"))
+        assert [r.name for r in p.list("parent", recursive=True)] == ["parent", "child"]
+
     def test_list_specific_package(self, tmp_path):
         p = CGetPrefix(str(tmp_path / "pfx"))
         os.makedirs(p.get_package_directory("mypkg"))
@@ -1283,7 +1395,7 @@ class TestCGetPrefixListAdditional:
         assert result[0].name == "mypkg"
 
 
-# ── CGetPrefix.install ──────────────────────────────────────────────────────
+# ── CGetPrefix.install_all ──────────────────────────────────────────────────
 
 class TestInstall:
     def test_install_already_installed(self, tmp_path):
@@ -1291,8 +1403,8 @@ class TestInstall:
         ps = PackageSource(name="user/repo", url="https://github.com/user/repo/archive/HEAD.tar.gz")
         pkg_dir = p.get_package_directory(ps.to_fname())
         os.makedirs(pkg_dir)
-        result = p.install(PackageBuild(pkg_src=ps))
-        assert "already installed" in result
+        result = list(p.install_all([PackageBuild(pkg_src=ps)]))
+        assert "already installed" in result[0]
 
     def test_install_relinks_unlinked(self, tmp_path, monkeypatch):
         monkeypatch.setattr(util, 'USE_SYMLINKS', False)
@@ -1308,8 +1420,8 @@ class TestInstall:
             f.write("lib content")
         # Need pkg dir to exist for link
         os.makedirs(p.get_package_directory(), exist_ok=True)
-        result = p.install(PackageBuild(pkg_src=ps))
-        assert "Linking" in result
+        result = list(p.install_all([PackageBuild(pkg_src=ps)]))
+        assert "Linking" in result[0]
 
     def test_install_update_removes_unlinked(self, tmp_path, monkeypatch):
         monkeypatch.setattr(util, 'USE_SYMLINKS', False)
@@ -1327,11 +1439,39 @@ class TestInstall:
             mock_builder.cmake_original_file = '__cget_original_cmake_file__.cmake'
             mock_cb.return_value.__enter__ = mock.MagicMock(return_value=mock_builder)
             mock_cb.return_value.__exit__ = mock.MagicMock(return_value=False)
-            with mock.patch.object(p, 'install_deps'):
-                result = p.install(PackageBuild(pkg_src=ps), update=True)
-                assert "Successfully installed" in result
+            with mock.patch.object(p, 'build_install'):
+                result = list(p.install_all([PackageBuild(pkg_src=ps)], update=True))
+                assert "Successfully installed" in result[0]
                 assert not os.path.exists(unlink_dir)
 
+    @pytest.mark.skipif(os.name != 'posix', reason="symlinks need posix")
+    def test_custom_cmake_on_shadowed_sources(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'USE_SYMLINKS', True)
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        src = tmp_path / "proj"
+        src.mkdir()
+        (src / "CMakeLists.txt").write_text("project(proj)")
+        (src / "main.cpp").write_text("int main() {}")
+        cmake_file = tmp_path / "custom.cmake"
+        cmake_file.write_text("# custom")
+        top = tmp_path / "build"
+        top.mkdir()
+        src_dir = util.transfer_to(str(src), str(top), copy=True)
+        builder = mock.MagicMock()
+        builder.cmake_original_file = '__cget_original_cmake_file__.cmake'
+        pb = PackageBuild(pkg_src=PackageSource(name="proj", url="file://" + str(src)), cmake=str(cmake_file))
+        with mock.patch.object(p, 'link_install'):
+            p.build_install(pb, builder, src_dir)
+        assert open(os.path.join(src_dir, "CMakeLists.txt")).read() == "# custom"
+        original = os.path.join(src_dir, builder.cmake_original_file)
+        assert open(original).read() == "project(proj)"
+        # Only the cmake files are real files, and the package is untouched
+        for f in [original, os.path.join(src_dir, "CMakeLists.txt")]:
+            assert not os.path.islink(f) and os.stat(f).st_nlink == 1
+        assert os.path.samefile(os.path.join(src_dir, "main.cpp"), str(src / "main.cpp"))
+        assert (src / "CMakeLists.txt").read_text() == "project(proj)"
+        assert sorted(os.listdir(str(src))) == ["CMakeLists.txt", "main.cpp"]
+
 
 # ── CGetPrefix.install_deps ─────────────────────────────────────────────────
 
@@ -1354,8 +1494,7 @@ class TestInstallDeps:
         req = os.path.join(src_dir, "requirements.cget")
         with open(req, 'w') as f:
             f.write("dep/lib\n")
-        with mock.patch.object(p, 'install') as mock_install:
-            mock_install.return_value = "installed"
+        with mock.patch.object(p, 'install_all', return_value=[]) as mock_install:
             p.install_deps(pb, src_dir)
             mock_install.assert_called_once()
 
@@ -1368,7 +1507,7 @@ class TestInstallDeps:
         req = os.path.join(src_dir, "requirements.cget")
         with open(req, 'w') as f:
             f.write("dep/lib\n")
-        with mock.patch.object(p, 'install') as mock_install:
+        with mock.patch.object(p, 'install_all', return_value=[]) as mock_install:
             p.install_deps(pb, src_dir, ignore_requirements=True)
             mock_install.assert_not_called()
 
@@ -1381,7 +1520,7 @@ class TestInstallDeps:
         req = os.path.join(src_dir, "requirements.cget")
         with open(req, 'w') as f:
             f.write("dep/lib -t\n")
-        with mock.patch.object(p, 'install') as mock_install:
+        with mock.patch.object(p, 'install_all', return_value=[]) as mock_install:
             p.install_deps(pb, src_dir, test=False)
             # Test dependency should be skipped when not testing
             mock_install.assert_not_called()
@@ -1395,11 +1534,23 @@ class TestInstallDeps:
         req = os.path.join(src_dir, "requirements.cget")
         with open(req, 'w') as f:
             f.write("dep/lib -t\n")
-        with mock.patch.object(p, 'install') as mock_install:
-            mock_install.return_value = "installed"
+        with mock.patch.object(p, 'install_all', return_value=[]) as mock_install:
             p.install_deps(pb, src_dir, test=True)
             mock_install.assert_called_once()
 
+    def test_test_dependency_not_recorded(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        for name in ["lib", "tester"]: (tmp_path / name).mkdir()
+        pb = PackageBuild(pkg_src=PackageSource(name="pkg", url="https://example.com"))
+        src_dir = tmp_path / "src"
+        src_dir.mkdir()
+        (src_dir / "requirements.cget").write_text("lib,{0}\ntester,{1} -t\n".format(tmp_path / "lib", tmp_path / "tester"))
+        with mock.patch.object(p, 'build_install', side_effect=lambda pb, *args, **kwargs: os.makedirs(p.get_package_directory(pb.to_fname()))):
+            p.install_deps(pb, str(src_dir), test=True)
+        assert os.path.exists(p.get_package_directory("tester"))
+        assert os.path.exists(p.get_deps_directory("lib", "pkg"))
+        assert not os.path.exists(p.get_deps_directory("tester", "pkg"))
+
     def test_custom_requirements_file(self, tmp_path):
         p = CGetPrefix(str(tmp_path / "pfx"))
         custom_req = str(tmp_path / "custom_reqs.txt")
@@ -1409,8 +1560,7 @@ class TestInstallDeps:
         pb = PackageBuild(pkg_src=ps, requirements=custom_req)
         src_dir = str(tmp_path / "src")
         os.makedirs(src_dir)
-        with mock.patch.object(p, 'install') as mock_install:
-            mock_install.return_value = "installed"
+        with mock.patch.object(p, 'install_all', return_value=[]) as mock_install:
             p.install_deps(pb, src_dir)
             mock_install.assert_called_once()
 
@@ -1619,8 +1769,7 @@ class TestRequirementsTxtBackwardsCompat:
         req = os.path.join(src_dir, "requirements.txt")
         with open(req, 'w') as f:
             f.write("dep/lib\n")
-        with mock.patch.object(p, 'install') as mock_install:
-            mock_install.return_value = "installed"
+        with mock.patch.object(p, 'install_all', return_value=[]) as mock_install:
             p.install_deps(pb, src_dir)
             mock_install.assert_called_once()
 
@@ -1663,3 +1812,438 @@ class TestRequirementsTxtBackwardsCompat:
             f.write("dep/lib\n")
         result = p.from_recipe(recipe)
         assert result.requirements == req
+
+
+# ── CGetPrefix.install_all ──────────────────────────────────────────────────
+
+class TestInstallAll:
+    def _write_pkg(self, tmp_path, name, reqs=()):
+        d = tmp_path / "src" / name
+        d.mkdir(parents=True)
+        (d / "requirements.cget").write_text("".join("{0},{1}\n".format(r, tmp_path / "src" / r) for r in reqs))
+        return str(d)
+
+    def test_diamond_builds_shared_dep_once(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        self._write_pkg(tmp_path, "base")
+        self._write_pkg(tmp_path, "left", ["base"])
+        self._write_pkg(tmp_path, "right", ["base"])
+        app = self._write_pkg(tmp_path, "app", ["left", "right"])
+        built = []
+        def build_install(pb, builder, src_dir, **kwargs):
+            built.append(pb.to_name())
+            os.makedirs(p.get_package_directory(pb.to_fname()))
+        with mock.patch.object(p, 'build_install', side_effect=build_install):
+            msgs = list(p.install_all([PackageBuild("app," + app)], jobs=2))
+        assert len(msgs) == 4
+        assert sorted(built) == ["app", "base", "left", "right"]
+        assert built[0] == "base"
+        assert built[-1] == "app"
+        assert sorted(os.listdir(p.get_deps_directory("base"))) == ["left", "right"]
+
+    def test_sources_removed_after_each_package(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        self._write_pkg(tmp_path, "base")
+        app = self._write_pkg(tmp_path, "app", ["base"])
+        dirs = {}
+        def build_install(pb, builder, src_dir, **kwargs):
+            dirs[pb.to_name()] = builder.top_dir
+            if pb.to_name() == "app": assert not os.path.exists(dirs["base"])
+            os.makedirs(p.get_package_directory(pb.to_fname()))
+        with mock.patch.object(p, 'build_install', side_effect=build_install):
+            list(p.install_all([PackageBuild("app," + app)], jobs=1))
+        assert not os.path.exists(dirs["app"])
+
+    def test_already_installed_is_skipped(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        app = self._write_pkg(tmp_path, "app")
+        os.makedirs(p.get_package_directory("app"))
+        with mock.patch.object(p, 'build_install') as mock_build:
+            msgs = list(p.install_all([PackageBuild("app," + app)]))
+            mock_build.assert_not_called()
+        assert "already installed" in msgs[0]
+
+    def test_cache_pruned_only_when_added_to(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        app = self._write_pkg(tmp_path, "app")
+        os.makedirs(p.get_package_directory("app"))
+        util.cache_added.clear()
+        with mock.patch('cget.prefix.prune_cache') as prune:
+            list(p.install_all([PackageBuild("app," + app)]))
+            prune.assert_not_called()
+            util.cache_added.set()
+            list(p.install_all([PackageBuild("app," + app)]))
+            prune.assert_called_once()
+        assert not util.cache_added.is_set()
+
+    def test_locked(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        self._write_pkg(tmp_path, "base")
+        app = self._write_pkg(tmp_path, "app", ["base"])
+        lock = p.lock([PackageBuild("app," + app)])
+        built = []
+        def build_install(pb, builder, src_dir, **kwargs):
+            built.append(pb.to_name())
+            os.makedirs(p.get_package_directory(pb.to_fname()))
+        with mock.patch.object(p, 'build_install', side_effect=build_install):
+            list(p.install_all([lockfile.to_pkg_build(lock, "app")], locked=lock))
+        assert built == ["base", "app"]
+
+    def test_locked_requirements_changed(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        self._write_pkg(tmp_path, "base")
+        self._write_pkg(tmp_path, "other")
+        app = self._write_pkg(tmp_path, "app", ["base"])
+        lock = p.lock([PackageBuild("app," + app)])
+        (tmp_path / "src" / "app" / "requirements.cget").write_text("other,{}\n".format(tmp_path / "src" / "other"))
+        with mock.patch.object(p, 'build_install'):
+            with pytest.raises(util.BuildError, match="out of date"):
+                list(p.install_all([lockfile.to_pkg_build(lock, "app")], locked=lock))
+
+
+# ── CGetPrefix parsing ──────────────────────────────────────────────────────
+
+class TestParseMemoized:
+    def test_requirements_parsed_once(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        req = tmp_path / "requirements.cget"
+        req.write_text("dep -DA=1\n")
+        with mock.patch.object(p, 'parse_file', wraps=p.parse_file) as parse_file:
+            first = list(p.from_file(str(req)))
+            second = list(p.from_file(str(req)))
+        assert parse_file.call_count == 1
+        first[0].define.append("B=2")
+        assert second[0].define == ["A=1"]
+
+    def test_included_file_parsed_once(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        (tmp_path / "common.txt").write_text("dep -DA=1\n")
+        (tmp_path / "a.txt").write_text("-f common.txt\n")
+        (tmp_path / "b.txt").write_text("-f common.txt\n")
+        with mock.patch.object(p, 'parse_file', wraps=p.parse_file) as parse_file:
+            a = list(p.from_file(str(tmp_path / "a.txt")))
+            b = list(p.from_file(str(tmp_path / "b.txt")))
+        assert [call[0][0] for call in parse_file.call_args_list] == [str(tmp_path / "a.txt"), str(tmp_path / "common.txt"), str(tmp_path / "b.txt")]
+        assert a[0].define == b[0].define == ["A=1"]
+
+    def test_lines_parsed_when_reached(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        req = tmp_path / "requirements.cget"
+        req.write_text("first\nsecond\n")
+        with mock.patch.object(p, 'find_pkg_src', wraps=p.find_pkg_src) as find_pkg_src:
+            pbs = p.from_file(str(req))
+            next(pbs)
+            assert find_pkg_src.call_count == 1
+            next(pbs)
+            assert find_pkg_src.call_count == 2
+
+    def test_pkg_src_parsed_once(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        with mock.patch.object(p, 'find_pkg_src', wraps=p.find_pkg_src) as find_pkg_src:
+            a = p.parse_pkg_src("user/repo")
+            b = p.parse_pkg_src("user/repo")
+        assert find_pkg_src.call_count == 1
+        assert a is not b
+        assert a.url == b.url
+
+
+# ── CGetPrefix binary cache ─────────────────────────────────────────────────
+
+class TestBinaryCacheKey:
+    def _key(self, tmp_path, name, **kwargs):
+        p = CGetPrefix(str(tmp_path / name))
+        p.compiler_fingerprint = "gcc"
+        pb = PackageBuild(pkg_src=PackageSource(name="foo", url="https://example.com/foo.tar.gz"), **kwargs)
+        return p.get_binary_cache_key(pb, "sha256:ABC")
+
+    def test_depends_on_prefix(self, tmp_path):
+        # The rpath of the binaries points into the prefix
+        assert self._key(tmp_path, "p1") != self._key(tmp_path, "p2")
+
+    def test_depends_on_defines_and_variant(self, tmp_path):
+        base = self._key(tmp_path, "p1")
+        assert self._key(tmp_path, "p1", define=["A=1"]) != base
+        assert self._key(tmp_path, "p1", variant="Debug") != base
+
+    def test_cached_package_is_not_built(self, tmp_path, monkeypatch):
+        from cget.cache import BinaryCache
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path / "cache"), *args))
+        src = tmp_path / "src"
+        src.mkdir()
+        archive = tmp_path / "foo.tar.gz"
+        import tarfile
+        with tarfile.open(str(archive), "w:gz") as tar:
+            tar.add(str(src), arcname="foo")
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        p.compiler_fingerprint = "gcc"
+        pb = PackageBuild("foo," + str(archive), hash="sha256:" + util.hash_file(str(archive), "sha256"))
+        install = tmp_path / "built" / "install"
+        (install / "include").mkdir(parents=True)
+        (install / "include" / "foo.h").write_text("")
+        key = p.get_binary_cache_key(p.parse_pkg_build(pb), pb.hash)
+        BinaryCache().save(key, p.get_dependency_cache_key([]), str(install), {'install_dir': str(install), 'prefix': str(tmp_path / "built")})
+        with mock.patch.object(p, 'build_install') as mock_build:
+            with mock.patch.object(util, 'retrieve_url') as mock_retrieve:
+                msgs = list(p.install_all([pb], binary_cache=BinaryCache()))
+                mock_retrieve.assert_not_called()
+            mock_build.assert_not_called()
+        assert "binary cache" in msgs[0]
+        assert "1 hits" in msgs[-1]
+        assert os.path.exists(p.get_path("include", "foo.h"))
+        assert p.get_installed_cache_key(p.parse_pkg_build(pb)) == key + "/" + p.get_dependency_cache_key([])
+
+    def test_failed_restore_is_built(self, tmp_path, monkeypatch):
+        from cget.cache import BinaryCache
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path / "cache"), *args))
+        app = self._write_pkg(tmp_path, "app")
+        assert self._install(tmp_path, app) == ["app"]
+        with mock.patch.object(BinaryCache, 'restore', side_effect=util.BuildError("Failed to download")):
+            assert self._install(tmp_path, app) == ["app"]
+        assert os.path.exists(str(tmp_path / "pfx" / "cget" / "pkg" / "app" / "install" / "include" / "app.h"))
+
+    def _write_pkg(self, tmp_path, name, reqs=(), files=()):
+        d = tmp_path / "src" / name
+        util.delete_dir(str(d))
+        d.mkdir(parents=True)
+        (d / "requirements.cget").write_text("".join("{0},{1}\n".format(r, url) for r, url in reqs))
+        for f in files: (d / f).write_text("")
+        archive = tmp_path / "archives" / (name + ".tar.gz")
+        archive.parent.mkdir(exist_ok=True)
+        with tarfile.open(str(archive), "w:gz") as tar:
+            tar.add(str(d), arcname=name)
+        return "{0},{1}".format(name, archive)
+
+    def _install(self, tmp_path, pkg):
+        from cget.cache import BinaryCache
+        util.delete_dir(str(tmp_path / "pfx"))
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        p.compiler_fingerprint = "gcc"
+        built = []
+        def build_install(pb, builder, src_dir, **kwargs):
+            built.append(pb.to_name())
+            install = p.get_package_directory(pb.to_fname(), 'install', 'include')
+            os.makedirs(install)
+            with open(os.path.join(install, pb.to_name() + ".h"), "w") as f: f.write("")
+        with mock.patch.object(p, 'build_install', side_effect=build_install):
+            list(p.install_all([PackageBuild(pkg)], binary_cache=BinaryCache()))
+        return sorted(built)
+
+    def test_rebuilt_when_dependency_changes(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path / "cache"), *args))
+        dep = self._write_pkg(tmp_path, "dep").split(',')[1]
+        app = self._write_pkg(tmp_path, "app", [("dep", dep)])
+        assert self._install(tmp_path, app) == ["app", "dep"]
+        assert self._install(tmp_path, app) == []
+        # A new version of the dependency rebuilds the package that uses it
+        self._write_pkg(tmp_path, "dep", files=["new.h"])
+        assert self._install(tmp_path, app) == ["app", "dep"]
+        assert self._install(tmp_path, app) == []
+
+    def test_dependency_without_key_is_not_cached(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path / "cache"), *args))
+        (tmp_path / "local").mkdir()
+        app = self._write_pkg(tmp_path, "app", [("local", str(tmp_path / "local"))])
+        assert self._install(tmp_path, app) == ["app", "local"]
+        # The local directory may have changed, so the package is built again
+        assert self._install(tmp_path, app) == ["app", "local"]
+
+
+class TestGuessedSources:
+    def test_github_fallback_is_guessed(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        assert p.is_guessed(p.parse_pkg_build("user/repo"))
+
+    def test_local_directory_is_not_guessed(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        (tmp_path / "lib").mkdir()
+        assert not p.is_guessed(p.parse_pkg_build(str(tmp_path / "lib")))
+        assert not p.is_guessed(p.parse_pkg_build("https://example.com/lib.tar.gz"))
+
+    def test_recipe_found_after_forget(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        assert p.is_guessed(p.parse_pkg_build(PackageBuild("simple")))
+        before = p.recipes_snapshot()
+        recipe = os.path.join(p.get_recipe_paths()[0], "simple")
+        os.makedirs(recipe)
+        with open(os.path.join(recipe, "package.txt"), "w") as f: f.write("simple,https://example.com/simple.tar.gz\n")
+        assert p.recipes_snapshot() != before
+        p.forget_parsed()
+        pb = p.parse_pkg_build(PackageBuild("simple"))
+        assert not p.is_guessed(pb)
+        assert pb.pkg_src.url == "https://example.com/simple.tar.gz"
+
+
+class TestPrefetch:
+    def _write_archive(self, tmp_path, name, reqs=()):
+        d = tmp_path / "src" / name
+        d.mkdir(parents=True)
+        (d / "requirements.cget").write_text("".join("{0},https://example.com/{0}.tar.gz\n".format(r) for r in reqs))
+        archive = str(tmp_path / (name + ".tar.gz"))
+        with tarfile.open(archive, "w:gz") as tar:
+            tar.add(str(d), arcname=name)
+        return archive
+
+    def test_fetches_dependencies_concurrently(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        archives = {}
+        for name, reqs in [("base", []), ("left", ["base"]), ("right", ["base"]), ("app", ["left", "right"])]:
+            archives["https://example.com/{}.tar.gz".format(name)] = self._write_archive(tmp_path, name, reqs)
+        fetched = []
+        # Both siblings must be downloading at the same time to pass the barrier
+        barrier = threading.Barrier(2, timeout=10)
+        def retrieve_url(url, dst, insecure=False, hash=None):
+            if 'left' in url or 'right' in url: barrier.wait()
+            fetched.append(url)
+            return archives[url]
+        with mock.patch.object(util, 'retrieve_url', side_effect=retrieve_url):
+            n = p.prefetch([PackageBuild("app,https://example.com/app.tar.gz")], jobs=4)
+        assert n == 4
+        assert sorted(fetched) == sorted(archives)
+        assert fetched[0].endswith("app.tar.gz")
+        assert fetched[-1].endswith("base.tar.gz")
+
+    def test_local_directory_dependencies(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        d = tmp_path / "app"
+        d.mkdir()
+        (d / "requirements.cget").write_text("base,https://example.com/base.tar.gz\n")
+        base = self._write_archive(tmp_path, "base")
+        with mock.patch.object(util, 'retrieve_url', return_value=base) as mock_retrieve:
+            assert p.prefetch([PackageBuild("app," + str(d))]) == 2
+        assert mock_retrieve.call_count == 1
+
+    def test_installed_is_skipped(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        pb = p.parse_pkg_build(PackageBuild("app,https://example.com/app.tar.gz"))
+        os.makedirs(p.get_package_directory(pb.to_fname()))
+        with mock.patch.object(util, 'retrieve_url') as mock_retrieve:
+            assert p.prefetch([pb]) == 0
+        mock_retrieve.assert_not_called()
+
+    def test_binary_cache_hit_is_not_fetched(self, tmp_path):
+        from cget.cache import BinaryCache
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        p.compiler_fingerprint = "gcc"
+        cache = BinaryCache(str(tmp_path / "binary"))
+        app = p.parse_pkg_build(PackageBuild("app,https://example.com/app.tar.gz", hash="sha256:abc"))
+        install = tmp_path / "install"
+        install.mkdir()
+        req = tmp_path / "requirements.cget"
+        req.write_text("base,https://example.com/base.tar.gz\n")
+        cache.save(p.get_binary_cache_key(app, app.hash), "d1", str(install), {}, requirements=str(req))
+        base = self._write_archive(tmp_path, "base")
+        with mock.patch.object(util, 'retrieve_url', return_value=base) as mock_retrieve:
+            # The dependencies are still fetched, from the cached requirements
+            assert p.prefetch([app], binary_cache=cache) == 2
+        assert [c[0][0] for c in mock_retrieve.call_args_list] == ["https://example.com/base.tar.gz"]
+        with mock.patch.object(util, 'retrieve_url', return_value=base) as mock_retrieve:
+            p.prefetch([app], update=True, binary_cache=cache)
+        # An update builds the package again, so it needs the archive
+        assert [c[0][0] for c in mock_retrieve.call_args_list] == ["https://example.com/app.tar.gz"]
+
+    def test_failure_is_not_fatal(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        with mock.patch.object(util, 'retrieve_url', side_effect=util.BuildError("offline")):
+            assert p.prefetch([PackageBuild("app,https://example.com/app.tar.gz")]) == 0
+
+
+class TestLock:
+    _write_archive = TestPrefetch._write_archive
+
+    def test_lock(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        archives = {}
+        for name, reqs in [("base", []), ("left", ["base"]), ("right", ["base"]), ("app", ["left", "right"])]:
+            archives["https://example.com/{}.tar.gz".format(name)] = self._write_archive(tmp_path, name, reqs)
+        with mock.patch.object(util, 'retrieve_url', side_effect=lambda url, dst, **kwargs: archives[url]):
+            lock = p.lock([PackageBuild("app,https://example.com/app.tar.gz", define=["A=1"])])
+        assert lock['roots'] == ["app"]
+        assert sorted(lock['packages']) == ["app", "base", "left", "right"]
+        base = lock['packages']['base']
+        assert base['url'] == "https://example.com/base.tar.gz"
+        assert base['hash'] == "sha256:" + util.hash_file(archives[base['url']], 'sha256')
+        assert base['define'] == ["A=1"]
+        assert [dep['fname'] for dep in lock['packages']['app']['deps']] == ["left", "right"]
+
+    def test_failure_is_fatal(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        with mock.patch.object(util, 'retrieve_url', side_effect=util.BuildError("offline")):
+            with pytest.raises(util.BuildError):
+                p.lock([PackageBuild("app,https://example.com/app.tar.gz")])
+
+
+class TestResolve:
+    _write_archive = TestPrefetch._write_archive
+
+    def _write_dir(self, tmp_path, name, reqs):
+        d = tmp_path / name
+        d.mkdir()
+        (d / "requirements.cget").write_text("".join(r + "\n" for r in reqs))
+        return str(d)
+
+    def test_guessed_dependency_is_deferred(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        app = PackageBuild("app," + self._write_dir(tmp_path, "app", ["simple"]))
+        recipes = PackageBuild("recipes,https://example.com/recipes.tar.gz")
+        archive = self._write_archive(tmp_path, "recipes")
+        with mock.patch.object(util, 'retrieve_url', return_value=archive) as mock_retrieve:
+            pbs, deferred = p.resolve([recipes, app], defer_guessed=True)
+        assert pbs == [recipes]
+        assert deferred == [app]
+        assert [c[0][0] for c in mock_retrieve.call_args_list] == ["https://example.com/recipes.tar.gz"]
+
+    def test_guessed_dependency_fetched_when_nothing_else_can_go_first(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        app = PackageBuild("app," + self._write_dir(tmp_path, "app", ["simple"]))
+        archive = self._write_archive(tmp_path, "simple")
+        with mock.patch.object(util, 'retrieve_url', return_value=archive) as mock_retrieve:
+            pbs, deferred = p.resolve([app], defer_guessed=True)
+        assert pbs == [app]
+        assert deferred == []
+        assert [c[0][0] for c in mock_retrieve.call_args_list] == ["https://github.com/simple/simple/archive/HEAD.tar.gz"]
+
+    def test_guessed_dependency_not_deferred_by_default(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        app = PackageBuild("app," + self._write_dir(tmp_path, "app", ["simple"]))
+        recipes = PackageBuild("recipes,https://example.com/recipes.tar.gz")
+        archive = self._write_archive(tmp_path, "recipes")
+        with mock.patch.object(util, 'retrieve_url', return_value=archive):
+            pbs, deferred = p.resolve([recipes, app])
+        assert pbs == [recipes, app]
+        assert deferred == []
+
+    _write_pkg = TestInstallAll._write_pkg
+
+    def test_dependencies_first(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        base = PackageBuild("base," + self._write_pkg(tmp_path, "base"))
+        app = PackageBuild("app," + self._write_pkg(tmp_path, "app", ["base"]))
+        pbs, deferred = p.resolve([app, base])
+        assert pbs == [base, app]
+        assert deferred == []
+
+    def test_cycle(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        self._write_pkg(tmp_path, "left", ["right"])
+        self._write_pkg(tmp_path, "right", ["left"])
+        app = self._write_pkg(tmp_path, "app", ["left"])
+        with pytest.raises(util.BuildError, match="Dependency cycle between: left, right"):
+            p.resolve([PackageBuild("app," + app)])
+
+    def test_conflicting_defines(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        base = self._write_pkg(tmp_path, "base")
+        left = self._write_pkg(tmp_path, "left")
+        (tmp_path / "src" / "left" / "requirements.cget").write_text("base,{} -DFOO=1\n".format(base))
+        app = self._write_pkg(tmp_path, "app", ["left", "base"])
+        with pytest.raises(util.BuildError, match="Package base is asked for with (no defines and with FOO=1|FOO=1 and with no defines)"):
+            p.resolve([PackageBuild("app," + app)])
+
+    def test_inherited_defines_do_not_conflict(self, tmp_path):
+        p = CGetPrefix(str(tmp_path / "pfx"))
+        self._write_pkg(tmp_path, "base")
+        self._write_pkg(tmp_path, "left", ["base"])
+        self._write_pkg(tmp_path, "right", ["base"])
+        app = PackageBuild("app," + self._write_pkg(tmp_path, "app"))
+        (tmp_path / "src" / "app" / "requirements.cget").write_text("left,{0} -DX=1\nright,{1}\n".format(tmp_path / "src" / "left", tmp_path / "src" / "right"))
+        assert p.resolve([app]) == ([app], [])
@@ -1,10 +1,15 @@
 import os
+import errno
 import sys
 import json
 import shutil
+import stat
 import hashlib
+import io
 import tarfile
 import tempfile
+import threading
+import time
 import zipfile
 from unittest import mock
 
@@ -265,6 +270,15 @@ class TestSymlinkDir:
         assert os.path.islink(str(dst / "sub" / "b.txt"))
         assert open(str(dst / "a.txt")).read() == "hello"
 
+    @pytest.mark.skipif(os.name != 'posix', reason="symlinks need posix")
+    def test_returns_linked_paths(self, tmp_path):
+        src = tmp_path / "src"
+        (src / "sub").mkdir(parents=True)
+        (src / "a.txt").write_text("hello")
+        (src / "sub" / "b.txt").write_text("world")
+        files = util.symlink_dir(str(src), str(tmp_path / "dst"))
+        assert sorted(files) == ["a.txt", os.path.join("sub", "b.txt")]
+
 
 class TestCopyDir:
     def test_copies_files(self, tmp_path):
@@ -281,6 +295,66 @@ class TestCopyDir:
         assert (dst / "sub" / "b.txt").read_text() == "world"
         assert not os.path.islink(str(dst / "a.txt"))
 
+    def test_returns_copied_paths(self, tmp_path):
+        src = tmp_path / "src"
+        (src / "sub").mkdir(parents=True)
+        (src / "a.txt").write_text("hello")
+        (src / "sub" / "b.txt").write_text("world")
+        files = util.copy_dir(str(src), str(tmp_path / "dst"))
+        assert sorted(files) == ["a.txt", os.path.join("sub", "b.txt")]
+
+
+class TestShadowDir:
+    def _src(self, tmp_path):
+        src = tmp_path / "src"
+        (src / "sub").mkdir(parents=True)
+        (src / "empty").mkdir()
+        (src / "a.txt").write_text("hello")
+        (src / "sub" / "b.txt").write_text("world")
+        return src
+
+    @pytest.mark.skipif(os.name != 'posix', reason="needs posix links")
+    def test_hardlinks(self, tmp_path):
+        src = self._src(tmp_path)
+        os.symlink("a.txt", str(src / "link.txt"))
+        os.symlink("sub", str(src / "linkdir"))
+        dst = tmp_path / "dst"
+        files = util.shadow_dir(str(src), str(dst))
+        assert sorted(files) == ["a.txt", "link.txt", "linkdir", os.path.join("sub", "b.txt")]
+        assert os.path.samefile(str(dst / "a.txt"), str(src / "a.txt"))
+        assert not os.path.islink(str(dst / "a.txt"))
+        assert os.readlink(str(dst / "link.txt")) == "a.txt"
+        assert os.readlink(str(dst / "linkdir")) == "sub"
+        assert (dst / "empty").is_dir()
+
+    @pytest.mark.skipif(os.name != 'posix', reason="needs posix links")
+    def test_symlinks_when_hardlinks_fail(self, tmp_path):
+        src = self._src(tmp_path)
+        dst = tmp_path / "dst"
+        with mock.patch.object(util.os, 'link', side_effect=OSError(errno.EXDEV, "cross-device")) as link:
+            util.shadow_dir(str(src), str(dst), workers=1)
+        assert link.call_count == 1
+        assert os.readlink(str(dst / "sub" / "b.txt")) == str(src / "sub" / "b.txt")
+        assert (dst / "sub" / "b.txt").read_text() == "world"
+
+
+    @pytest.mark.skipif(os.name != 'posix', reason="needs posix links")
+    def test_copy(self, tmp_path):
+        src = self._src(tmp_path)
+        os.symlink("a.txt", str(src / "link.txt"))
+        dst = tmp_path / "dst"
+        util.shadow_dir(str(src), str(dst), copy=True)
+        assert not os.path.samefile(str(dst / "a.txt"), str(src / "a.txt"))
+        assert (dst / "sub" / "b.txt").read_text() == "world"
+        assert os.readlink(str(dst / "link.txt")) == "a.txt"
+
+    def test_links_protected_only_without_root(self, monkeypatch):
+        monkeypatch.setattr(util.os, 'name', 'posix')
+        monkeypatch.setattr(util.os, 'geteuid', lambda: 0, raising=False)
+        assert not util.can_protect_links()
+        monkeypatch.setattr(util.os, 'geteuid', lambda: 1000, raising=False)
+        assert util.can_protect_links()
+
 
 # ── readlink ─────────────────────────────────────────────────────────────────
 
@@ -435,6 +509,13 @@ class TestHashFile:
         expected = hashlib.md5(b"test").hexdigest()
         assert util.hash_file(str(f), "md5") == expected
 
+    def test_multiple_blocks(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'HASH_BLOCK_SIZE', 3)
+        f = tmp_path / "file.txt"
+        f.write_bytes(b"hello world")
+        expected = hashlib.sha256(b"hello world").hexdigest()
+        assert util.hash_file(str(f), "sha256") == expected
+
 
 class TestCheckHash:
     def test_matching_hash(self, tmp_path):
@@ -675,6 +756,39 @@ class TestTransferTo:
         assert not os.path.islink(result)
         assert open(result).read() == "data"
 
+    def _source(self, tmp_path):
+        src = tmp_path / "proj"
+        (src / "sub").mkdir(parents=True)
+        (src / "CMakeLists.txt").write_text("project(proj)")
+        (src / "sub" / "a.cpp").write_text("int a;")
+        (tmp_path / "shared.h").write_text("int b;")
+        if os.name == 'posix': (src / "shared.h").symlink_to("../shared.h")
+        dst = tmp_path / "dst"
+        dst.mkdir()
+        return src, dst
+
+    @pytest.mark.skipif(os.name != 'posix', reason="symlinks need posix")
+    def test_copy_dir_is_shadowed(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'USE_SYMLINKS', True)
+        src, dst = self._source(tmp_path)
+        result = util.transfer_to(str(src), str(dst), copy=True)
+        assert result == str(dst / "proj")
+        assert not os.path.islink(result)
+        assert os.path.samefile(os.path.join(result, "sub", "a.cpp"), str(src / "sub" / "a.cpp"))
+        # The link that leaves the tree still points to its file
+        assert open(os.path.join(result, "shared.h")).read() == "int b;"
+        # Replacing a file of the shadow leaves the source alone
+        os.remove(os.path.join(result, "CMakeLists.txt"))
+        with open(os.path.join(result, "CMakeLists.txt"), 'w') as f: f.write("custom")
+        assert (src / "CMakeLists.txt").read_text() == "project(proj)"
+
+    def test_copy_dir_without_symlinks(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'USE_SYMLINKS', False)
+        src, dst = self._source(tmp_path)
+        result = util.transfer_to(str(src), str(dst), copy=True)
+        assert os.stat(os.path.join(result, "sub", "a.cpp")).st_nlink == 1
+        assert open(os.path.join(result, "CMakeLists.txt")).read() == "project(proj)"
+
 
 # ── cache operations ─────────────────────────────────────────────────────────
 
@@ -814,6 +928,14 @@ class TestUrlRetrieve:
         # Reported at least once and propagated the total size
         assert calls and all(t == 8 for c, t in calls)
 
+    def test_updates_hasher(self, tmp_path):
+        dest = tmp_path / "out.txt"
+        response = self._fake_response(b"hello world", total=11)
+        h = hashlib.sha256()
+        with mock.patch.object(util.request, 'urlopen', return_value=response):
+            util.url_retrieve("http://example.com/file.txt", str(dest), hasher=h)
+        assert h.hexdigest() == hashlib.sha256(b"hello world").hexdigest()
+
 
 # ── download_to ──────────────────────────────────────────────────────────────
 
@@ -827,7 +949,7 @@ class TestDownloadTo:
         download_dir.mkdir()
         # Mock url_retrieve to copy the file instead of downloading
         with mock.patch.object(util, 'url_retrieve') as mock_retrieve:
-            def fake_retrieve(url, filename, reporthook=None, context=None):
+            def fake_retrieve(url, filename, **kwargs):
                 shutil.copy(str(src), filename)
             mock_retrieve.side_effect = fake_retrieve
             result = util.download_to("http://example.com/file.txt", str(download_dir))
@@ -858,7 +980,7 @@ class TestDownloadTo:
         download_dir = tmp_path / "dl"
         download_dir.mkdir()
         with mock.patch.object(util, 'url_retrieve') as mock_retrieve:
-            def fake_retrieve(url, filename, reporthook=None, context=None):
+            def fake_retrieve(url, filename, **kwargs):
                 shutil.copy(str(src), filename)
             mock_retrieve.side_effect = fake_retrieve
             # Should not raise with insecure=True
@@ -925,10 +1047,11 @@ class TestRetrieveUrl:
         content = b"downloaded data"
         h = hashlib.sha256(content).hexdigest()
         # Mock download_to
-        def fake_download(url, download_dir, insecure=False):
+        def fake_download(url, download_dir, insecure=False, hasher=None, extractor=None):
             f = os.path.join(download_dir, "pkg.tar.gz")
             with open(f, 'wb') as fh:
                 fh.write(content)
+            hasher.update(content)
             return f
         monkeypatch.setattr(util, 'download_to', fake_download)
         result = util.retrieve_url("https://example.com/pkg.tar.gz", str(dst), hash="sha256:" + h)
@@ -936,6 +1059,269 @@ class TestRetrieveUrl:
         # Verify it was cached
         assert os.path.exists(os.path.join(cache_dir, "sha256-" + h))
 
+    def test_remote_hash_is_not_computed_again(self, tmp_path, monkeypatch):
+        cache_dir = str(tmp_path / "cache")
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(cache_dir, *args))
+        dst = tmp_path / "dst"
+        dst.mkdir()
+        def fake_download(url, download_dir, insecure=False, hasher=None, extractor=None):
+            f = os.path.join(download_dir, "pkg.tar.gz")
+            with open(f, 'wb') as fh:
+                fh.write(b"tampered")
+            hasher.update(b"tampered")
+            return f
+        monkeypatch.setattr(util, 'download_to', fake_download)
+        h = hashlib.sha256(b"data").hexdigest()
+        with mock.patch.object(util, 'hash_file') as mock_hash:
+            with pytest.raises(util.BuildError, match="Hash doesn't match"):
+                util.retrieve_url("https://example.com/pkg.tar.gz", str(dst), hash="sha256:" + h)
+        mock_hash.assert_not_called()
+        assert not os.path.exists(os.path.join(cache_dir, "sha256-" + h))
+
+    def test_remote_uses_url_cache_with_same_hash(self, tmp_path, monkeypatch):
+        cache_dir = str(tmp_path / "cache")
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(cache_dir, *args))
+        monkeypatch.setattr(util, 'validated_urls', set())
+        dst = tmp_path / "dst"
+        dst.mkdir()
+        def fake_download(url, download_dir, insecure=False, hasher=None, headers=None, validators=None, extractor=None):
+            f = os.path.join(download_dir, "pkg.tar.gz")
+            with open(f, 'wb') as fh:
+                fh.write(b"data")
+            hasher.update(b"data")
+            return f
+        monkeypatch.setattr(util, 'download_to', fake_download)
+        cached = util.retrieve_url("https://example.com/pkg.tar.gz", str(dst))
+        monkeypatch.setattr(util, 'download_to', mock.Mock(side_effect=AssertionError))
+        h = hashlib.sha256(b"data").hexdigest()
+        assert util.retrieve_url("https://example.com/pkg.tar.gz", str(dst), hash="sha256:" + h) == cached
+
+
+# ── cache stats ──────────────────────────────────────────────────────────────
+
+class TestCacheStats:
+    def test_count(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path), *args))
+        assert util.get_cache_stats() == {'hits': 0, 'misses': 0}
+        assert util.count_cache("f") == "f"
+        util.count_cache(False)
+        util.count_cache(True)
+        assert util.get_cache_stats() == {'hits': 2, 'misses': 1}
+
+    def test_cache_hit_is_touched(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path), *args))
+        d = tmp_path / "sha256-abc"
+        d.mkdir()
+        (d / "pkg.tar.gz").write_text("x")
+        os.utime(str(d), (0, 0))
+        util.get_cache_file("sha256-abc")
+        assert os.stat(str(d)).st_mtime > 0
+
+
+# ── cache_lock ───────────────────────────────────────────────────────────────
+
+class TestCacheLock:
+    @pytest.fixture(autouse=True)
+    def cache(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path), *args))
+
+    def test_exclusive(self):
+        with util.cache_lock("k") as locked:
+            assert locked
+            with util.cache_lock("k", blocking=False) as other:
+                assert not other
+            with util.cache_lock("other", blocking=False) as other:
+                assert other
+        with util.cache_lock("k", blocking=False) as locked:
+            assert locked
+
+    def test_concurrent_downloads_are_deduplicated(self, tmp_path, monkeypatch):
+        content = b"data"
+        h = hashlib.sha256(content).hexdigest()
+        downloads = []
+        def fake_download(url, download_dir, insecure=False, hasher=None, extractor=None):
+            downloads.append(url)
+            time.sleep(0.2)
+            f = os.path.join(download_dir, "pkg.tar.gz")
+            with open(f, 'wb') as fh:
+                fh.write(content)
+            hasher.update(content)
+            return f
+        monkeypatch.setattr(util, 'download_to', fake_download)
+        results = []
+        def run(i):
+            dst = tmp_path / "dst{}".format(i)
+            dst.mkdir()
+            results.append(util.retrieve_url("https://example.com/pkg.tar.gz", str(dst), hash="sha256:" + h))
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(3)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        assert len(downloads) == 1
+        assert len(set(results)) == 1
+        assert util.get_cache_stats() == {'hits': 2, 'misses': 1}
+
+    def test_add_cache_file_keeps_first(self, tmp_path):
+        for content in [b"first", b"second"]:
+            f = tmp_path / "pkg.tar.gz"
+            f.write_bytes(content)
+            result = util.add_cache_file("sha256-abc", str(f))
+        assert open(result, 'rb').read() == b"first"
+        # No temporary entries are left behind
+        assert sorted(os.listdir(str(tmp_path))) == ["sha256-abc"]
+
+
+# ── HostLimiter / read_archive_file ──────────────────────────────────────────
+
+class TestHostLimiter:
+    def test_limit_per_host(self):
+        limiter = util.HostLimiter(2)
+        active = {'a': 0}
+        peak = []
+        lock = threading.Lock()
+        def run():
+            with limiter.connection("https://a.example.com/x.tar.gz"):
+                with lock:
+                    active['a'] += 1
+                    peak.append(active['a'])
+                time.sleep(0.05)
+                with lock: active['a'] -= 1
+        threads = [threading.Thread(target=run) for i in range(6)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        assert max(peak) == 2
+
+    def test_hosts_are_independent(self):
+        limiter = util.HostLimiter(1)
+        with limiter.connection("https://a.example.com/x"):
+            with limiter.connection("https://b.example.com/x"):
+                pass
+
+
+class TestReadArchiveFile:
+    def test_tar(self, tmp_path):
+        d = tmp_path / "pkg"
+        (d / "sub").mkdir(parents=True)
+        (d / "requirements.cget").write_text("dep\n")
+        (d / "sub" / "requirements.cget").write_text("nested\n")
+        archive = str(tmp_path / "pkg.tar.gz")
+        with tarfile.open(archive, "w:gz") as tar:
+            tar.add(str(d), arcname="pkg")
+        assert util.read_archive_file(archive, ["requirements.cget"]) == ("requirements.cget", b"dep\n")
+
+    def test_zip(self, tmp_path):
+        archive = str(tmp_path / "pkg.zip")
+        with zipfile.ZipFile(archive, "w") as z:
+            z.writestr("pkg/requirements.txt", "dep\n")
+        assert util.read_archive_file(archive, ["requirements.cget", "requirements.txt"]) == ("requirements.txt", b"dep\n")
+
+    def test_missing(self, tmp_path):
+        f = tmp_path / "header.h"
+        f.write_text("int x;")
+        assert util.read_archive_file(str(f), ["requirements.cget"]) == (None, None)
+
+
+# ── download_cached ──────────────────────────────────────────────────────────
+
+class TestIsImmutableUrl:
+    @pytest.mark.parametrize("url", [
+        "https://github.com/pfultz2/cget/archive/v0.2.0.tar.gz",
+        "https://github.com/boostorg/boost/archive/1.80.0.tar.gz",
+        "https://github.com/pfultz2/cget/archive/" + "a" * 40 + ".tar.gz",
+        "https://github.com/pfultz2/cget/archive/refs/tags/release.zip",
+        "https://github.com/pfultz2/cget/releases/download/v1/cget.tar.gz",
+    ])
+    def test_immutable(self, url):
+        assert util.is_immutable_url(url)
+
+    @pytest.mark.parametrize("url", [
+        "https://github.com/pfultz2/cget/archive/HEAD.tar.gz",
+        "https://github.com/pfultz2/cget/archive/master.tar.gz",
+        "https://example.com/pkg-1.0.tar.gz",
+    ])
+    def test_mutable(self, url):
+        assert not util.is_immutable_url(url)
+
+
+class TestDownloadCached:
+    URL = "https://example.com/pkg.tar.gz"
+
+    @pytest.fixture(autouse=True)
+    def cache(self, tmp_path, monkeypatch):
+        cache_dir = str(tmp_path / "cache")
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(cache_dir, *args))
+        monkeypatch.setattr(util, 'validated_urls', set())
+
+    def fake_download(self, content, validators=None, status=200):
+        calls = []
+        def f(url, download_dir, insecure=False, hasher=None, headers=None, validators=None, extractor=None):
+            calls.append(headers)
+            if status == 304: return None
+            if validators is not None: validators.update({'ETag': '"v1"'})
+            p = os.path.join(download_dir, url.split('/')[-1])
+            with open(p, 'wb') as fh:
+                fh.write(content)
+            return p
+        return f, calls
+
+    def test_revalidates_with_etag(self, tmp_path, monkeypatch):
+        dst = tmp_path / "dst"
+        dst.mkdir()
+        f, calls = self.fake_download(b"v1")
+        monkeypatch.setattr(util, 'download_to', f)
+        util.retrieve_url(self.URL, str(dst))
+        assert calls == [{}]
+
+        # The same process doesn't revalidate again
+        f, calls = self.fake_download(b"v2")
+        monkeypatch.setattr(util, 'download_to', f)
+        util.retrieve_url(self.URL, str(dst))
+        assert calls == []
+
+        util.validated_urls.clear()
+        f, calls = self.fake_download(b"v2", status=304)
+        monkeypatch.setattr(util, 'download_to', f)
+        result = util.retrieve_url(self.URL, str(dst))
+        assert calls == [{'If-None-Match': '"v1"'}]
+        assert open(result, 'rb').read() == b"v1"
+
+    def test_modified(self, tmp_path, monkeypatch):
+        dst = tmp_path / "dst"
+        dst.mkdir()
+        monkeypatch.setattr(util, 'download_to', self.fake_download(b"v1")[0])
+        util.retrieve_url(self.URL, str(dst))
+        util.validated_urls.clear()
+        monkeypatch.setattr(util, 'download_to', self.fake_download(b"v2")[0])
+        util.retrieve_url(self.URL, str(dst))
+        cached, meta = util.get_url_cache(self.URL)
+        assert open(cached, 'rb').read() == b"v2"
+
+    def test_immutable_is_not_revalidated(self, tmp_path, monkeypatch):
+        url = "https://github.com/pfultz2/cget/archive/v0.2.0.tar.gz"
+        dst = tmp_path / "dst"
+        dst.mkdir()
+        monkeypatch.setattr(util, 'download_to', self.fake_download(b"v1")[0])
+        util.retrieve_url(url, str(dst))
+        f, calls = self.fake_download(b"v2")
+        monkeypatch.setattr(util, 'download_to', f)
+        result = util.retrieve_url(url, str(dst))
+        assert calls == []
+        assert open(result, 'rb').read() == b"v1"
+
+    def test_offline_uses_cache(self, tmp_path, monkeypatch):
+        dst = tmp_path / "dst"
+        dst.mkdir()
+        monkeypatch.setattr(util, 'download_to', self.fake_download(b"v1")[0])
+        util.retrieve_url(self.URL, str(dst))
+        util.validated_urls.clear()
+        monkeypatch.setattr(util, 'download_to', mock.Mock(side_effect=util.error.URLError("offline")))
+        result = util.retrieve_url(self.URL, str(dst))
+        assert open(result, 'rb').read() == b"v1"
+
+    def test_not_modified_download_to(self, tmp_path):
+        err = util.error.HTTPError(self.URL, 304, "Not Modified", {}, None)
+        with mock.patch.object(util, 'url_retrieve', side_effect=err):
+            assert util.download_to(self.URL, str(tmp_path), headers={'If-None-Match': '"v1"'}) is None
+
 
 # ── extract_ar ───────────────────────────────────────────────────────────────
 
@@ -986,6 +1372,437 @@ class TestExtractAr:
         util.extract_ar(archive, str(dst))
         assert (dst / "proj" / "file.txt").exists()
 
+    def test_extract_tar_xz_and_plain_tar(self, tmp_path):
+        src = tmp_path / "archive_src"
+        src.mkdir()
+        (src / "file.txt").write_text("content")
+        for mode, name in [("w:xz", "test.tar.xz"), ("w", "test.tar")]:
+            archive = str(tmp_path / name)
+            with tarfile.open(archive, mode) as tar:
+                tar.add(str(src), arcname="proj")
+            dst = tmp_path / ("out-" + name)
+            dst.mkdir()
+            util.extract_ar(archive, str(dst))
+            assert (dst / "proj" / "file.txt").read_text() == "content"
+
+    def test_format_from_magic_bytes(self, tmp_path):
+        # Archives from urls often don't have an extension
+        archive = str(tmp_path / "download")
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr("proj/a.txt", "a")
+        assert util.get_archive_format(archive) == 'zip'
+        dst = tmp_path / "extracted"
+        dst.mkdir()
+        util.extract_ar(archive, str(dst))
+        assert (dst / "proj" / "a.txt").read_text() == "a"
+
+    def test_no_cmake_process(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'EXTRACT_BACKEND', 'cget')
+        archive = str(tmp_path / "test.tar.gz")
+        with tarfile.open(archive, "w:gz") as tar:
+            tar.add(str(tmp_path), arcname="proj", recursive=False)
+        with mock.patch.object(util, 'cmd') as cmd:
+            util.extract_ar(archive, str(tmp_path))
+        cmd.assert_not_called()
+
+    def test_cmake_backend(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'EXTRACT_BACKEND', 'cmake')
+        archive = str(tmp_path / "test.tar.gz")
+        with tarfile.open(archive, "w:gz") as tar:
+            tar.add(str(tmp_path), arcname="proj", recursive=False)
+        with mock.patch.object(util, 'which', return_value='cmake'), mock.patch.object(util, 'cmd') as cmd:
+            util.extract_ar(archive, str(tmp_path))
+        assert cmd.call_args[0][0] == ['cmake', '-E', 'tar', 'xf', archive]
+
+    def test_zstd_without_module_uses_cmake(self, tmp_path):
+        archive = tmp_path / "test.tar.zst"
+        archive.write_bytes(b'\x28\xb5\x2f\xfd' + b'\0' * 16)
+        with mock.patch.object(util, 'zstandard', None), mock.patch.object(util, 'which', return_value='cmake'), mock.patch.object(util, 'cmd') as cmd:
+            util.extract_ar(str(archive), str(tmp_path))
+        assert cmd.called
+
+    def test_zstd_without_module_or_cmake(self, tmp_path):
+        archive = tmp_path / "test.tar.zst"
+        archive.write_bytes(b'\x28\xb5\x2f\xfd' + b'\0' * 16)
+        with mock.patch.object(util, 'zstandard', None), mock.patch.object(util, 'which', return_value=None):
+            with pytest.raises(util.BuildError):
+                util.extract_ar(str(archive), str(tmp_path))
+
+    @pytest.mark.skipif(os.name != 'posix', reason="needs posix permissions")
+    def test_extract_zip_in_parallel(self, tmp_path):
+        archive = str(tmp_path / "test.zip")
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for i in range(50):
+                zf.writestr("proj/d{}/f{}.txt".format(i % 5, i), "x" * i)
+            script = zipfile.ZipInfo("proj/configure")
+            script.external_attr = (stat.S_IFREG | 0o755) << 16
+            zf.writestr(script, "#!/bin/sh")
+            link = zipfile.ZipInfo("proj/link")
+            link.external_attr = (stat.S_IFLNK | 0o777) << 16
+            zf.writestr(link, "configure")
+        dst = tmp_path / "extracted"
+        dst.mkdir()
+        util.extract_zip(archive, str(dst), workers=4)
+        assert (dst / "proj" / "d4" / "f49.txt").read_text() == "x" * 49
+        assert os.access(str(dst / "proj" / "configure"), os.X_OK)
+        assert os.readlink(str(dst / "proj" / "link")) == "configure"
+
+    @pytest.mark.parametrize("name", ["../escape.txt", "/abs/file", "a/../../b"])
+    def test_member_outside_destination(self, tmp_path, name):
+        with pytest.raises(util.BuildError):
+            util.get_member_path(str(tmp_path), name)
+
+
+class TestExtractTar:
+    def _extract(self, tmp_path, build, mode="w:gz", fmt="gz"):
+        archive = str(tmp_path / "test.tar")
+        with tarfile.open(archive, mode) as tar:
+            build(tar)
+        dst = tmp_path / "extracted"
+        dst.mkdir()
+        util.extract_tar(archive, str(dst), fmt)
+        return dst
+
+    def _add(self, tar, name, content=b"", **kwargs):
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        for key, value in kwargs.items(): setattr(info, key, value)
+        tar.addfile(info, io.BytesIO(content))
+
+    def test_same_as_tarfile(self, tmp_path):
+        src = tmp_path / "src"
+        for i in range(20):
+            (src / "d{}".format(i % 3)).mkdir(parents=True, exist_ok=True)
+            (src / "d{}".format(i % 3) / "f{}.txt".format(i)).write_text("y" * (i * 700))
+        dst = self._extract(tmp_path, lambda tar: tar.add(str(src), arcname="proj"))
+        for i in range(20):
+            assert (dst / "proj" / "d{}".format(i % 3) / "f{}.txt".format(i)).read_text() == "y" * (i * 700)
+
+    @pytest.mark.parametrize("mode,fmt", [("w", "tar"), ("w:bz2", "bz2"), ("w:xz", "xz")])
+    def test_formats(self, tmp_path, mode, fmt):
+        dst = self._extract(tmp_path, lambda tar: self._add(tar, "proj/a.txt", b"a"), mode, fmt)
+        assert (dst / "proj" / "a.txt").read_text() == "a"
+
+    @pytest.mark.parametrize("format", [tarfile.PAX_FORMAT, tarfile.GNU_FORMAT, tarfile.USTAR_FORMAT])
+    def test_long_names(self, tmp_path, format):
+        name = "proj/" + "/".join(["directory{}".format(i) for i in range(15)]) + "/file.txt"
+        if format == tarfile.USTAR_FORMAT: name = name[:240]
+        archive = str(tmp_path / "test.tar")
+        with tarfile.open(archive, "w", format=format) as tar:
+            self._add(tar, name, b"long")
+        dst = tmp_path / "extracted"
+        dst.mkdir()
+        util.extract_tar(archive, str(dst))
+        assert (dst / name).read_text() == "long"
+
+    @pytest.mark.skipif(os.name != 'posix', reason="needs posix links")
+    def test_links_and_modes(self, tmp_path):
+        def build(tar):
+            self._add(tar, "proj/configure", b"#!/bin/sh", mode=0o755, mtime=1000000)
+            self._add(tar, "proj/link", type=tarfile.SYMTYPE, linkname="configure")
+            self._add(tar, "proj/hard", type=tarfile.LNKTYPE, linkname="proj/configure")
+        dst = self._extract(tmp_path, build)
+        assert os.access(str(dst / "proj" / "configure"), os.X_OK)
+        assert os.path.getmtime(str(dst / "proj" / "configure")) == 1000000
+        assert os.readlink(str(dst / "proj" / "link")) == "configure"
+        assert (dst / "proj" / "hard").read_text() == "#!/bin/sh"
+
+    def test_outside_destination(self, tmp_path):
+        with pytest.raises(util.BuildError):
+            self._extract(tmp_path, lambda tar: self._add(tar, "../escape.txt", b"x"))
+        assert not (tmp_path / "escape.txt").exists()
+
+    @pytest.mark.skipif(os.name != 'posix', reason="needs posix links")
+    def test_through_symlink_outside_destination(self, tmp_path):
+        outside = tmp_path / "outside"
+        outside.mkdir()
+        def build(tar):
+            self._add(tar, "proj/out", type=tarfile.SYMTYPE, linkname=str(outside))
+            self._add(tar, "proj/out/escape.txt", b"x")
+        with pytest.raises(util.BuildError):
+            self._extract(tmp_path, build)
+        assert not (outside / "escape.txt").exists()
+
+    @pytest.mark.skipif(os.name != 'posix', reason="needs posix links")
+    def test_hardlink_through_symlink_outside_destination(self, tmp_path):
+        outside = tmp_path / "outside"
+        outside.mkdir()
+        (outside / "s.txt").write_text("secret")
+        def build(tar):
+            self._add(tar, "install/evil", type=tarfile.SYMTYPE, linkname=str(outside))
+            self._add(tar, "install/leak.txt", type=tarfile.LNKTYPE, linkname="install/evil/s.txt")
+        with pytest.raises(util.BuildError):
+            self._extract(tmp_path, build)
+        assert not (tmp_path / "extracted" / "install" / "leak.txt").exists()
+
+    @pytest.mark.skipif(os.name != 'posix', reason="needs posix links")
+    def test_hardlink_to_symlink(self, tmp_path):
+        def build(tar):
+            self._add(tar, "proj/link", type=tarfile.SYMTYPE, linkname="/etc/hostname")
+            self._add(tar, "proj/hard", type=tarfile.LNKTYPE, linkname="proj/link")
+        dst = self._extract(tmp_path, build)
+        assert os.readlink(str(dst / "proj" / "hard")) == "/etc/hostname"
+
+    def test_truncated(self, tmp_path):
+        archive = tmp_path / "test.tar"
+        with tarfile.open(str(archive), "w") as tar:
+            self._add(tar, "proj/a.txt", b"a" * 5000)
+        archive.write_bytes(archive.read_bytes()[:2048])
+        with pytest.raises(util.BuildError):
+            util.extract_tar(str(archive), str(tmp_path))
+
+
+class TestExtractBackend:
+    def test_explicit_backend(self, monkeypatch):
+        monkeypatch.setattr(util, 'EXTRACT_BACKEND', 'cmake')
+        with mock.patch.object(util, 'which', return_value='cmake'):
+            assert util.get_extract_backend('gz') == 'cmake'
+
+    def test_only_backend(self, monkeypatch):
+        monkeypatch.setattr(util, 'EXTRACT_BACKEND', 'auto')
+        with mock.patch.object(util, 'which', return_value=None):
+            assert util.get_extract_backend('gz') == 'cget'
+
+    def test_benchmark_picks_fastest(self, monkeypatch):
+        def slow(archive, dst, fmt): time.sleep(0.2)
+        monkeypatch.setitem(util.EXTRACT_BACKENDS, 'cmake', slow)
+        assert util.benchmark_extract('gz', ['cget', 'cmake']) == 'cget'
+        monkeypatch.setitem(util.EXTRACT_BACKENDS, 'cget', slow)
+        monkeypatch.setitem(util.EXTRACT_BACKENDS, 'cmake', lambda archive, dst, fmt: None)
+        assert util.benchmark_extract('zip', ['cget', 'cmake']) == 'cmake'
+
+    def test_choice_is_saved(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path), *args))
+        monkeypatch.setattr(util, 'extract_choices', {})
+        with mock.patch.object(util, 'benchmark_extract', return_value='cmake') as benchmark:
+            assert util.choose_extract_backend('gz', ['cget', 'cmake']) == 'cmake'
+            util.extract_choices.clear()
+            assert util.choose_extract_backend('gz', ['cget', 'cmake']) == 'cmake'
+        assert benchmark.call_count == 1
+        with mock.patch.object(util, 'get_extract_choices_key', return_value='other'), \
+             mock.patch.object(util, 'benchmark_extract', return_value='cget') as benchmark:
+            util.extract_choices.clear()
+            assert util.choose_extract_backend('gz', ['cget', 'cmake']) == 'cget'
+        assert benchmark.call_count == 1
+
+    @pytest.mark.parametrize("fmt", ["gz", "zip"])
+    def test_sample_archive(self, tmp_path, fmt):
+        archive = util.write_sample_archive(str(tmp_path), fmt)
+        assert util.get_archive_format(archive) == fmt
+        util.extract_in_process(archive, str(tmp_path / "out"), fmt)
+        assert len(os.listdir(str(tmp_path / "out" / "sample"))) == 100
+
+
+class TestSourceCache:
+    @pytest.fixture(autouse=True)
+    def cache(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path / "cache"), *args))
+
+    def _archive(self, tmp_path):
+        src = tmp_path / "src"
+        src.mkdir()
+        (src / "a.txt").write_text("a")
+        archive = str(tmp_path / "pkg.tar.gz")
+        with tarfile.open(archive, "w:gz") as tar:
+            tar.add(str(src), arcname="proj")
+        return archive
+
+    def test_missing(self):
+        assert util.get_source_tree("sha256:abc") is None
+
+    def test_extracted_once(self, tmp_path):
+        archive = self._archive(tmp_path)
+        with mock.patch.object(util, 'extract_ar', wraps=util.extract_ar) as extract:
+            tree = util.add_source_tree("SHA256:ABC", archive)
+            assert util.add_source_tree("sha256:abc", archive) == tree
+        assert extract.call_count == 1
+        assert util.get_source_tree("sha256:abc") == tree
+        assert os.path.basename(tree) == "sha256-abc"
+        assert (tmp_path / "cache" / "src" / "sha256-abc" / "proj" / "a.txt").read_text() == "a"
+        assert os.listdir(str(tmp_path / "cache" / "src")) == ["sha256-abc"]
+
+    @pytest.mark.skipif(os.name != 'posix', reason="needs posix permissions")
+    def test_read_only(self, tmp_path):
+        tree = util.add_source_tree("sha256:abc", self._archive(tmp_path))
+        assert not os.stat(os.path.join(tree, "proj", "a.txt")).st_mode & 0o222
+
+    def test_failed_extraction_is_not_cached(self, tmp_path):
+        with mock.patch.object(util, 'extract_ar', side_effect=util.BuildError("bad")):
+            with pytest.raises(util.BuildError):
+                util.add_source_tree("sha256:abc", self._archive(tmp_path))
+        assert util.get_source_tree("sha256:abc") is None
+        assert os.listdir(str(tmp_path / "cache" / "src")) == []
+
+
+class TestFastArchive:
+    @pytest.fixture(autouse=True)
+    def cache(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path / "cache"), *args))
+        monkeypatch.setattr(util, 'RECOMPRESS_CACHE', 'tar')
+
+    def _archive(self, tmp_path, mode="w:xz", files=20, size=200):
+        src = tmp_path / "src"
+        src.mkdir(exist_ok=True)
+        for i in range(files): (src / "f{}.txt".format(i)).write_text("".join("int x{0}_{1} = {1};\n".format(i, j * 7919 % 104729) for j in range(size)))
+        archive = str(tmp_path / "pkg.tar.xz")
+        with tarfile.open(archive, mode) as tar:
+            tar.add(str(src), arcname="proj")
+        with open(archive, 'rb') as f:
+            h = hashlib.sha256(f.read()).hexdigest()
+        return archive, h
+
+    def _cached(self, tmp_path, **kwargs):
+        archive, h = self._archive(tmp_path, **kwargs)
+        return util.add_cache_file("sha256-" + h, archive), h
+
+    def test_recompressed_once(self, tmp_path):
+        f, h = self._cached(tmp_path)
+        fast = util.get_fast_archive(f)
+        assert fast != f
+        assert util.get_archive_format(fast) == 'tar'
+        with open(os.path.join(os.path.dirname(fast), "meta.json")) as m:
+            assert json.load(m) == {'source': 'pkg.tar.xz', 'hash': 'sha256:' + h, 'file': 'archive.tar', 'format': 'tar'}
+        with mock.patch.object(util, 'recompress_archive') as recompress:
+            assert util.get_fast_archive(f) == fast
+        recompress.assert_not_called()
+        # The original is still found by its hash
+        assert util.get_cache_file("sha256-" + h) == f
+        assert util.check_hash(f, "sha256:" + h)
+        dst = tmp_path / "out"
+        util.extract_ar(fast, str(dst))
+        assert (dst / "proj" / "f3.txt").read_text() == (tmp_path / "src" / "f3.txt").read_text()
+
+    def test_url_entry(self, tmp_path):
+        archive, h = self._archive(tmp_path)
+        f = util.add_url_cache_file("https://example.com/pkg.tar.xz", archive, {}, sha256=h)
+        fast = util.get_fast_archive(f)
+        with open(os.path.join(os.path.dirname(fast), "meta.json")) as m:
+            assert json.load(m)['hash'] == 'sha256:' + h
+
+    def test_disabled(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'RECOMPRESS_CACHE', '')
+        f, h = self._cached(tmp_path)
+        assert util.get_fast_archive(f) == f
+        assert not os.path.exists(os.path.join(os.path.dirname(f), "fast"))
+
+    def test_not_cached(self, tmp_path):
+        archive, h = self._archive(tmp_path)
+        assert util.get_fast_archive(archive) == archive
+        assert not (tmp_path / "fast").exists()
+
+    def test_zip_is_kept(self, tmp_path):
+        archive = str(tmp_path / "pkg.zip")
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr("proj/a.txt", "a")
+        f = util.add_cache_file("sha256-abc", archive)
+        assert util.get_fast_archive(f) == f
+
+    def test_zstd(self, tmp_path, monkeypatch):
+        if not util.can_decompress('zst'): pytest.skip("needs zstd")
+        monkeypatch.setattr(util, 'RECOMPRESS_CACHE', 'zstd')
+        f, h = self._cached(tmp_path)
+        fast = util.get_fast_archive(f)
+        assert util.get_archive_format(fast) == 'zst'
+        util.extract_tar(fast, str(tmp_path / "out"), 'zst')
+        assert (tmp_path / "out" / "proj" / "f0.txt").exists()
+
+    def test_extracts_same_files(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(util, 'EXTRACT_BACKEND', 'cget')
+        f, h = self._cached(tmp_path)
+        fast = util.get_fast_archive(f)
+        util.extract_ar(f, str(tmp_path / "original"))
+        util.extract_ar(fast, str(tmp_path / "recompressed"))
+        for i in range(20):
+            name = os.path.join("proj", "f{}.txt".format(i))
+            assert (tmp_path / "recompressed" / name).read_text() == (tmp_path / "original" / name).read_text()
+
+
+class TestStreamExtractor:
+    def _tarball(self, tmp_path, mode="w:gz"):
+        src = tmp_path / "src"
+        src.mkdir()
+        for i in range(30): (src / "f{}.txt".format(i)).write_text("z" * (i * 500))
+        archive = tmp_path / "pkg.tar.gz"
+        with tarfile.open(str(archive), mode) as tar:
+            tar.add(str(src), arcname="proj")
+        return archive.read_bytes()
+
+    def _write(self, extractor, data, block=1000):
+        for i in range(0, len(data), block): extractor.write(data[i:i + block])
+
+    def test_extracts_while_writing(self, tmp_path):
+        data = self._tarball(tmp_path)
+        dst = tmp_path / "top"
+        dst.mkdir()
+        with util.StreamExtractor(str(dst), limit=2) as extractor:
+            self._write(extractor, data)
+            extractor.close()
+            assert extractor.finish()
+        assert sorted(os.listdir(str(dst))) == ["proj"]
+        assert (dst / "proj" / "f29.txt").read_text() == "z" * (29 * 500)
+
+    def test_zip_is_not_streamed(self, tmp_path):
+        archive = tmp_path / "pkg.zip"
+        with zipfile.ZipFile(str(archive), 'w') as zf:
+            zf.writestr("proj/a.txt", "a" * 5000)
+        dst = tmp_path / "top"
+        dst.mkdir()
+        with util.StreamExtractor(str(dst), limit=1) as extractor:
+            self._write(extractor, archive.read_bytes(), block=100)
+            extractor.close()
+            assert not extractor.finish()
+        assert os.listdir(str(dst)) == []
+
+    def test_incomplete_download_is_removed(self, tmp_path):
+        data = self._tarball(tmp_path)
+        dst = tmp_path / "top"
+        dst.mkdir()
+        with util.StreamExtractor(str(dst), limit=1) as extractor:
+            self._write(extractor, data[:len(data) // 2])
+            assert not extractor.finish()
+        assert os.listdir(str(dst)) == []
+
+    def test_padding_after_end_of_archive(self, tmp_path):
+        data = self._tarball(tmp_path, mode="w") + b"\0" * (2 * 1024 * 1024)
+        dst = tmp_path / "top"
+        dst.mkdir()
+        with util.StreamExtractor(str(dst), limit=2) as extractor:
+            self._write(extractor, data, block=8192)
+            extractor.close()
+            assert extractor.finish()
+        assert (dst / "proj" / "f29.txt").read_text() == "z" * (29 * 500)
+
+    def test_not_used(self, tmp_path):
+        with util.StreamExtractor(str(tmp_path)) as extractor:
+            assert not extractor.finish()
+
+    def _retrieve(self, tmp_path, monkeypatch, data, hash):
+        monkeypatch.setattr(util, 'get_cache_path', lambda *args: os.path.join(str(tmp_path / "cache"), *args))
+        chunks = [data[i:i + 8192] for i in range(0, len(data), 8192)]
+        response = mock.MagicMock()
+        response.headers.get.return_value = str(len(data))
+        response.read.side_effect = chunks + [b""]
+        dst = tmp_path / "top"
+        dst.mkdir()
+        with mock.patch.object(util.request, 'urlopen', return_value=response):
+            with util.StreamExtractor(str(dst)) as extractor:
+                f = util.retrieve_url("https://example.com/pkg.tar.gz", str(dst), hash=hash, extractor=extractor)
+                assert extractor.finish()
+        return dst, f
+
+    def test_retrieve_url(self, tmp_path, monkeypatch):
+        data = self._tarball(tmp_path)
+        dst, f = self._retrieve(tmp_path, monkeypatch, data, "sha256:" + hashlib.sha256(data).hexdigest())
+        assert os.listdir(str(dst)) == ["proj"]
+        with open(f, 'rb') as fh:
+            assert fh.read() == data
+
+    def test_hash_mismatch_rolls_back(self, tmp_path, monkeypatch):
+        data = self._tarball(tmp_path)
+        with pytest.raises(util.BuildError, match="Hash doesn't match"):
+            self._retrieve(tmp_path, monkeypatch, data, "sha256:" + "0" * 64)
+        assert os.listdir(str(tmp_path / "top")) == []
+
 
 # ── rm_symlink_from ──────────────────────────────────────────────────────────
 
@@ -1022,6 +1839,61 @@ class TestRmSymlinkFrom:
         util.rm_symlink_from(str(pkg_install), str(prefix))
         assert (lib_dir / "libbar.so").exists()
 
+    @pytest.mark.skipif(os.name != 'posix', reason="symlinks need posix")
+    def test_removes_folded_dirs(self, tmp_path):
+        pkg_install = tmp_path / "pkg" / "install"
+        (pkg_install / "include" / "foo").mkdir(parents=True)
+        (pkg_install / "include" / "foo" / "a.h").write_text("a")
+        prefix = tmp_path / "prefix"
+        util.symlink_dir(str(pkg_install), str(prefix), fold=True)
+        util.rm_symlink_from(str(pkg_install), str(prefix))
+        assert not os.path.lexists(str(prefix / "include" / "foo"))
+
+
+# ── rm_prefix_files / rm_empty_parents ───────────────────────────────────────
+
+class TestRmPrefixFiles:
+    @pytest.mark.skipif(os.name != 'posix', reason="symlinks need posix")
+    def test_keeps_links_replaced_by_other_packages(self, tmp_path):
+        pkg = tmp_path / "pkg" / "install"
+        other = tmp_path / "other" / "install"
+        for d in [pkg, other]:
+            d.mkdir(parents=True)
+            (d / "a.txt").write_text("a")
+            (d / "b.txt").write_text("b")
+        prefix = tmp_path / "prefix"
+        prefix.mkdir()
+        os.symlink(str(pkg / "a.txt"), str(prefix / "a.txt"))
+        os.symlink(str(other / "b.txt"), str(prefix / "b.txt"))
+        util.rm_prefix_files(str(prefix), ["a.txt", "b.txt"], src=str(pkg))
+        assert not os.path.lexists(str(prefix / "a.txt"))
+        assert os.path.islink(str(prefix / "b.txt"))
+
+    def test_removes_copies_and_ignores_missing(self, tmp_path):
+        prefix = tmp_path / "prefix"
+        prefix.mkdir()
+        (prefix / "a.txt").write_text("a")
+        util.rm_prefix_files(str(prefix), ["a.txt", "missing.txt"])
+        assert not (prefix / "a.txt").exists()
+
+    def test_outside_prefix(self, tmp_path):
+        with pytest.raises(util.BuildError):
+            util.rm_prefix_files(str(tmp_path), [os.path.join("..", "a.txt")])
+
+
+class TestRmEmptyParents:
+    def test_only_prunes_affected_dirs(self, tmp_path):
+        (tmp_path / "include" / "foo" / "detail").mkdir(parents=True)
+        (tmp_path / "lib").mkdir()
+        (tmp_path / "share" / "empty").mkdir(parents=True)
+        (tmp_path / "lib" / "libbar.a").write_text("bar")
+        util.rm_empty_parents(str(tmp_path), [os.path.join("include", "foo", "detail", "x.h"), os.path.join("lib", "libfoo.a")])
+        assert not (tmp_path / "include").exists()
+        assert (tmp_path / "lib" / "libbar.a").exists()
+        # Directories not touched by the paths are left alone
+        assert (tmp_path / "share" / "empty").exists()
+        assert tmp_path.exists()
+
 
 # ── rm_empty_dirs (additional) ───────────────────────────────────────────────
 
@@ -1078,6 +1950,82 @@ class TestRmDupDirAdditional:
         assert not (prefix / "sub" / "file.txt").exists()
 
 
+    def test_link_mode_keeps_replaced_files(self, tmp_path):
+        pkg = tmp_path / "pkg"
+        pkg.mkdir()
+        (pkg / "a.txt").write_text("a")
+        (pkg / "b.txt").write_text("b")
+        prefix = tmp_path / "prefix"
+        util.copy_dir(str(pkg), str(prefix), mode='hardlink')
+        # Another package replaced b.txt
+        os.remove(str(prefix / "b.txt"))
+        (prefix / "b.txt").write_text("other package")
+        util.rm_dup_dir(str(pkg), str(prefix), remove_both=False, mode='hardlink')
+        assert not (prefix / "a.txt").exists()
+        assert (prefix / "b.txt").read_text() == "other package"
+
+
+# ── link_file / copy_dir link modes ─────────────────────────────────────────
+
+class TestLinkFile:
+    def test_copy(self, tmp_path):
+        (tmp_path / "a.txt").write_text("a")
+        util.link_file(str(tmp_path / "a.txt"), str(tmp_path / "b.txt"))
+        assert (tmp_path / "b.txt").read_text() == "a"
+        assert not os.path.samefile(str(tmp_path / "a.txt"), str(tmp_path / "b.txt"))
+
+    @pytest.mark.skipif(not hasattr(os, 'link'), reason="needs hardlinks")
+    def test_hardlink(self, tmp_path):
+        (tmp_path / "a.txt").write_text("a")
+        util.link_file(str(tmp_path / "a.txt"), str(tmp_path / "b.txt"), mode='hardlink')
+        assert os.path.samefile(str(tmp_path / "a.txt"), str(tmp_path / "b.txt"))
+
+    def test_reflink_falls_back_to_copy(self, tmp_path):
+        (tmp_path / "a.txt").write_text("a" * 10000)
+        util.link_file(str(tmp_path / "a.txt"), str(tmp_path / "b.txt"), mode='reflink')
+        assert (tmp_path / "b.txt").read_text() == "a" * 10000
+        assert util.is_dup_file(str(tmp_path / "a.txt"), str(tmp_path / "b.txt"))
+
+    def test_unsupported_method_not_retried(self, tmp_path, monkeypatch):
+        calls = []
+        def cross_device(src, dst):
+            calls.append(src)
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        monkeypatch.setitem(util.LINK_METHODS, 'hardlink', [cross_device])
+        unsupported = set()
+        for name in ["a.txt", "b.txt"]:
+            (tmp_path / name).write_text(name)
+            util.link_file(str(tmp_path / name), str(tmp_path / ("copy-" + name)), mode='hardlink', unsupported=unsupported)
+            assert (tmp_path / ("copy-" + name)).read_text() == name
+        assert len(calls) == 1
+
+    def test_unknown_mode(self, tmp_path):
+        (tmp_path / "a.txt").write_text("a")
+        with pytest.raises(util.BuildError):
+            util.link_file(str(tmp_path / "a.txt"), str(tmp_path / "b.txt"), mode='bogus')
+
+    @pytest.mark.skipif(not hasattr(os, 'link'), reason="needs hardlinks")
+    def test_copy_dir_hardlinks(self, tmp_path):
+        src = tmp_path / "src"
+        (src / "sub").mkdir(parents=True)
+        (src / "sub" / "a.txt").write_text("a")
+        util.copy_dir(str(src), str(tmp_path / "dst"), mode='hardlink')
+        assert os.path.samefile(str(src / "sub" / "a.txt"), str(tmp_path / "dst" / "sub" / "a.txt"))
+
+    def test_rm_prefix_files_keeps_replaced_files(self, tmp_path):
+        src = tmp_path / "src"
+        src.mkdir()
+        (src / "a.txt").write_text("a")
+        (src / "b.txt").write_text("b")
+        prefix = tmp_path / "prefix"
+        files = util.copy_dir(str(src), str(prefix), mode='reflink')
+        os.remove(str(prefix / "b.txt"))
+        (prefix / "b.txt").write_text("replaced")
+        util.rm_prefix_files(str(prefix), files, src=str(src), mode='reflink')
+        assert not (prefix / "a.txt").exists()
+        assert (prefix / "b.txt").exists()
+
+
 # ── transfer_to (additional) ────────────────────────────────────────────────
 
 class TestTransferToAdditional:
@@ -1277,6 +2225,83 @@ class TestSymlinkDirAdditional:
         assert open(str(dst / "a" / "b" / "c" / "deep.txt")).read() == "deep"
 
 
+    @pytest.mark.skipif(os.name != 'posix', reason="symlinks need posix")
+    def test_links_symlinked_dirs(self, tmp_path):
+        src = tmp_path / "src"
+        (src / "real").mkdir(parents=True)
+        (src / "real" / "a.txt").write_text("a")
+        os.symlink("real", str(src / "alias"))
+        files = util.symlink_dir(str(src), str(tmp_path / "dst"))
+        assert sorted(files) == ["alias", os.path.join("real", "a.txt")]
+        assert os.path.islink(str(tmp_path / "dst" / "alias"))
+        assert (tmp_path / "dst" / "alias" / "a.txt").read_text() == "a"
+
+    @pytest.mark.skipif(os.name != 'posix', reason="symlinks need posix")
+    def test_many_files_with_workers(self, tmp_path):
+        src = tmp_path / "src"
+        for d in range(4):
+            (src / "d{}".format(d)).mkdir(parents=True)
+            for i in range(200):
+                (src / "d{}".format(d) / "f{}.h".format(i)).write_text(str(i))
+        files = util.symlink_dir(str(src), str(tmp_path / "dst"), workers=4)
+        assert len(files) == 800
+        assert (tmp_path / "dst" / "d3" / "f199.h").read_text() == "199"
+
+    @pytest.mark.skipif(os.name != 'posix', reason="symlinks need posix")
+    def test_existing_file(self, tmp_path):
+        src = tmp_path / "src"
+        src.mkdir()
+        (src / "a.txt").write_text("a")
+        dst = tmp_path / "dst"
+        dst.mkdir()
+        (dst / "a.txt").write_text("other")
+        with pytest.raises(util.BuildError):
+            util.symlink_dir(str(src), str(dst))
+
+
+    @pytest.mark.skipif(os.name != 'posix', reason="symlinks need posix")
+    def test_fold(self, tmp_path):
+        src = tmp_path / "src"
+        (src / "include" / "foo" / "detail").mkdir(parents=True)
+        (src / "include" / "foo" / "a.h").write_text("a")
+        (src / "include" / "foo" / "detail" / "b.h").write_text("b")
+        dst = tmp_path / "dst"
+        files = util.symlink_dir(str(src), str(dst), fold=True)
+        # The top level directories are never folded
+        assert files == [os.path.join("include", "foo")]
+        assert not os.path.islink(str(dst / "include"))
+        assert os.path.islink(str(dst / "include" / "foo"))
+        assert (dst / "include" / "foo" / "detail" / "b.h").read_text() == "b"
+
+    @pytest.mark.skipif(os.name != 'posix', reason="symlinks need posix")
+    def test_unfold(self, tmp_path):
+        dst = tmp_path / "dst"
+        for name in ["a", "b"]:
+            (tmp_path / name / "include" / "foo").mkdir(parents=True)
+            (tmp_path / name / "include" / "foo" / (name + ".h")).write_text(name)
+        unfolded = []
+        util.symlink_dir(str(tmp_path / "a"), str(dst), fold=True)
+        files = util.symlink_dir(str(tmp_path / "b"), str(dst), fold=True, on_unfold=lambda *args: unfolded.append(args))
+        assert files == [os.path.join("include", "foo", "b.h")]
+        assert unfolded == [(os.path.join("include", "foo"), str(tmp_path / "a" / "include" / "foo"), [os.path.join("include", "foo", "a.h")])]
+        assert not os.path.islink(str(dst / "include" / "foo"))
+        assert (dst / "include" / "foo" / "a.h").read_text() == "a"
+        assert (dst / "include" / "foo" / "b.h").read_text() == "b"
+
+    @pytest.mark.skipif(os.name != 'posix', reason="symlinks need posix")
+    def test_unfold_without_fold(self, tmp_path):
+        # Folded directories are unfolded even when not folding, so files
+        # are never added to the directory of another package
+        dst = tmp_path / "dst"
+        for name in ["a", "b"]:
+            (tmp_path / name / "include" / "foo").mkdir(parents=True)
+            (tmp_path / name / "include" / "foo" / (name + ".h")).write_text(name)
+        util.symlink_dir(str(tmp_path / "a"), str(dst), fold=True)
+        util.symlink_dir(str(tmp_path / "b"), str(dst))
+        assert not (tmp_path / "a" / "include" / "foo" / "b.h").exists()
+        assert (dst / "include" / "foo" / "b.h").read_text() == "b"
+
+
 # ── copy_dir (additional) ───────────────────────────────────────────────────
 
 class TestCopyDirAdditional:
@@ -1297,3 +2322,133 @@ class TestCopyDirAdditional:
         dst.mkdir()
         util.copy_dir(str(src), str(dst))
         assert len(list(os.listdir(str(dst)))) == 5
+
+    @pytest.mark.skipif(os.name != 'posix', reason="symlinks need posix")
+    def test_skips_symlinked_dirs(self, tmp_path):
+        src = tmp_path / "src"
+        (src / "real").mkdir(parents=True)
+        (src / "real" / "a.txt").write_text("a")
+        (src / "b.txt").write_text("b")
+        os.symlink("real", str(src / "alias"))
+        os.symlink("b.txt", str(src / "c.txt"))
+        files = util.copy_dir(str(src), str(tmp_path / "dst"), workers=2)
+        assert sorted(files) == ["b.txt", "c.txt", os.path.join("real", "a.txt")]
+        assert not os.path.exists(str(tmp_path / "dst" / "alias"))
+        assert not os.path.islink(str(tmp_path / "dst" / "c.txt"))
+
+    def test_missing_src(self, tmp_path):
+        assert util.copy_dir(str(tmp_path / "missing"), str(tmp_path / "dst")) == []
+
+
+# ── cgroup / job count ──────────────────────────────────────────────────────
+
+class TestParseSize:
+    @pytest.mark.parametrize("s,n", [("1024", 1024), ("2K", 2048), ("1G", 1024**3), ("1.5GB", int(1.5 * 1024**3))])
+    def test_sizes(self, s, n):
+        assert util.parse_size(s) == n
+
+
+class TestCgroup:
+    def _proc(self, tmp_path, content):
+        p = tmp_path / "cgroup"
+        p.write_text(content)
+        return str(p)
+
+    def test_v2_cpu_quota(self, tmp_path):
+        root = tmp_path / "fs"
+        (root / "kubepods" / "pod1").mkdir(parents=True)
+        (root / "kubepods" / "pod1" / "cpu.max").write_text("800000 100000\n")
+        proc = self._proc(tmp_path, "0::/kubepods/pod1\n")
+        assert util.cgroup_cpu_limit(str(root), proc) == 8
+
+    def test_v2_quota_on_ancestor(self, tmp_path):
+        root = tmp_path / "fs"
+        (root / "kubepods" / "pod1").mkdir(parents=True)
+        (root / "kubepods" / "pod1" / "cpu.max").write_text("max 100000\n")
+        (root / "kubepods" / "cpu.max").write_text("250000 100000\n")
+        proc = self._proc(tmp_path, "0::/kubepods/pod1\n")
+        assert util.cgroup_cpu_limit(str(root), proc) == 3
+
+    def test_v2_unlimited(self, tmp_path):
+        root = tmp_path / "fs"
+        root.mkdir()
+        (root / "cpu.max").write_text("max 100000\n")
+        proc = self._proc(tmp_path, "0::/\n")
+        assert util.cgroup_cpu_limit(str(root), proc) is None
+
+    def test_v1_cpu_quota(self, tmp_path):
+        root = tmp_path / "fs"
+        cpu = root / "cpu,cpuacct" / "docker"
+        cpu.mkdir(parents=True)
+        (cpu / "cpu.cfs_quota_us").write_text("200000\n")
+        (cpu / "cpu.cfs_period_us").write_text("100000\n")
+        proc = self._proc(tmp_path, "4:cpu,cpuacct:/docker\n")
+        assert util.cgroup_cpu_limit(str(root), proc) == 2
+
+    def test_v1_no_quota(self, tmp_path):
+        root = tmp_path / "fs"
+        cpu = root / "cpu"
+        cpu.mkdir(parents=True)
+        (cpu / "cpu.cfs_quota_us").write_text("-1\n")
+        (cpu / "cpu.cfs_period_us").write_text("100000\n")
+        proc = self._proc(tmp_path, "4:cpu:/\n")
+        assert util.cgroup_cpu_limit(str(root), proc) is None
+
+    def test_v2_memory(self, tmp_path):
+        root = tmp_path / "fs"
+        (root / "pod").mkdir(parents=True)
+        (root / "pod" / "memory.max").write_text(str(4 * 1024**3))
+        (root / "pod" / "memory.current").write_text(str(1024**3))
+        proc = self._proc(tmp_path, "0::/pod\n")
+        assert util.cgroup_memory_limit(str(root), proc) == 3 * 1024**3
+
+    def test_page_cache_is_not_used(self, tmp_path):
+        root = tmp_path / "fs"
+        (root / "pod").mkdir(parents=True)
+        (root / "pod" / "memory.max").write_text(str(8 * 1024**3))
+        (root / "pod" / "memory.current").write_text(str(7 * 1024**3))
+        (root / "pod" / "memory.stat").write_text("anon {}\nfile {}\ninactive_file {}\n".format(1024**3, 6 * 1024**3, 5 * 1024**3))
+        proc = self._proc(tmp_path, "0::/pod\n")
+        assert util.cgroup_memory_limit(str(root), proc) == 6 * 1024**3
+
+    def test_v1_page_cache_is_not_used(self, tmp_path):
+        root = tmp_path / "fs"
+        mem = root / "memory" / "docker"
+        mem.mkdir(parents=True)
+        (mem / "memory.limit_in_bytes").write_text(str(4 * 1024**3))
+        (mem / "memory.usage_in_bytes").write_text(str(3 * 1024**3))
+        (mem / "memory.stat").write_text("cache 1\ninactive_file 1\ntotal_inactive_file {}\n".format(2 * 1024**3))
+        proc = self._proc(tmp_path, "5:memory:/docker\n")
+        assert util.cgroup_memory_limit(str(root), proc) == 3 * 1024**3
+
+    def test_available_memory_uses_smaller(self, tmp_path):
+        root = tmp_path / "fs"
+        (root / "pod").mkdir(parents=True)
+        (root / "pod" / "memory.max").write_text(str(2 * 1024**3))
+        proc = self._proc(tmp_path, "0::/pod\n")
+        meminfo = tmp_path / "meminfo"
+        meminfo.write_text("MemTotal: 100000000 kB\nMemAvailable: 50000000 kB\n")
+        assert util.available_memory(str(meminfo), str(root), proc) == 2 * 1024**3
+
+
+class TestDefaultJobs:
+    def test_env_override(self, monkeypatch):
+        monkeypatch.setenv('CGET_JOBS', '3')
+        assert util.default_jobs() == 3
+
+    def test_limited_by_memory(self, monkeypatch):
+        monkeypatch.delenv('CGET_JOBS', raising=False)
+        monkeypatch.setenv('CGET_JOB_MEMORY', '2G')
+        monkeypatch.setattr(util, 'cpu_count', lambda: 16)
+        monkeypatch.setattr(util, 'available_memory', lambda: 5 * 1024**3)
+        assert util.default_jobs() == 2
+
+    def test_at_least_one(self, monkeypatch):
+        monkeypatch.delenv('CGET_JOBS', raising=False)
+        monkeypatch.setattr(util, 'cpu_count', lambda: 16)
+        monkeypatch.setattr(util, 'available_memory', lambda: 0)
+        assert util.default_jobs() == 1
+
+    def test_cpu_count_respects_cgroup(self, monkeypatch):
+        monkeypatch.setattr(util, 'cgroup_cpu_limit', lambda: 2)
+        assert util.cpu_count() <= 2
@@ -0,0 +1,56 @@
+import os, sys, shutil, tarfile, tempfile, time, argparse
+
+__dir__ = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(__dir__, '..'))
+
+import cget.util as util
+
+# Source files that don't compress too well, so the time to decompress
+# isn't lost among the files that are created
+def create_archive(d, files, lines, mode):
+    src = os.path.join(d, 'src')
+    util.mkdir(src)
+    for i in range(files):
+        with open(os.path.join(src, 'f{}.txt'.format(i)), 'w') as f:
+            f.write(''.join('int x{0}_{1} = {1};\n'.format(i, j * 7919 % 104729) for j in range(lines)))
+    archive = os.path.join(d, 'pkg.tar.' + mode)
+    with tarfile.open(archive, 'w:' + mode) as tar:
+        tar.add(src, arcname='proj')
+    return archive
+
+def bench(name, archive, tmp, repeat):
+    best = None
+    for i in range(repeat):
+        dst = os.path.join(tmp, 'dst')
+        start = time.time()
+        util.extract_ar(archive, dst)
+        elapsed = time.time() - start
+        shutil.rmtree(dst)
+        if best is None or elapsed < best: best = elapsed
+    print('{:<16} {:.3f}s'.format(name, best))
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark extracting a cached archive before and after it is recompressed')
+    parser.add_argument('-n', '--files', type=int, default=4)
+    parser.add_argument('-l', '--lines', type=int, default=30000)
+    parser.add_argument('-m', '--mode', choices=['gz', 'bz2', 'xz'], default='xz')
+    parser.add_argument('-f', '--format', choices=['zstd', 'tar'], default='zstd')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+    tmp = tempfile.mkdtemp()
+    try:
+        util.get_cache_path = lambda *paths: os.path.join(tmp, 'cache', *paths)
+        util.RECOMPRESS_CACHE = args.format
+        archive = create_archive(tmp, args.files, args.lines, args.mode)
+        f = util.add_cache_file('sha256-' + util.hash_file(archive, 'sha256'), archive)
+        fast = util.get_fast_archive(f)
+        print('Extracting {} files of {} lines'.format(args.files, args.lines))
+        before = bench(args.mode, f, tmp, args.repeat)
+        after = bench(util.get_archive_format(fast), fast, tmp, args.repeat)
+        print('{:<16} {:.1f}x'.format('speedup', before / after))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import os, sys, shutil, tempfile, time, argparse
+
+__dir__ = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(__dir__, '..'))
+
+import cget.util as util
+
+# The os.walk based linker used before, as the baseline
+def walk_symlink_dir(src, dst):
+    for root, dirs, files in os.walk(src):
+        all_files = (file for x in [dirs, files] for file in x if os.path.islink(os.path.join(root, file)) or os.path.isfile(os.path.join(root, file)))
+        for file in all_files:
+            d = os.path.join(dst, os.path.relpath(root, src))
+            util.mkdir(d)
+            os.symlink(os.path.relpath(os.path.join(root, file), d), os.path.join(d, file))
+
+def walk_copy_dir(src, dst):
+    for root, dirs, files in os.walk(src):
+        for file in files:
+            d = os.path.join(dst, os.path.relpath(root, src))
+            util.mkdir(d)
+            shutil.copy2(os.path.join(root, file), os.path.join(d, file))
+
+# Roughly the shape of a boost install: many headers spread over nested
+# directories
+def create_tree(d, n):
+    for i in range(n):
+        p = os.path.join(d, 'include', 'lib{}'.format(i % 50), 'detail{}'.format(i % 7))
+        util.mkdir(p)
+        with open(os.path.join(p, 'header{}.hpp'.format(i)), 'w') as f:
+            f.write('#pragma once\n' * 8)
+
+def bench(name, f, src, tmp, repeat):
+    best = None
+    for i in range(repeat):
+        dst = os.path.join(tmp, 'dst')
+        start = time.time()
+        f(src, dst)
+        elapsed = time.time() - start
+        shutil.rmtree(dst)
+        if best is None or elapsed < best: best = elapsed
+    print('{:<16} {:.3f}s'.format(name, best))
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark linking an install tree into a prefix')
+    parser.add_argument('-n', '--files', type=int, default=20000)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+    tmp = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp, 'src')
+        create_tree(src, args.files)
+        print('Linking {} files'.format(args.files))
+        before = bench('walk symlink', walk_symlink_dir, src, tmp, args.repeat)
+        after = bench('symlink_dir', util.symlink_dir, src, tmp, args.repeat)
+        print('{:<16} {:.1f}x'.format('speedup', before / after))
+        before = bench('walk copy', walk_copy_dir, src, tmp, args.repeat)
+        after = bench('copy_dir', util.copy_dir, src, tmp, args.repeat)
+        print('{:<16} {:.1f}x'.format('speedup', before / after))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import os, sys, shlex, timeit, argparse
+
+__dir__ = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(__dir__, '..'))
+
+from cget.package import PackageBuild, parse_pkg_build_tokens, split_requirement
+
+# The argparse based parser used before, as the baseline
+def argparse_pkg_build_tokens(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pkg_src', nargs='?')
+    parser.add_argument('-D', '--define', action='append', default=[])
+    parser.add_argument('-H', '--hash')
+    parser.add_argument('-X', '--cmake')
+    parser.add_argument('-f', '--file')
+    parser.add_argument('-t', '--test', action='store_true')
+    parser.add_argument('-b', '--build', action='store_true')
+    parser.add_argument('--ignore-requirements', action='store_true')
+    return parser.parse_args(args=args, namespace=PackageBuild())
+
+REQUIREMENT_LINES = [
+    "user/repo",
+    "user/repo@v1.0 -DFOO=1 -DBAR=2 # pinned",
+    "zlib,http://zlib.net/zlib-1.2.11.tar.gz -H sha256:abc -X recipe.cmake",
+    "-f dev-requirements.txt",
+    "pkg --define=A=1 --test -b --ignore-requirements",
+    "pkg -D 'A=with space' -t",
+    "# just a comment",
+    "",
+]
+
+def parse(line):
+    tokens = split_requirement(line)
+    if tokens: parse_pkg_build_tokens(tokens)
+
+def argparse_parse(line):
+    tokens = shlex.split(line, comments=True)
+    if tokens: argparse_pkg_build_tokens(tokens)
+
+def bench(name, f, lines, repeat):
+    best = min(timeit.repeat(lambda: [f(line) for line in lines], number=1, repeat=repeat))
+    print('{:<16} {:.3f}s'.format(name, best))
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parsing requirements files')
+    parser.add_argument('-n', '--lines', type=int, default=1000)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+    lines = (REQUIREMENT_LINES * (args.lines // len(REQUIREMENT_LINES) + 1))[:args.lines]
+    print('Parsing {} lines'.format(len(lines)))
+    before = bench('argparse', argparse_parse, lines, args.repeat)
+    after = bench('parse_pkg_build', parse, lines, args.repeat)
+    print('{:<16} {:.1f}x'.format('speedup', before / after))
+
+if __name__ == '__main__':
+    main()